@@ -0,0 +1,140 @@
+"""
+One-time conversion of LoRA adapters to PEFT-native safetensors.
+
+Adapters trained with torch.compile are saved with ``._orig_mod`` in their
+tensor names, which PEFT cannot match. Instead of repairing the weights on
+every load, the adapter is converted once into a ``peft_native`` directory
+next to the original (or under ADAPTER_CACHE_DIR when the adapter directory
+is read-only). The converted file records the source's SHA-256 so stale
+conversions are detected; later loads read it directly through PEFT, which
+memory-maps safetensors files. Both files are written to a temporary name and
+renamed into place, the config first, so a conversion is only used once its
+weights exist and its config matches the source's.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+ADAPTER_CONFIG = "adapter_config.json"
+CONVERTED_DIR = "peft_native"
+ADAPTER_CACHE_DIR = os.environ.get("ADAPTER_CACHE_DIR", "/models/.adapter_cache")
+
+
+def native_key(key):
+    return key.replace("._orig_mod", "")
+
+
+def needs_conversion(safetensors_path):
+    """Only the header is read to list tensor names"""
+    with safe_open(safetensors_path, framework="pt") as f:
+        return any(native_key(key) != key for key in f.keys())
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {"source_size": str(stat.st_size), "source_mtime_ns": str(stat.st_mtime_ns)}
+
+
+def _read_metadata(path):
+    try:
+        with safe_open(path, framework="pt") as f:
+            return f.metadata() or {}
+    except Exception:
+        return {}
+
+
+def _same_file(a, b):
+    try:
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            return fa.read() == fb.read()
+    except OSError:
+        return False
+
+
+def _is_current(adapter_path, target_dir):
+    """The stored size/mtime avoid rehashing the source when it is untouched"""
+    source = os.path.join(adapter_path, ADAPTER_WEIGHTS)
+    converted = os.path.join(target_dir, ADAPTER_WEIGHTS)
+    if not os.path.exists(converted):
+        return False
+    if not _same_file(os.path.join(adapter_path, ADAPTER_CONFIG), os.path.join(target_dir, ADAPTER_CONFIG)):
+        return False
+    metadata = _read_metadata(converted)
+    if not metadata.get("source_sha256"):
+        return False
+    stamp = _source_stamp(source)
+    if all(metadata.get(k) == v for k, v in stamp.items()):
+        return True
+    return metadata["source_sha256"] == file_sha256(source)
+
+
+def _candidate_dirs(adapter_path):
+    yield os.path.join(adapter_path, CONVERTED_DIR)
+    key = hashlib.sha256(os.path.abspath(adapter_path).encode()).hexdigest()[:16]
+    yield os.path.join(ADAPTER_CACHE_DIR, key)
+
+
+def _replace(target_path, write):
+    """Write through write(tmp_path) first so concurrent loaders never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _convert(adapter_path, target_dir):
+    source = os.path.join(adapter_path, ADAPTER_WEIGHTS)
+    os.makedirs(target_dir, exist_ok=True)
+    metadata = {"source_sha256": file_sha256(source), **_source_stamp(source)}
+    with safe_open(source, framework="pt") as f:
+        tensors = {native_key(key): f.get_tensor(key) for key in f.keys()}
+    # The config goes first: a loader that finds the new weights also finds their config
+    _replace(
+        os.path.join(target_dir, ADAPTER_CONFIG),
+        lambda tmp_path: shutil.copyfile(os.path.join(adapter_path, ADAPTER_CONFIG), tmp_path),
+    )
+    _replace(os.path.join(target_dir, ADAPTER_WEIGHTS), lambda tmp_path: save_file(tensors, tmp_path, metadata=metadata))
+    print(f"Converted adapter {adapter_path} -> {target_dir} ({len(tensors)} tensors)")
+
+
+def prepare_adapter(adapter_path):
+    """
+    Return a directory PEFT can load without any key remapping: the adapter
+    itself when it is already PEFT-native, otherwise its converted copy.
+    """
+    source = os.path.join(adapter_path, ADAPTER_WEIGHTS)
+    if not os.path.exists(source) or not os.path.exists(os.path.join(adapter_path, ADAPTER_CONFIG)):
+        return adapter_path
+
+    for target_dir in _candidate_dirs(adapter_path):
+        if _is_current(adapter_path, target_dir):
+            return target_dir
+
+    if not needs_conversion(source):
+        return adapter_path
+
+    for target_dir in _candidate_dirs(adapter_path):
+        try:
+            _convert(adapter_path, target_dir)
+            return target_dir
+        except OSError as e:
+            print(f"Cannot write converted adapter to {target_dir}: {e}")
+    print(f"Loading adapter {adapter_path} without conversion")
+    return adapter_path
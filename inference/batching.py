@@ -0,0 +1,153 @@
+"""
+Dynamic request batching for the inference consumer.
+
+Messages are buffered as they arrive and flushed either when the buffer
+reaches ``max_batch_size`` or ``max_wait`` seconds after the first message
+was buffered. On flush the buffer is grouped by base model, generation args
+and whether an adapter is used, so that every group can be served by a
+single ``generate()`` call.
+
+Messages carry a priority class (``interactive`` by default, or ``batch``)
+and optionally a ``deadline`` as a unix timestamp. A flush serves the most
+urgent class present; less urgent messages are kept for an immediate follow-up
+flush, so urgent messages delivered in the meantime are served first. Within
+a class, groups with the earliest deadline go first.
+"""
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+# Priority classes, most urgent first. Each class is consumed from its own queue.
+PRIORITY_CLASSES = ("interactive", "batch")
+DEFAULT_PRIORITY = PRIORITY_CLASSES[0]
+
+
+@dataclass
+class PendingMessage:
+    channel: Any
+    method: Any
+    properties: Any
+    message: Dict[str, Any]
+    received_at: float = field(default_factory=time.monotonic)
+    # Result of the scheduler's prepare hook, e.g. a future for a prefetched document
+    document: Any = None
+
+
+def priority_of(message):
+    priority = message.get("priority")
+    return priority if priority in PRIORITY_CLASSES else DEFAULT_PRIORITY
+
+
+def priority_rank(message):
+    return PRIORITY_CLASSES.index(priority_of(message))
+
+
+def class_queue(queue, priority):
+    """Queue carrying priority's messages; the most urgent class uses queue itself"""
+    return queue if priority == PRIORITY_CLASSES[0] else f"{queue}_{priority}"
+
+
+def message_deadline(message):
+    deadline = message.get("deadline")
+    try:
+        return float(deadline) if deadline is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def deadline_passed(message, now=None):
+    deadline = message_deadline(message)
+    return deadline is not None and deadline <= (time.time() if now is None else now)
+
+
+def batch_key(message):
+    """
+    Messages with equal keys can share one generate() call. Adapter requests
+    for one base model share a key, since their adapters are attached to a
+    single resident model and can be selected per row.
+    """
+    generation_args = message.get("generation_args")
+    if generation_args is not None:
+        generation_args = json.dumps(generation_args, sort_keys=True)
+    return (
+        message.get("base_model_path"),
+        bool(message.get("adapter_path")),
+        generation_args,
+        bool(message.get("stream")),
+        priority_of(message),
+    )
+
+
+class BatchScheduler:
+    def __init__(self, process_group: Callable[[List[PendingMessage]], None],
+                 max_batch_size: int = 8, max_wait: float = 0.05, connection=None,
+                 prepare: Optional[Callable[[Dict[str, Any]], Any]] = None):
+        """
+        process_group is called once per group with the pending messages of
+        that group. It is responsible for publishing and acking each of them.
+        connection provides call_later/remove_timeout (pika BlockingConnection);
+        without one every message is flushed immediately.
+        prepare is called with each message as it arrives, so that work such as
+        document fetching can start while the message waits for its batch.
+        """
+        self.process_group = process_group
+        self.prepare = prepare
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait
+        self.connection = connection
+        self.pending: List[PendingMessage] = []
+        self._timer = None
+
+    def submit(self, channel, method, properties, message):
+        item = PendingMessage(channel, method, properties, message)
+        if self.prepare is not None:
+            try:
+                item.document = self.prepare(message)
+            except Exception as e:
+                print(f"Failed to prepare message: {e}")
+        self.pending.append(item)
+        if len(self.pending) >= self.max_batch_size or self.connection is None:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.connection.call_later(self.max_wait, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _cancel_timer(self):
+        if self._timer is not None and self.connection is not None:
+            try:
+                self.connection.remove_timeout(self._timer)
+            except Exception as e:
+                print(f"Failed to cancel batch timer: {e}")
+        self._timer = None
+
+    def flush(self):
+        self._cancel_timer()
+        if not self.pending:
+            return
+
+        rank = min(priority_rank(item.message) for item in self.pending)
+        pending = [item for item in self.pending if priority_rank(item.message) == rank]
+        self.pending = [item for item in self.pending if priority_rank(item.message) != rank]
+
+        groups: Dict[tuple, List[PendingMessage]] = {}
+        for item in pending:
+            groups.setdefault(batch_key(item.message), []).append(item)
+
+        def earliest_deadline(group):
+            deadlines = [d for d in (message_deadline(item.message) for item in group) if d is not None]
+            return min(deadlines) if deadlines else float("inf")
+
+        for group in sorted(groups.values(), key=earliest_deadline):
+            self.process_group(group)
+
+        # Less urgent messages go next, after any newly delivered urgent ones
+        if self.pending:
+            if self.connection is None:
+                self.flush()
+            elif self._timer is None:
+                self._timer = self.connection.call_later(0, self._on_timer)
+
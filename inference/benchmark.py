@@ -0,0 +1,254 @@
+"""
+Local throughput and latency benchmark of the inference consumer.
+
+Runs ``generic_inference.main()`` unchanged, with its RabbitMQ connection
+replaced by the in-memory broker (``inference.local_broker``) and tiny
+randomly initialised Llama models, written to disk once and loaded on CPU
+through the normal handler path. Requests are published according to a
+workload: a weighted mix of models, prompt lengths and text attachments,
+sent all at once or at a fixed rate. Latency runs from publishing a request
+to its result reaching the output queue.
+
+Usage: python -m inference.benchmark [--workload workload.json] [--output report.json]
+
+A workload file overrides any of the keys of ``DEFAULT_WORKLOAD``. The report
+is JSON with p50/p95/p99 latency overall and per model, generated tokens per
+second and the number of times each model's handler was loaded.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+DEFAULT_WORKLOAD = {
+    "requests": 64,
+    # Names ending in -instruct or -chat get a ChatHandler, the others a PipelineHandler
+    "models": [
+        {"name": "tiny-instruct", "weight": 3, "hidden_size": 64, "layers": 2},
+        {"name": "tiny-base", "weight": 1, "hidden_size": 64, "layers": 2},
+    ],
+    "prompt_words": [{"words": 8, "weight": 4}, {"words": 64, "weight": 2}, {"words": 192, "weight": 1}],
+    # Share of requests carrying a text file_url of attachment_words words
+    "attachment_ratio": 0.25,
+    "attachment_words": 400,
+    "max_new_tokens": 16,
+    # Requests per second; 0 publishes the whole workload at once
+    "rate": 0,
+    "max_batch_size": 8,
+    "seed": 0,
+}
+
+VOCAB_WORDS = 200
+SPECIAL_TOKENS = ["<pad>", "<unk>", "<s>", "</s>"]
+CHAT_TEMPLATE = (
+    "{% for m in messages %}{{ m['role'] }} : {{ m['content'] }} {% endfor %}"
+    "{% if add_generation_prompt %}assistant : {% endif %}"
+)
+
+
+def vocabulary():
+    return SPECIAL_TOKENS + [f"w{i}" for i in range(VOCAB_WORDS)] + ["user", "assistant", ":"]
+
+
+def save_tiny_model(path, hidden_size=64, layers=2, seed=0):
+    """Write a randomly initialised Llama model and word-level tokenizer to path"""
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    vocab = {token: i for i, token in enumerate(vocabulary())}
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>", eos_token="</s>", unk_token="<unk>", pad_token="<pad>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(vocab), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers, num_attention_heads=4, num_key_value_heads=4,
+        max_position_embeddings=1024, bos_token_id=2, eos_token_id=3, pad_token_id=0,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+def percentiles(samples):
+    """Nearest-rank p50/p95/p99, mean and max of samples"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": sum(ordered) / len(ordered),
+        "max": ordered[-1],
+    }
+
+
+def weighted(rng, options):
+    return rng.choices(options, weights=[option.get("weight", 1) for option in options])[0]
+
+
+def build_requests(workload, model_dir, rng):
+    """Messages of the workload, with the model name each one is for"""
+    words = [f"w{i}" for i in range(VOCAB_WORDS)]
+    attachment = os.path.join(model_dir, "attachment.txt")
+    with open(attachment, "w") as f:
+        f.write(" ".join(rng.choice(words) for _ in range(workload["attachment_words"])))
+
+    requests = []
+    for index in range(workload["requests"]):
+        model = weighted(rng, workload["models"])
+        length = weighted(rng, workload["prompt_words"])["words"]
+        message = {
+            "conversation_id": f"bench-{index}",
+            "base_model_path": os.path.join(model_dir, model["name"]),
+            "input": [{"role": "user", "content": " ".join(rng.choice(words) for _ in range(length))}],
+            "generation_args": {"max_new_tokens": workload["max_new_tokens"], "do_sample": False},
+        }
+        if rng.random() < workload["attachment_ratio"]:
+            message["file_url"] = attachment
+        requests.append((model["name"], message))
+    return requests
+
+
+def run_benchmark(workload=None, model_dir=None):
+    workload = dict(DEFAULT_WORKLOAD, **(workload or {}))
+    rng = random.Random(workload["seed"])
+    model_dir = model_dir or tempfile.mkdtemp(prefix="llmedic-bench-")
+    for model in workload["models"]:
+        path = os.path.join(model_dir, model["name"])
+        if not os.path.exists(os.path.join(path, "config.json")):
+            save_tiny_model(path, model.get("hidden_size", 64), model.get("layers", 2), workload["seed"])
+    requests = build_requests(workload, model_dir, rng)
+
+    from inference import generic_inference, runtime
+    from inference.local_broker import LocalConnection
+
+    sent_at, done_at, results = {}, {}, {}
+    published = []
+    loads = {}
+
+    def on_publish(exchange, routing_key, body, properties):
+        if routing_key != generic_inference.OUTPUT_QUEUE:
+            return
+        response = json.loads(body)
+        if response.get("done") is False:
+            return
+        done_at[response["conversation_id"]] = time.monotonic()
+        results[response["conversation_id"]] = response
+
+    def publish(channel, message):
+        message = dict(message, enqueued_at=time.time())
+        sent_at[message["conversation_id"]] = time.monotonic()
+        channel.basic_publish(exchange="", routing_key=generic_inference.INPUT_QUEUE, body=json.dumps(message))
+        published.append(message["conversation_id"])
+
+    def on_ready(channel):
+        for index, (_, message) in enumerate(requests):
+            if workload["rate"] > 0:
+                connection.call_later(index / workload["rate"], lambda m=message: publish(channel, m))
+            else:
+                publish(channel, message)
+
+    def finished():
+        return len(published) == len(requests) and connection.idle()
+
+    build_handler = runtime.build_handler
+
+    def counting_build_handler(base_model_path, device, adapter_path=None):
+        name = os.path.basename(base_model_path)
+        loads[name] = loads.get(name, 0) + 1
+        return build_handler(base_model_path, device, adapter_path)
+
+    connection = LocalConnection(on_ready=on_ready, on_publish=on_publish, until=finished)
+    started = time.monotonic()
+    with patch("pika.BlockingConnection", return_value=connection), \
+         patch.object(runtime, "build_handler", counting_build_handler), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", workload["max_batch_size"]), \
+         patch.object(generic_inference, "METRICS_PORT", 0), \
+         patch.object(generic_inference, "MODEL_ROUTING", False), \
+         patch.object(generic_inference, "PRELOAD_MODELS", ""), \
+         patch.object(generic_inference, "PRELOAD_MANIFEST", ""):
+        generic_inference.main()
+    wall = time.monotonic() - started
+
+    from transformers import AutoTokenizer
+
+    tokenizers = {}
+    latencies, by_model = [], {}
+    generated_tokens = 0
+    errors = 0
+    for name, message in requests:
+        conversation_id = message["conversation_id"]
+        response = results.get(conversation_id)
+        if response is None or response.get("error"):
+            errors += 1
+            continue
+        latency = done_at[conversation_id] - sent_at[conversation_id]
+        latencies.append(latency)
+        by_model.setdefault(name, []).append(latency)
+        if name not in tokenizers:
+            tokenizers[name] = AutoTokenizer.from_pretrained(message["base_model_path"])
+        generated_tokens += len(tokenizers[name](response["result"], add_special_tokens=False)["input_ids"])
+
+    return {
+        "workload": workload,
+        "requests": len(requests),
+        "completed": len(latencies),
+        "errors": errors,
+        "wall_seconds": wall,
+        "requests_per_second": len(latencies) / wall if wall else 0.0,
+        "generated_tokens": generated_tokens,
+        "tokens_per_second": generated_tokens / wall if wall else 0.0,
+        "latency_seconds": percentiles(latencies),
+        "latency_seconds_by_model": {name: percentiles(samples) for name, samples in sorted(by_model.items())},
+        "handler_loads": loads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inference consumer against an in-memory broker")
+    parser.add_argument("--workload", default=None, help="JSON file overriding the default workload")
+    parser.add_argument("--requests", type=int, default=None)
+    parser.add_argument("--rate", type=float, default=None, help="requests per second, 0 sends all at once")
+    parser.add_argument("--model-dir", default=None, help="where the tiny models are written and reused")
+    parser.add_argument("--output", default=None, help="write the JSON report here as well")
+    args = parser.parse_args()
+
+    workload = {}
+    if args.workload:
+        with open(args.workload) as f:
+            workload = json.load(f)
+    if args.requests is not None:
+        workload["requests"] = args.requests
+    if args.rate is not None:
+        workload["rate"] = args.rate
+    # The consumer's logging goes to stderr, leaving stdout to the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmark(workload, model_dir=args.model_dir)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
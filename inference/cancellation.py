@@ -0,0 +1,96 @@
+"""
+Cancellation of requests whose conversation was abandoned.
+
+Producers publish ``{"conversation_id": ..., "cancelled_at": <unix time>}`` to
+the ``CANCEL_EXCHANGE`` fanout exchange when a clinician rejects a response
+or closes the conversation; ``cancelled_at`` defaults to the time the worker
+receives it. Every worker follows the exchange on its own connection in a
+background thread, because the consumer's connection is not serviced while
+generate() runs. Requests of that conversation enqueued before the
+cancellation are dropped if still queued, and stopped by a stopping
+criterion (``runtime.cancellation_criteria``) if already generating. Later
+requests of the same conversation are served normally.
+"""
+import json
+import os
+import threading
+import time
+
+# Fanout exchange carrying cancellations, empty disables them
+CANCEL_EXCHANGE = os.environ.get("CANCEL_EXCHANGE", "")
+# Generation checks for cancellation every CANCEL_CHECK_TOKENS decode steps
+CANCEL_CHECK_TOKENS = int(os.environ.get("CANCEL_CHECK_TOKENS", "4"))
+# Cancellations are forgotten after this long
+CANCEL_TTL_S = float(os.environ.get("CANCEL_TTL_S", "900"))
+CANCEL_RECONNECT_S = 5
+
+
+class CancellationRegistry:
+    """Latest cancellation time per conversation, shared with the listener thread"""
+    def __init__(self, ttl=CANCEL_TTL_S):
+        self.ttl = ttl
+        self._cancelled = {}
+        self._lock = threading.Lock()
+
+    def cancel(self, conversation_id, cancelled_at=None):
+        now = time.time()
+        cancelled_at = now if cancelled_at is None else cancelled_at
+        with self._lock:
+            self._cancelled[conversation_id] = max(cancelled_at, self._cancelled.get(conversation_id, 0))
+            expired = [key for key, at in self._cancelled.items() if now - at > self.ttl]
+            for key in expired:
+                del self._cancelled[key]
+
+    def cancelled(self, conversation_id, requested_at):
+        """Whether the request of conversation_id made at requested_at (unix time) was cancelled since"""
+        with self._lock:
+            cancelled_at = self._cancelled.get(conversation_id)
+        return cancelled_at is not None and requested_at <= cancelled_at
+
+    def __len__(self):
+        return len(self._cancelled)
+
+
+def parse_cancellation(body):
+    """(conversation_id, cancelled_at) of a cancellation message, None if it is invalid"""
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(message, dict) or message.get("conversation_id") is None:
+        return None
+    cancelled_at = message.get("cancelled_at")
+    return message["conversation_id"], cancelled_at if isinstance(cancelled_at, (int, float)) else None
+
+
+class CancelListener(threading.Thread):
+    def __init__(self, registry, connect, exchange=CANCEL_EXCHANGE, reconnect_delay=CANCEL_RECONNECT_S):
+        """connect() opens a new BlockingConnection for this thread"""
+        super().__init__(name="cancel-listener", daemon=True)
+        self.registry = registry
+        self.connect = connect
+        self.exchange = exchange
+        self.reconnect_delay = reconnect_delay
+
+    def on_cancel(self, ch, method, properties, body):
+        cancellation = parse_cancellation(body)
+        if cancellation is None:
+            print(f"Ignoring invalid cancellation: {body!r}")
+            return
+        print(f"Cancelling requests of conversation {cancellation[0]}")
+        self.registry.cancel(*cancellation)
+
+    def run(self):
+        while True:
+            try:
+                connection = self.connect()
+                channel = connection.channel()
+                channel.exchange_declare(exchange=self.exchange, exchange_type="fanout")
+                queue = channel.queue_declare(queue="", exclusive=True).method.queue
+                channel.queue_bind(exchange=self.exchange, queue=queue)
+                channel.basic_consume(queue=queue, on_message_callback=self.on_cancel, auto_ack=True)
+                channel.start_consuming()
+                return
+            except Exception as e:
+                print(f"Cancellation listener disconnected: {e}, reconnecting in {self.reconnect_delay}s")
+                time.sleep(self.reconnect_delay)
@@ -0,0 +1,376 @@
+"""
+Fetching and text extraction for ``file_url`` attachments.
+
+Documents are read on a bounded pool of worker threads as soon as a message
+is received, so the thread driving the accelerator never waits on a slow
+file server or a long PDF. The work itself is bounded, so slow documents
+cannot hold on to the workers: a download is abandoned once it has taken
+``fetch_timeout`` seconds in total or exceeds ``max_bytes``, and PDF extraction
+stops at the first page boundary after ``extract_timeout`` seconds. The caller
+waits at most for the two timeouts together; a document that misses a bound
+contributes no text instead of stalling the batch.
+
+Extracted text is cached by the SHA-256 of the document's bytes, in memory
+and optionally on disk. For URLs the ETag/Last-Modified validators are
+remembered, so a repeat request is a conditional GET: an unchanged document
+is neither downloaded nor extracted again. The size of the disk store is
+counted from one scan plus the files written since, and it is only walked
+again to trim it once the count exceeds ``max_disk_bytes``; trimming goes down
+to ``DISK_TRIM_RATIO`` of the limit so scans stay rare.
+
+Extraction can be capped at ``max_chars``: PDF pages are extracted lazily and
+reading stops once the cap is reached, so a long upload costs time in
+proportion to the part the model can actually see.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from io import BytesIO
+
+import requests
+
+try:
+    from PyPDF2 import PdfReader
+except ImportError:
+    PdfReader = None
+
+# Downloads are read in chunks of this size, checking the time and size bounds in between
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+def iter_pdf_pages(file_obj):
+    """Yield the text of each non-empty page, extracting pages only as they are consumed"""
+    reader = PdfReader(file_obj)
+    for page in reader.pages:
+        text = page.extract_text()
+        if text:
+            yield text
+
+def extract_text_from_pdf(file_obj, max_chars=None, deadline=None):
+    """
+    Text of a PDF, up to max_chars. Past deadline, a time.monotonic() value,
+    extraction stops with a TimeoutError between pages.
+    """
+    if PdfReader is None:
+        print("PyPDF2 not installed, can't extract PDF text")
+        return ""
+    try:
+        pages = []
+        length = 0
+        for text in iter_pdf_pages(file_obj):
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"PDF extraction stopped after {len(pages)} page(s) at its time limit")
+            pages.append(text)
+            length += len(text) + 1
+            if max_chars and length >= max_chars:
+                print(f"Stopped PDF extraction after {len(pages)} page(s) at the {max_chars} character budget")
+                break
+        file_text = "\n".join(pages)
+        return file_text[:max_chars] if max_chars else file_text
+    except TimeoutError:
+        raise
+    except Exception as e:
+        print(f"PDF extraction failed: {e}")
+        return ""
+
+# Share of max_disk_bytes the disk store is trimmed down to
+DISK_TRIM_RATIO = 0.9
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class DocumentTextCache:
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        # Bytes of text files on disk, counted on the first write; other processes
+        # sharing disk_dir are only seen by the scan of the next trim
+        self._disk_bytes = None
+        self._texts = OrderedDict()  # content sha256 -> text
+        self._urls = {}  # url -> {"etag", "last_modified", "sha256"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _text_path(self, digest):
+        return os.path.join(self.disk_dir, "text", digest[:2], f"{digest}.txt")
+
+    def _url_path(self, url):
+        return os.path.join(self.disk_dir, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get_text(self, digest):
+        with self._lock:
+            if digest in self._texts:
+                self._texts.move_to_end(digest)
+                self.hits += 1
+                return self._texts[digest]
+        text = None
+        if self.disk_dir:
+            try:
+                with open(self._text_path(digest), "r", encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(self._text_path(digest))
+            except OSError:
+                text = None
+        with self._lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(digest, text)
+        return text
+
+    def put_text(self, digest, text):
+        with self._lock:
+            self._remember(digest, text)
+        if self.disk_dir:
+            path = self._text_path(digest)
+            replaced = _file_size(path)
+            self._write(path, text)
+            with self._lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+                else:
+                    self._disk_bytes += _file_size(path) - replaced
+                over = self._disk_bytes > self.max_disk_bytes
+            if over:
+                self._trim_disk()
+
+    def _remember(self, digest, text):
+        self._texts[digest] = text
+        self._texts.move_to_end(digest)
+        while len(self._texts) > self.max_entries:
+            self._texts.popitem(last=False)
+
+    def url_entry(self, url):
+        with self._lock:
+            entry = self._urls.get(url)
+        if entry is None and self.disk_dir:
+            try:
+                with open(self._url_path(url), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+        return entry
+
+    def remember_url(self, url, etag, last_modified, digest):
+        if not etag and not last_modified:
+            return
+        entry = {"etag": etag, "last_modified": last_modified, "sha256": digest}
+        with self._lock:
+            self._urls[url] = entry
+        if self.disk_dir:
+            self._write(self._url_path(url), json.dumps(entry))
+
+    def _write(self, path, content):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write document cache entry {path}: {e}")
+
+    def _disk_files(self):
+        """(mtime, size, path) of every text file on disk"""
+        files = []
+        for root, _, names in os.walk(os.path.join(self.disk_dir, "text")):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _trim_disk(self):
+        """Remove least recently used text files until the store fits DISK_TRIM_RATIO of max_disk_bytes"""
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * DISK_TRIM_RATIO)
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._texts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+def _download(response, deadline=None, max_bytes=None):
+    """Body of a streamed response, abandoned past deadline (a time.monotonic() value) or beyond max_bytes"""
+    chunks = []
+    size = 0
+    try:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise ValueError(f"document exceeds {max_bytes} bytes")
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"download stopped after {size} bytes at its time limit")
+            chunks.append(chunk)
+    finally:
+        response.close()
+    return b"".join(chunks)
+
+def _extract(content, mime, source, encoding="utf-8", max_chars=None, deadline=None):
+    if mime and "pdf" in mime and PdfReader:
+        file_text = extract_text_from_pdf(BytesIO(content), max_chars=max_chars, deadline=deadline)
+        print(f"Extracted PDF text ({source}): {file_text[:100]}")
+    elif mime and "text" in mime:
+        file_text = content.decode(encoding or "utf-8", errors="replace")
+        if max_chars:
+            file_text = file_text[:max_chars]
+        print(f"Extracted text file ({source}): {file_text[:100]}")
+    else:
+        print(f"Unhandled mime type ({source}): {mime}")
+        file_text = ""
+    return file_text
+
+def _text_key(digest, max_chars):
+    """Texts extracted under different caps are cached separately"""
+    return f"{digest}-{max_chars}" if max_chars else digest
+
+def _cached_extract(content, mime, source, cache, encoding="utf-8", max_chars=None, deadline=None):
+    """Extract content, or reuse the text of identical bytes seen before"""
+    if cache is None:
+        return _extract(content, mime, source, encoding, max_chars, deadline), None
+    digest = hashlib.sha256(content).hexdigest()
+    file_text = cache.get_text(_text_key(digest, max_chars))
+    if file_text is None:
+        file_text = _extract(content, mime, source, encoding, max_chars, deadline)
+        cache.put_text(_text_key(digest, max_chars), file_text)
+    else:
+        print(f"Document cache hit ({source}): {digest[:12]}")
+    return file_text, digest
+
+def read_document(file_path, fetch_timeout=None, cache=None, max_chars=None, extract_timeout=None, max_bytes=None):
+    """
+    Return the text of a URL or local file and the seconds spent fetching and
+    extracting it. With a cache, unchanged documents are not downloaded or
+    extracted again. At most max_chars characters are extracted. Downloads
+    longer than fetch_timeout seconds in total or larger than max_bytes, and
+    extraction longer than extract_timeout seconds, give no text.
+    """
+    timings = {"fetch": 0.0, "extract": 0.0}
+    try:
+        if file_path.startswith("http"):
+            headers = {}
+            entry = cache.url_entry(file_path) if cache is not None else None
+            if entry:
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+
+            start = time.monotonic()
+            deadline = start + fetch_timeout if fetch_timeout else None
+            response = requests.get(file_path, timeout=fetch_timeout, headers=headers, stream=True)
+            content = _download(response, deadline, max_bytes)
+            timings["fetch"] = time.monotonic() - start
+
+            if entry and getattr(response, "status_code", 200) == 304:
+                file_text = cache.get_text(_text_key(entry["sha256"], max_chars))
+                if file_text is not None:
+                    print(f"Document unchanged (url): {file_path}")
+                    return file_text, timings
+                # Validated but evicted text: download it again, within what is left of the time limit
+                start = time.monotonic()
+                response = requests.get(file_path, timeout=fetch_timeout, stream=True)
+                content = _download(response, deadline, max_bytes)
+                timings["fetch"] += time.monotonic() - start
+
+            response.raise_for_status()
+            start = time.monotonic()
+            mime = response.headers.get('Content-Type', '')
+            file_text, digest = _cached_extract(
+                content, mime, "url", cache, getattr(response, "encoding", None), max_chars,
+                start + extract_timeout if extract_timeout else None,
+            )
+            if digest is not None:
+                cache.remember_url(file_path, response.headers.get("ETag"), response.headers.get("Last-Modified"), digest)
+            timings["extract"] = time.monotonic() - start
+        else:
+            start = time.monotonic()
+            mime, _ = mimetypes.guess_type(file_path)
+            if mime and ("pdf" in mime or "text" in mime):
+                with open(file_path, "rb") as f:
+                    content = f.read()
+                file_text, _ = _cached_extract(
+                    content, mime, "local", cache, max_chars=max_chars,
+                    deadline=start + extract_timeout if extract_timeout else None,
+                )
+            else:
+                print(f"Unhandled mime type (local): {mime}")
+                file_text = ""
+            timings["extract"] = time.monotonic() - start
+    except Exception as e:
+        print(f"Error reading file {file_path}: {e}")
+        file_text = ""
+    return file_text, timings
+
+class DocumentPrefetcher:
+    def __init__(self, max_workers=4, fetch_timeout=10.0, extract_timeout=30.0, cache=None, max_chars=None,
+                 max_bytes=None):
+        self.fetch_timeout = fetch_timeout
+        self.extract_timeout = extract_timeout
+        self.cache = cache
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="document")
+
+    def submit(self, file_path, max_chars=None):
+        """
+        Start reading file_path in the background, extracting at most
+        max_chars characters (by default the prefetcher's cap); returns a
+        future or None
+        """
+        if not file_path:
+            return None
+        return self._pool.submit(
+            read_document, file_path, self.fetch_timeout, self.cache, max_chars or self.max_chars,
+            self.extract_timeout, self.max_bytes,
+        )
+
+    def result(self, future):
+        """
+        Wait for a prefetched document. Returns its text and stage timings,
+        including "wait": how long the caller was blocked on it. A read that
+        is still running when the wait times out ends at its own bounds.
+        """
+        start = time.monotonic()
+        try:
+            file_text, timings = future.result(timeout=self.fetch_timeout + self.extract_timeout)
+        except FutureTimeout:
+            print(f"Document read exceeded {self.fetch_timeout + self.extract_timeout:.0f}s, continuing without it")
+            future.cancel()
+            file_text, timings = "", {"fetch": 0.0, "extract": 0.0}
+        timings["wait"] = time.monotonic() - start
+        return file_text, timings
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,463 +1,612 @@
 import os
-os.environ["HF_HOME"] = "/models"
-
 import pika
 import json
-from transformers import pipeline as hf_pipeline, AutoModelForCausalLM, AutoTokenizer, AutoProcessor, AutoModelForVision2Seq
-import transformers
-print("Transformers cache dir:", transformers.utils.default_cache_path)
-import torch
-import mimetypes
-import requests
-from io import BytesIO
-from peft import PeftModel
-from safetensors.torch import load_file
-
-try:
-    from PyPDF2 import PdfReader
-except ImportError:
-    PdfReader = None
-
-try:
-    from peft import PeftModel
-except ImportError:
-    PeftModel = None
-    
-def fix_lora_weights(peft_model, adapter_path):
-    """Fix LoRA weights by manually loading from safetensors with correct key mapping"""
-    if load_file is None:
-        print("Safetensors not available, skipping LoRA weight fix")
-        return peft_model
-        
-    print("Fixing LoRA weights...")
-    
-    safetensors_path = f"{adapter_path}/adapter_model.safetensors"
-    
-    # Check if safetensors file exists
-    if not os.path.exists(safetensors_path):
-        print(f"Safetensors file not found: {safetensors_path}")
-        return peft_model
-    
-    try:
-        safetensors_weights = load_file(safetensors_path)
-        model_state = peft_model.state_dict()
-        loaded_count = 0
-        
-        for safe_key, weight in safetensors_weights.items():
-            model_key = safe_key.replace("._orig_mod", "").replace(".weight", ".default.weight")
-            if model_key in model_state:
-                with torch.no_grad():
-                    model_state[model_key].copy_(weight)
-                loaded_count += 1
-                if loaded_count <= 3:
-                    print(f"{safe_key} -> {model_key}")
-            else:
-                print(f"Key not found: {model_key}")
-        
-        print(f"Successfully loaded {loaded_count} LoRA weights")
-        
-        # Verify LoRA weights are properly loaded
-        print("\nVerifying LoRA weights:")
-        for name, param in peft_model.named_parameters():
-            if "lora_B" in name:
-                norm = param.data.norm().item()
-                print(f"  {name}: norm = {norm:.4f}")
-                if norm == 0:
-                    print("WARNING: Weight is still zero!")
-                break  # Just check first one
-                
-    except Exception as e:
-        print(f"Error fixing LoRA weights: {e}")
-    
-    return peft_model
-
-def is_image_file(filepath):
-    mime, _ = mimetypes.guess_type(filepath)
-    return mime is not None and mime.startswith("image")
-
-def extract_text_from_pdf(file_obj):
-    if PdfReader is None:
-        print("PyPDF2 not installed, can't extract PDF text")
-        return ""
+import time
+from inference.batching import PRIORITY_CLASSES, BatchScheduler, class_queue, deadline_passed, priority_of
+from inference.handler_cache import HandlerCache
+from inference.metrics import GenerationTimer, InferenceMetrics
+from inference.memory import LoadMemory
+from inference.speculative import draft_model_for, parse_draft_models
+from inference.response_cache import ResponseCache, is_deterministic, response_key
+from inference.quantization_modes import handler_quantization
+from inference.router import WORKER_STATUS_EXCHANGE, WORKER_STATUS_INTERVAL_S, worker_queue, worker_status
+from inference.preload import load_preload_manifest, parse_preload_models, parse_token_lengths, preload_handlers
+from inference.documents import DocumentPrefetcher
+from inference.transport import Transport
+from inference.stopping import stops_for
+from inference.cancellation import CANCEL_CHECK_TOKENS, CANCEL_EXCHANGE, CancelListener, CancellationRegistry
+from inference.messages import (
+    DOCUMENT_EXTRACT_TIMEOUT_S, DOCUMENT_FETCH_TIMEOUT_S, DOCUMENT_MAX_BYTES, DOCUMENT_MAX_CHARS, DOCUMENT_WORKERS,
+    MAX_INPUT_TOKENS, compose_prompt, document_cache, document_max_chars, extract_llama3_answer, fit_document,
+    is_image_file, is_vision_handler, needs_chat_handler, parse_input,
+)
+
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "128.16.12.219")
+RABBITMQ_PORT = int(os.environ.get("RABBITMQ_PORT", "5672"))
+RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
+RABBITMQ_PASS = os.environ.get("RABBITMQ_PASS", "guest")
+INPUT_QUEUE = os.environ.get("INPUT_QUEUE", "engineered_prompt")
+OUTPUT_QUEUE = os.environ.get("OUTPUT_QUEUE", "inference_results")
+INFERENCE_DEVICE = os.environ.get("INFERENCE_DEVICE", "hpu")
+
+# Dynamic batching: up to MAX_BATCH_SIZE messages are prefetched and grouped,
+# a partial batch is flushed MAX_BATCH_WAIT_MS after its first message arrived
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MAX_BATCH_WAIT_MS", "50"))
+
+# Messages with "stream": true get partial results at most every STREAM_MIN_INTERVAL_MS
+STREAM_MIN_INTERVAL_MS = float(os.environ.get("STREAM_MIN_INTERVAL_MS", "100"))
+
+# Loaded handlers are evicted least-recently-used first beyond this budget (0 disables it)
+HANDLER_CACHE_MAX_GB = float(os.environ.get("HANDLER_CACHE_MAX_GB", "64"))
+
+# Opt-in cache of results for deterministic requests (do_sample false or a fixed seed),
+# with an optional on-disk tier; 0 entries disables it
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "0"))
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_TTL_S = float(os.environ.get("RESPONSE_CACHE_TTL_S", "86400"))
+
+# Draft models for assisted decoding, as "family=draft_model_path,..." matched against
+# the base model directory name, e.g. "Llama-3=/models/Llama-3.2-1B-Instruct"
+DRAFT_MODELS = parse_draft_models(os.environ.get("DRAFT_MODELS", ""))
+
+# With model routing each worker consumes its own queue, fed by inference.router
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "0").lower() in ("1", "true", "yes")
+WORKER_ID = os.environ.get("WORKER_ID", "0")
+
+# Port of the Prometheus metrics endpoint, 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9400"))
+
+# Models to load and warm up before consuming: a YAML manifest, or "base[=adapter],..."
+PRELOAD_MANIFEST = os.environ.get("PRELOAD_MANIFEST", "")
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "")
+WARMUP_PROMPT_TOKENS = os.environ.get("WARMUP_PROMPT_TOKENS", "32,512")
+WARMUP_MAX_NEW_TOKENS = int(os.environ.get("WARMUP_MAX_NEW_TOKENS", "8"))
+
+def _runtime():
+    """
+    The model runtime. torch, transformers and peft are imported with it, on
+    the first handler build rather than at startup.
+    """
+    from inference import runtime
+    return runtime
+
+def __getattr__(name):
+    """
+    Handlers, model classes and runtime caches stay reachable from this module.
+    They are looked up on inference.runtime at every access, so patch them there.
+    """
+    if name.startswith("__"):
+        raise AttributeError(name)
+    from inference import messages
+    if hasattr(messages, name):
+        return getattr(messages, name)
     try:
-        reader = PdfReader(file_obj)
-        return "\n".join(page.extract_text() for page in reader.pages if page.extract_text())
-    except Exception as e:
-        print(f"PDF extraction failed: {e}")
-        return ""
+        return getattr(_runtime(), name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
 
-def compose_prompt(input_list):
+def queue_latency(item, now):
     """
-    Compose the prompt for the model based on the input conversation history
-    If user has rejected a previous response, build a correction prompt
-    Otherwise, just use the latest user prompt
+    Seconds a message has waited. Producers stamp enqueued_at (unix time), which
+    also covers time spent in the broker; otherwise the wait since delivery is used.
     """
-    # Find all user and assistant turns
-    user_turns = [msg["content"] for msg in input_list if msg["role"] == "user"]
-    assistant_turns = [msg["content"] for msg in input_list if msg["role"] == "assistant"]
-    
-    # Correction case: at least one user, one assistant, and then a user rejection/comment
-    if len(user_turns) >= 2 and len(assistant_turns) >= 1:
-        original_prompt = user_turns[0]
-        rejected_response = assistant_turns[-1]
-        rejection_comment = user_turns[-1]
-        # Compose correction prompt
-        correction_template = (
-            "You are an intelligent assistant being trained to improve your responses based on user corrections. "
-            "A user has rejected your first answer to their prompt. Your task is to analyse their feedback and provide a superior, corrected answer.\n"
-            "1. Original User Prompt: {original}\n"
-            "2. Your Rejected Response: {rejected}\n"
-            "3. User's Feedback and Reason for Rejection: {feedback}\n\n"
-            "Your Instructions:\n"
-            "Analyse why your previous response was inadequate based on the user's feedback. Identify the key mistake or omission.\n"
-            "Then, provide a new, comprehensive response that fixes the identified issue and fully satisfies the user's original prompt.\n\n"
+    enqueued_at = item.message.get("enqueued_at")
+    if isinstance(enqueued_at, (int, float)):
+        return max(0.0, time.time() - enqueued_at)
+    return now - item.received_at
+
+def requested_at(item):
+    """Unix time a request was made: when it was enqueued, or else when it was delivered"""
+    enqueued_at = item.message.get("enqueued_at")
+    if isinstance(enqueued_at, (int, float)):
+        return enqueued_at
+    return time.time() - (time.monotonic() - item.received_at)
+
+def preload_manifest():
+    """Preload entries and default warmup prompt lengths from the environment"""
+    warmup_tokens = parse_token_lengths(WARMUP_PROMPT_TOKENS)
+    entries = []
+    if PRELOAD_MANIFEST:
+        entries, manifest_warmup_tokens = load_preload_manifest(PRELOAD_MANIFEST)
+        if manifest_warmup_tokens is not None:
+            warmup_tokens = manifest_warmup_tokens
+    entries += parse_preload_models(PRELOAD_MODELS)
+    return entries, warmup_tokens
+
+def main():
+    handler_cache = HandlerCache(max_bytes=int(HANDLER_CACHE_MAX_GB * 2**30))
+    metrics = InferenceMetrics(handler_cache)
+    metrics.serve(METRICS_PORT)
+
+    def load_handler(build, model_path, adapter_path=None):
+        """Build a handler, reporting the load time and the peak RSS while loading"""
+        with LoadMemory() as load:
+            handler = build()
+        print(f"Loaded {model_path}, adapter: {adapter_path} in {load.summary()}")
+        metrics.observe_load(model_path, adapter_path, load)
+        return handler
+
+    def handler_key(base_model_path, device, adapter_path=None):
+        return (base_model_path, adapter_path, device)
+
+    def draft_key(draft_model_path, device):
+        return ("draft", draft_model_path, device)
+
+    def get_handler(base_model_path, device, adapter_path=None):
+        key = handler_key(base_model_path, device, adapter_path)
+        misses = handler_cache.misses
+        runtime = _runtime()
+        handler = handler_cache.get(
+            key,
+            lambda: load_handler(
+                lambda: runtime.build_handler(base_model_path, device, adapter_path), base_model_path, adapter_path
+            ),
         )
-        return correction_template.format(
-            original=original_prompt,
-            rejected=rejected_response,
-            feedback=rejection_comment
+        if handler_cache.misses != misses:
+            print(f"Handler cache: {handler_cache.stats()}")
+        return handler
+
+    def get_draft(base_model_path, device):
+        """Draft model for base_model_path's family, kept in the handler cache next to its target"""
+        draft_model_path = draft_model_for(base_model_path, DRAFT_MODELS)
+        if draft_model_path is None or is_vision_handler(base_model_path):
+            return None
+        runtime = _runtime()
+        return handler_cache.get(
+            draft_key(draft_model_path, device),
+            lambda: load_handler(lambda: runtime.DraftHandler(draft_model_path, device), draft_model_path),
         )
-    else:
-        # Send latest user message
-        for msg in reversed(input_list):
-            if msg["role"] == "user":
-                return msg["content"]
-        # Fallback if no user message found
-        return ""
-    
-def extract_llama3_answer(text):
-    if "<|assistant|>" in text:
-        return text.split("<|assistant|>")[-1].strip()
-    return text.strip()
-
-def parse_input(message, is_vision_model=False): 
-    input_list = message.get("input", [])
-    file_path = message.get("file_url", None)
-    prompt_text = compose_prompt(input_list)
-    file_text = None
-
-    if is_vision_model:
-        if not file_path or not is_image_file(file_path):
-            raise ValueError("No image file provided for vision model. Please upload an image with your prompt.")
-        return [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "url": file_path},
-                    {"type": "text", "text": prompt_text}
-                ]
-            }
-        ]
-    elif file_path:
-        try:
-            if file_path.startswith("http"):
-                response = requests.get(file_path)
-                response.raise_for_status()
-                mime = response.headers.get('Content-Type', '')
-                if "pdf" in mime and PdfReader:
-                    file_text = extract_text_from_pdf(BytesIO(response.content))
-                    print(f"Extracted PDF text (url): {file_text[:100]}")
-                elif 'text' in mime:
-                    file_text = response.text
-                    print(f"Extracted text file (url): {file_text[:100]}")
-                else:
-                    print(f"Unhandled mime type (url): {mime}")
-                    file_text = ""
-            else:
-                mime, _ = mimetypes.guess_type(file_path)
-                if mime and "pdf" in mime and PdfReader:
-                    with open(file_path, "rb") as f:
-                        file_text = extract_text_from_pdf(f)
-                elif mime and "text" in mime:
-                    with open(file_path, "r") as f:
-                        file_text = f.read()
-                else:
-                    print(f"Unhandled mime type (local): {mime}")
-                    file_text = ""
-        except Exception as e:
-            print(f"Error reading file {file_path}: {e}")
-            file_text = ""
-        return prompt_text + "\n" + (file_text or "")
-    else:
-        return prompt_text
-
-class PipelineHandler:
-    def __init__(self, base_model_path, device, adapter_path=None):
-        if adapter_path and PeftModel:
-            # Load the base model and then apply the adapter
-            print(f"Loading base model for PEFT: {base_model_path}")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                base_model_path,
-                torch_dtype=torch.bfloat16,
-                device_map=device,
-                trust_remote_code=True,
-                low_cpu_mem_usage=True
-            )
-            # Load the PEFT adapter
-            print(f"Loading PEFT adapter: {adapter_path}")
-            self.model = PeftModel.from_pretrained(
-                self.model,
-                adapter_path,
-                torch_dtype=torch.bfloat16,
-                device_map=device
-            )
-            # Apply the LoRA weight fix
-            self.model = fix_lora_weights(self.model, adapter_path)
-            self.model.eval()
-            
-            self.tokenizer = AutoTokenizer.from_pretrained(base_model_path)
-            self.pipe = None
-        else:
-            self.pipe = hf_pipeline(
-                "text-generation",
-                model=base_model_path,
-                torch_dtype=torch.bfloat16,
-                device_map=device,
-            )
-            self.tokenizer = self.pipe.tokenizer
-            self.model = None
-
-        self.adapter_path = adapter_path
-        self.base_model_path = base_model_path
-        self.device = device
-
-    @property
-    def default_generation_args(self):
-        return {
-            "max_new_tokens": 512,
-            "do_sample": True,
-            "temperature": 0.4,
-            "top_k": 150,
-            "top_p": 0.75,
-        }
 
-    def infer(self, prompt, **generation_args):
-        if not generation_args:
-            generation_args = self.default_generation_args
-            
-        if self.adapter_path and PeftModel and self.model:
-            # For PeftModel, we need to tokenize the prompt first
-            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048, add_special_tokens=False)
-            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-            input_length = inputs["input_ids"].shape[1]
-            
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=generation_args.get("max_new_tokens", 512),
-                    min_new_tokens=generation_args.get("min_new_tokens", 10),
-                    do_sample=generation_args.get("do_sample", True),
-                    temperature=generation_args.get("temperature", 0.7),
-                    top_k=generation_args.get("top_k", 150),
-                    top_p=generation_args.get("top_p", 0.75),
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
-            
-            # Only decode the generated part 
-            generated = self.tokenizer.decode(outputs[0][input_length:], skip_special_tokens=True)
-            return generated.strip()
-        else:
-            # Use pipeline inference for non-PEFT models
-            outputs = self.pipe(prompt, **generation_args)
-            generated = outputs[0]["generated_text"]
-            return generated[len(prompt):] if generated.startswith(prompt) else generated
-
-class ChatHandler:
-    def __init__(self, base_model_path, device, adapter_path=None):
-        self.tokenizer = AutoTokenizer.from_pretrained(base_model_path)
-        if adapter_path and PeftModel:
-            print(f"Loading base model for PEFT chat: {base_model_path}")
-            model = AutoModelForCausalLM.from_pretrained(
-                base_model_path,
-                torch_dtype=torch.bfloat16,
-                device_map=device,
-                trust_remote_code=True
-            )
-            print(f"Loading PEFT adapter for chat: {adapter_path}")
-            model = PeftModel.from_pretrained(
-                model,
-                adapter_path,
-                torch_dtype=torch.bfloat16,
-                device_map=device
-            )
-            # Apply the LoRA weight fix
-            model = fix_lora_weights(model, adapter_path)
-            model.eval()
-
-            self.model = model
-        else:
-            self.model = AutoModelForCausalLM.from_pretrained(
-                base_model_path,
-                torch_dtype=torch.bfloat16,
-                device_map=device,
-            )
-        self.device = device
-        self.adapter_path = adapter_path
-        self.base_model_path = base_model_path
-        
-    @property
-    def default_generation_args(self):
-        return {
-            "max_new_tokens": 512, 
-        }
+    # Models in the preload manifest are loaded and warmed up before connecting,
+    # so no message waits unacked on a cold model
+    preload_entries, warmup_tokens = preload_manifest()
+    if preload_entries:
+        def drop_warmup_prefixes(handler):
+            prefix_cache = _runtime().prefix_cache
+            if prefix_cache is not None and hasattr(handler, "prefix_namespace"):
+                prefix_cache.drop(handler.prefix_namespace)
 
-    def infer(self, prompt, **generation_args):
-        if not generation_args:
-            generation_args = self.default_generation_args
-        eos_token_id = self.tokenizer.eos_token_id
-        generation_args.setdefault("pad_token_id", eos_token_id)
-        generation_args.setdefault("eos_token_id", eos_token_id)
-        if isinstance(prompt, str):
-            prompt = [{"role": "user", "content": prompt}]
-        inputs = self.tokenizer.apply_chat_template(
-            prompt,
-            return_tensors="pt",
-            return_dict=True,
-            add_generation_prompt=True
-        )
-        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-        outputs = self.model.generate(
-            input_ids=inputs["input_ids"],
-            attention_mask=inputs.get("attention_mask"),
-            **generation_args
+        def preload_handler(base_model_path, adapter_path):
+            get_draft(base_model_path, INFERENCE_DEVICE)
+            return get_handler(base_model_path, INFERENCE_DEVICE, adapter_path)
+
+        start = time.monotonic()
+        preload_handlers(
+            preload_entries,
+            preload_handler,
+            default_warmup_tokens=warmup_tokens,
+            max_new_tokens=WARMUP_MAX_NEW_TOKENS,
+            after_warmup=drop_warmup_prefixes,
         )
-        result = self.tokenizer.decode(
-            outputs[0, inputs["input_ids"].shape[1]:],
-            skip_special_tokens=True
+        print(f"Preloaded {len(preload_entries)} model(s) in {time.monotonic() - start:.2f}s")
+
+    def publish(item, response, requeue=True):
+        """
+        Publish a response to item; if the broker rejects it item is requeued
+        instead of acked, unless requeue is False. Returns whether it was taken.
+        """
+        return transport.publish(
+            item.channel, OUTPUT_QUEUE, json.dumps(response),
+            delivery_tag=item.method.delivery_tag if requeue else None,
         )
-        return result
 
-class VisionHandler:
-    def __init__(self, base_model_path, device):
-        self.processor = AutoProcessor.from_pretrained(base_model_path)
-        self.model = AutoModelForVision2Seq.from_pretrained(base_model_path).to(device)
-        self.device = device
+    response_cache = (
+        ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, disk_dir=RESPONSE_CACHE_DIR or None, ttl=RESPONSE_CACHE_TTL_S)
+        if RESPONSE_CACHE_MAX_ENTRIES > 0 else None
+    )
 
-    @property
-    def default_generation_args(self):
-        return {
-            "max_new_tokens": 100,
+    def publish_result(item, result, cached=False, error=None):
+        message = item.message
+        response = {
+            "conversation_id": message.get("conversation_id"),
+            "result": result,
         }
+        if cached:
+            response["cached"] = True
+        if error:
+            response["error"] = error
+        if message.get("stream"):
+            # Streaming clients wait for the done marker
+            response["done"] = True
+        publish(item, response)
 
-    def infer(self, prompt, **generation_args):
-        # prompt is the conversation format (list of dicts)
-        inputs = self.processor.apply_chat_template(
-            prompt,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt"
-        ).to(self.device)
-        output = self.model.generate(**inputs, **generation_args)
-        return self.processor.decode(output[0], skip_special_tokens=True)
+    def stream_publisher(item):
+        from inference.streaming import StreamPublisher
 
-def needs_chat_handler(base_model_path):
-    return "instruct" in base_model_path.lower() or "chat" in base_model_path.lower()
+        return StreamPublisher(
+            lambda response, requeue: publish(item, response, requeue),
+            item.message.get("conversation_id"),
+            restart=getattr(item.method, "redelivered", False) is True,
+        )
 
-def is_vision_handler(base_model_path):
-    return "vision" in base_model_path.lower()
+    def infer_streaming(handler, publisher, item, prompt, generation_args):
+        """Publish partial results for one message, ending with a done marker"""
+        from inference.streaming import ChunkStreamer
 
-def main():
-    # RabbitMQ details
-    rabbitmq_host = "128.16.12.219"
-    rabbitmq_port = 5672
-    rabbitmq_user = "guest"
-    rabbitmq_pass = "guest"
-    input_queue = "engineered_prompt"
-    output_queue = "inference_results"
-
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            host=rabbitmq_host,
-            port=rabbitmq_port,
-            credentials=credentials
+        streamer = ChunkStreamer(
+            handler.tokenizer,
+            publisher.chunk,
+            min_interval=STREAM_MIN_INTERVAL_MS / 1000.0,
+            stop_strings=stops_for(handler.base_model_path, generation_args.get("stop"))[0],
         )
-    )
-    channel = connection.channel()
-    channel.queue_declare(queue=input_queue, durable=True)
-    channel.queue_declare(queue=output_queue, durable=True)
-    channel.basic_qos(prefetch_count=1)
+        result = extract_llama3_answer(handler.infer(prompt, streamer=streamer, **generation_args))
+        print(f"Result: {result!r}")
+        publisher.done(result, error="cancelled" if cancelled(item) else None)
+        return result
 
-    handler_cache = {}
+    cancellations = CancellationRegistry()
 
-    def get_handler(base_model_path, device, adapter_path=None):
-        key = (base_model_path, adapter_path, device)
-        if key not in handler_cache:
-            print(f"Loading model: {base_model_path}, adapter: {adapter_path} on {device}")
-            if is_vision_handler(base_model_path):
-                handler_cache[key] = VisionHandler(base_model_path, device)
-            elif needs_chat_handler(base_model_path):
-                handler_cache[key] = ChatHandler(base_model_path, device, adapter_path)
-            else:
-                handler_cache[key] = PipelineHandler(base_model_path, device, adapter_path)
-        return handler_cache[key]
+    def cancelled(item):
+        return cancellations.cancelled(item.message.get("conversation_id"), requested_at(item))
 
-    def on_message(ch, method, properties, body):
+    def with_cancellation(generation_args, items):
+        """generation_args with a stopping criterion ending the generation of items once cancelled"""
+        if not CANCEL_EXCHANGE:
+            return generation_args
+        checks = [lambda item=item: cancelled(item) for item in items]
+        return dict(generation_args, stopping_criteria=_runtime().cancellation_criteria(checks, CANCEL_CHECK_TOKENS))
+
+    prefetcher = DocumentPrefetcher(
+        max_workers=DOCUMENT_WORKERS,
+        fetch_timeout=DOCUMENT_FETCH_TIMEOUT_S,
+        extract_timeout=DOCUMENT_EXTRACT_TIMEOUT_S,
+        cache=document_cache,
+        max_chars=DOCUMENT_MAX_CHARS,
+        max_bytes=DOCUMENT_MAX_BYTES,
+    )
+
+    def prefetch_document(message):
+        """Vision models read their image themselves; other attachments are read ahead"""
+        base_model_path = message.get("base_model_path")
+        if not isinstance(base_model_path, str) or is_vision_handler(base_model_path):
+            return None
+        # Extract no more than the resident handler of the request can take
+        handler = handler_cache.peek(handler_key(base_model_path, INFERENCE_DEVICE, message.get("adapter_path")))
+        max_chars = None
+        if handler is not None:
+            max_chars = document_max_chars(_runtime().input_budget(handler, message.get("generation_args")))
+        return prefetcher.submit(message.get("file_url"), max_chars)
+
+    def process_group(items):
+        """
+        Serve a group of messages sharing base model and generation args.
+        Messages for different adapters of one base model are batched together.
+        """
+        # Streams started but not yet closed by a done marker
+        open_streams = []
         try:
-            message = json.loads(body)
-            input_list = message["input"]
+            message = items[0].message
             base_model_path = message["base_model_path"]
-            adapter_path = message.get("adapter_path")
-            device = "hpu"
+            device = INFERENCE_DEVICE
+            started = time.monotonic()
 
             if not base_model_path or not isinstance(base_model_path, str):
                 print("Error: base_model_path is None or invalid in message:", message)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                for item in items:
+                    metrics.error("", item.message.get("adapter_path"), "invalid_model")
                 return
-            
-            handler = get_handler(base_model_path, device, adapter_path)
 
-            if is_vision_handler(base_model_path):
+            vision = is_vision_handler(base_model_path)
+
+            def expire(item):
+                """Fail a request whose deadline passed before generation"""
+                print(f"Deadline passed for conversation {item.message.get('conversation_id')}, not generating")
+                metrics.error(base_model_path, item.message.get("adapter_path"), "deadline_exceeded")
+                publish_result(item, "Request expired before it could be processed", error="deadline_exceeded")
+
+            def drop(item):
+                """Skip a request whose conversation was cancelled before generation"""
+                print(f"Conversation {item.message.get('conversation_id')} was cancelled, not generating")
+                metrics.observe_cancelled(base_model_path, item.message.get("adapter_path"), "queued", 0)
+                publish_result(item, "", error="cancelled")
+
+            ready, prompts, file_texts, stage_timings = [], [], [], []
+            for item in items:
+                timings = {"queue": queue_latency(item, started)}
+                if deadline_passed(item.message):
+                    expire(item)
+                    continue
+                if cancelled(item):
+                    drop(item)
+                    continue
+                file_text = None
+                if item.document is not None:
+                    file_text, document_timings = prefetcher.result(item.document)
+                    timings.update(document_timings)
                 try:
-                    parsed_prompt = parse_input(message, is_vision_model=True)
+                    parse_start = time.monotonic()
+                    prompts.append(parse_input(item.message, is_vision_model=vision, file_text=file_text))
+                    timings["parse"] = time.monotonic() - parse_start
+                    ready.append(item)
+                    file_texts.append(file_text)
+                    stage_timings.append(timings)
                 except ValueError as ve:
-                    response = {
-                        "conversation_id": message.get("conversation_id"),
-                        "result": str(ve),
-                    }
-                    ch.basic_publish(
-                        exchange="",
-                        routing_key=output_queue,
-                        body=json.dumps(response),
+                    metrics.error(base_model_path, item.message.get("adapter_path"), "invalid_input")
+                    publish_result(item, str(ve))
+                metrics.observe_stages(
+                    base_model_path, item.message.get("adapter_path"), timings, priority_of(item.message)
+                )
+            if not ready:
+                return
+
+            # Cached deterministic results are published before any model is loaded
+            cache_keys = [None] * len(ready)
+            if response_cache is not None and is_deterministic(message.get("generation_args")):
+                cache_keys = [
+                    response_key(
+                        base_model_path, item.message.get("adapter_path"), prompt, message["generation_args"],
+                        handler_quantization(base_model_path, item.message.get("adapter_path")),
                     )
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    return 
-            else:
-                parsed_prompt = parse_input(message, is_vision_model=False)
-            
-            print("Prompt sent to model:", parsed_prompt) 
-            
+                    for item, prompt in zip(ready, prompts)
+                ]
+                misses = []
+                for index, (item, key) in enumerate(zip(ready, cache_keys)):
+                    cached_result = response_cache.get(key)
+                    if cached_result is None:
+                        misses.append(index)
+                    else:
+                        print(f"Response cache hit for conversation {item.message.get('conversation_id')}")
+                        publish_result(item, cached_result, cached=True)
+                print(f"Response cache: {response_cache.stats()}")
+                ready = [ready[i] for i in misses]
+                prompts = [prompts[i] for i in misses]
+                cache_keys = [cache_keys[i] for i in misses]
+                file_texts = [file_texts[i] for i in misses]
+                stage_timings = [stage_timings[i] for i in misses]
+                if not ready:
+                    return
+
+            handlers = [get_handler(base_model_path, device, item.message.get("adapter_path")) for item in ready]
+
+            # Loading a model can take long enough for deadlines to pass or requests to be cancelled
+            keep = []
+            for index, item in enumerate(ready):
+                if deadline_passed(item.message):
+                    expire(item)
+                elif cancelled(item):
+                    drop(item)
+                else:
+                    keep.append(index)
+            if len(keep) < len(ready):
+                ready = [ready[i] for i in keep]
+                prompts = [prompts[i] for i in keep]
+                cache_keys = [cache_keys[i] for i in keep]
+                file_texts = [file_texts[i] for i in keep]
+                stage_timings = [stage_timings[i] for i in keep]
+                handlers = [handlers[i] for i in keep]
+                if not ready:
+                    return
+            handler = handlers[0]
+            runtime = _runtime()
+            draft = get_draft(base_model_path, device)
+
+            # Fit attachments into the model's token budget now that its tokenizer and context are known
+            if not vision and getattr(handler, "tokenizer", None) is not None:
+                prompts = [
+                    parse_input(
+                        item.message,
+                        file_text=file_text,
+                        tokenizer=handler.tokenizer,
+                        max_tokens=runtime.input_budget(handler, message.get("generation_args")),
+                    ) if item.message.get("file_url") else prompt
+                    for item, prompt, file_text in zip(ready, prompts, file_texts)
+                ]
+
+            for prompt in prompts:
+                print("Prompt sent to model:", prompt)
+
             # Use handler's defaults unless message overrides
-            generation_args = message.get("generation_args", handler.default_generation_args)
-            print(f"Received prompt for model: {base_model_path}")
-            if adapter_path:
-                print(f"Using adapter: {adapter_path}")
-
-            result = handler.infer(parsed_prompt, **generation_args)
-            result = extract_llama3_answer(result)
-            print(f"Result: {result!r}")
-
-            response = {
-                "conversation_id": message.get("conversation_id"),
-                "result": result,
-            }
-            ch.basic_publish(
-                exchange="",
-                routing_key=output_queue,
-                body=json.dumps(response),
-            )
+            generation_args = dict(message.get("generation_args") or handler.default_generation_args)
+            # A fixed seed makes sampling reproducible; each message is then generated on its own
+            seed = generation_args.pop("seed", None)
+            if draft is not None:
+                # Assisted decoding runs one sequence at a time
+                generation_args["assistant_model"] = draft.model
+            print(f"Received {len(ready)} prompt(s) for model: {base_model_path}")
+            adapter_paths = sorted({item.message.get("adapter_path") for item in ready} - {None})
+            if adapter_paths:
+                print(f"Using adapter(s): {', '.join(adapter_paths)}")
+
+            def seeded(infer, *args, **kwargs):
+                if seed is not None:
+                    runtime.transformers.set_seed(seed)
+                return infer(*args, **kwargs)
+
+            def log_stage_latency(generate_seconds):
+                for item, timings in zip(ready, stage_timings):
+                    timings["generate"] = generate_seconds
+                    breakdown = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items())
+                    print(
+                        f"Stage latency for {priority_of(item.message)} conversation "
+                        f"{item.message.get('conversation_id')}: {breakdown}"
+                    )
+
+            def observe_generation(item_handler, item, timer, result):
+                metrics.observe_generation(
+                    base_model_path,
+                    item.message.get("adapter_path"),
+                    timer,
+                    item.received_at,
+                    runtime.count_tokens(item_handler, result),
+                )
+
+            def observe_cancelled(item_handler, item, result):
+                """Record a request cancelled while generating; its tokens so far were wasted"""
+                tokens = runtime.count_tokens(item_handler, result)
+                print(f"Conversation {item.message.get('conversation_id')} was cancelled after {tokens} token(s)")
+                metrics.observe_cancelled(base_model_path, item.message.get("adapter_path"), "generating", tokens)
+
+            start = time.time()
+            if message.get("stream") and not vision:
+                open_streams.extend(stream_publisher(item) for item in ready)
+                for item_handler, item, prompt, key in zip(handlers, ready, prompts, cache_keys):
+                    publisher = open_streams[0]
+                    with GenerationTimer(runtime.generation_model(item_handler)) as timer:
+                        result = seeded(
+                            infer_streaming, item_handler, publisher, item, prompt,
+                            with_cancellation(generation_args, [item]),
+                        )
+                    open_streams.pop(0)
+                    observe_generation(item_handler, item, timer, result)
+                    if cancelled(item):
+                        observe_cancelled(item_handler, item, result)
+                    elif key is not None:
+                        response_cache.put(key, result)
+                print(f"Streamed {len(ready)} result(s) in {time.time() - start:.2f}s")
+                log_stage_latency(time.time() - start)
+                return
+
+            shares_model = all(getattr(h, "model", None) is getattr(handler, "model", None) for h in handlers)
+            if len(ready) > 1 and hasattr(handler, "infer_batch") and shares_model and seed is None and draft is None:
+                batch_kwargs = {}
+                if adapter_paths:
+                    batch_kwargs["adapter_names"] = [h.adapter_name for h in handlers]
+                with GenerationTimer(runtime.generation_model(handler)) as timer:
+                    results = handler.infer_batch(prompts, **batch_kwargs, **with_cancellation(generation_args, ready))
+                timers = [timer] * len(ready)
+            else:
+                results, timers = [], []
+                for h, item, prompt in zip(handlers, ready, prompts):
+                    with GenerationTimer(runtime.generation_model(h)) as timer:
+                        results.append(seeded(h.infer, prompt, **with_cancellation(generation_args, [item])))
+                    timers.append(timer)
+            print(f"Generated batch of {len(ready)} in {time.time() - start:.2f}s")
+            log_stage_latency(time.time() - start)
+            if runtime.prefix_cache is not None:
+                print(f"Prefix cache: {runtime.prefix_cache.stats()}")
+            print(f"Input shapes: {runtime.input_shapes.stats()}")
+
+            for item_handler, item, result, timer, key in zip(handlers, ready, results, timers, cache_keys):
+                result = extract_llama3_answer(result)
+                print(f"Result: {result!r}")
+                observe_generation(item_handler, item, timer, result)
+                if cancelled(item):
+                    observe_cancelled(item_handler, item, result)
+                    publish_result(item, result, error="cancelled")
+                    continue
+                if key is not None:
+                    response_cache.put(key, result)
+                publish_result(item, result)
             print("Result sent to output queue")
         except Exception as e:
+            for item in items:
+                metrics.error(item.message.get("base_model_path"), item.message.get("adapter_path"), type(e).__name__)
             print("Error during inference or message handling:", e)
             import traceback
             traceback.print_exc()
+            # Streaming clients wait for a done marker, also after chunks of a failed generation
+            for publisher in open_streams:
+                publisher.done(publisher.text, error="generation_failed")
         finally:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            # Acked once their results are confirmed, together with other completed requests
+            for ch in {id(item.channel): item.channel for item in items}.values():
+                transport.settle(ch, [item.method.delivery_tag for item in items if item.channel is ch])
+            print(f"Transport: {transport.stats()}")
+
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    parameters = pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=credentials
+    )
+    connection = pika.BlockingConnection(parameters)
+    channel = connection.channel()
+    input_queue = worker_queue(WORKER_ID) if MODEL_ROUTING else INPUT_QUEUE
+    # One queue per priority class, each with its own prefetch window
+    input_queues = [class_queue(input_queue, priority) for priority in PRIORITY_CLASSES]
+    for queue in input_queues:
+        channel.queue_declare(queue=queue, durable=True)
+    channel.queue_declare(queue=OUTPUT_QUEUE, durable=True)
+    # Prefetch enough messages to fill a batch
+    channel.basic_qos(prefetch_count=MAX_BATCH_SIZE)
+    transport = Transport(connection, prefetch_count=MAX_BATCH_SIZE, on_round_trip=metrics.observe_round_trip)
+    transport.open(channel)
+    if MODEL_ROUTING:
+        channel.exchange_declare(exchange=WORKER_STATUS_EXCHANGE, exchange_type="fanout")
+
+    # Messages waiting in the broker, counted with each heartbeat, and the handlers last advertised
+    advertised = {"queued": 0, "handlers": None}
+
+    def resident_handlers():
+        return [key for key, _, _ in handler_cache.entries()]
+
+    def advertise(count_queued=True):
+        """
+        Tell the router which models this worker holds and how much work it has
+        queued. Counting queued messages takes a broker round trip per queue,
+        so between heartbeats the last count is reused.
+        """
+        if not MODEL_ROUTING:
+            return
+        try:
+            if count_queued:
+                advertised["queued"] = sum(
+                    channel.queue_declare(queue=queue, durable=True, passive=True).method.message_count
+                    for queue in input_queues
+                )
+            advertised["handlers"] = set(resident_handlers())
+            status = worker_status(
+                WORKER_ID, input_queue, advertised["handlers"], advertised["queued"] + len(scheduler.pending)
+            )
+            # The router may not be listening yet, so the status is not mandatory
+            transport.publish(channel, "", json.dumps(status), exchange=WORKER_STATUS_EXCHANGE, mandatory=False)
+        except Exception as e:
+            print(f"Failed to advertise worker status: {e}")
+
+    def advertise_periodically():
+        advertise()
+        connection.call_later(WORKER_STATUS_INTERVAL_S, advertise_periodically)
+
+    def group_keys(items):
+        """Cache keys of the handlers and draft model serving items"""
+        keys = set()
+        for item in items:
+            base_model_path = item.message.get("base_model_path")
+            if not isinstance(base_model_path, str):
+                continue
+            keys.add(handler_key(base_model_path, INFERENCE_DEVICE, item.message.get("adapter_path")))
+            draft_model_path = draft_model_for(base_model_path, DRAFT_MODELS)
+            if draft_model_path is not None:
+                keys.add(draft_key(draft_model_path, INFERENCE_DEVICE))
+        return keys
+
+    def process_and_advertise(items):
+        # Loading one adapter of a group must not evict, and detach, another one the group uses
+        with handler_cache.pin(group_keys(items)):
+            process_group(items)
+        # Loads and evictions reach the router without waiting for the next heartbeat
+        if MODEL_ROUTING and set(resident_handlers()) != advertised["handlers"]:
+            advertise(count_queued=False)
+
+    scheduler = BatchScheduler(
+        process_and_advertise,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_BATCH_WAIT_MS / 1000.0,
+        connection=connection,
+        prepare=prefetch_document,
+    )
+
+    def on_message(ch, method, properties, body):
+        try:
+            message = json.loads(body)
+        except Exception as e:
+            metrics.error("", "", "invalid_json")
+            print("Error decoding message:", e)
+            transport.settle(ch, [method.delivery_tag])
+            return
+        transport.delivered(ch, method.delivery_tag)
+        scheduler.submit(ch, method, properties, message)
 
-    channel.basic_consume(queue=input_queue, on_message_callback=on_message)
-    print("Waiting for messages. To exit press CTRL+C")
+    for queue in input_queues:
+        channel.basic_consume(queue=queue, on_message_callback=on_message)
+    if CANCEL_EXCHANGE:
+        CancelListener(cancellations, lambda: pika.BlockingConnection(parameters)).start()
+        print(f"Following cancellations on {CANCEL_EXCHANGE}")
+    if MODEL_ROUTING:
+        advertise_periodically()
+        print(f"Worker {WORKER_ID} consuming routed requests from {input_queue}")
+    print(f"Waiting for messages (max batch size {MAX_BATCH_SIZE}, max wait {MAX_BATCH_WAIT_MS}ms). To exit press CTRL+C")
     channel.start_consuming()
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+"""
+Memory-bounded LRU cache of inference handlers.
+
+Each handler's footprint is estimated from the parameters and buffers of its
+model, counting weights shared between handlers once. When the total exceeds
+``max_bytes`` the least recently used handlers are dropped and the device
+allocator is asked to release their memory, so a new model costs a reload of
+an old one rather than an out-of-memory crash. Handlers a batch is using are
+pinned and only evicted once it is done.
+"""
+import gc
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+
+def handler_models(handler):
+    """All torch modules held by a handler"""
+    # Handlers only exist once the model runtime, and with it torch, is imported
+    import torch
+
+    models = []
+    model = getattr(handler, "model", None)
+    if model is None and getattr(handler, "pipe", None) is not None:
+        model = getattr(handler.pipe, "model", None)
+    if isinstance(model, torch.nn.Module):
+        models.append(model)
+    return models
+
+
+def estimate_handlers_bytes(handlers):
+    """
+    Bytes held by the given handlers. Tensors shared between handlers, such as
+    a base model serving several adapters, are counted once.
+    """
+    seen = set()
+    total = 0
+    for handler in handlers:
+        for model in handler_models(handler):
+            for tensor in list(model.parameters()) + list(model.buffers()):
+                key = (tensor.device, tensor.data_ptr())
+                if key in seen:
+                    continue
+                seen.add(key)
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def estimate_handler_bytes(handler):
+    return estimate_handlers_bytes([handler])
+
+
+def release_device_memory():
+    import torch
+
+    gc.collect()
+    hpu = getattr(torch, "hpu", None)
+    if hpu is not None and hasattr(hpu, "empty_cache"):
+        try:
+            hpu.empty_cache()
+        except Exception as e:
+            print(f"Failed to empty HPU cache: {e}")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def is_out_of_memory(error):
+    """Whether error is an allocation failure, on the host, CUDA or HPU (a RuntimeError saying so)"""
+    import torch
+
+    cuda_oom = getattr(torch.cuda, "OutOfMemoryError", ())
+    return isinstance(error, (MemoryError, cuda_oom)) or "out of memory" in str(error).lower()
+
+
+class HandlerCache:
+    def __init__(self, max_bytes=0, estimate=estimate_handlers_bytes):
+        """
+        max_bytes <= 0 disables the memory bound.
+        estimate returns the bytes held by a list of handlers.
+        """
+        self.max_bytes = max_bytes
+        self.estimate = estimate
+        self._entries = OrderedDict()  # key -> (handler, size in bytes when loaded)
+        self._pinned = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entries(self):
+        """Snapshot of (key, handler, size in bytes when loaded), least recently used first"""
+        return [(key, handler, size) for key, (handler, size) in list(self._entries.items())]
+
+    @property
+    def total_bytes(self):
+        return self.estimate([handler for handler, _ in self._entries.values()])
+
+    def peek(self, key):
+        """The cached handler for key, or None, without counting a lookup or refreshing its position"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def get(self, key, factory):
+        """Return the cached handler for key, building it with factory() on a miss"""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+        self.misses += 1
+        try:
+            handler = factory()
+        except Exception as e:
+            evictable = [k for k in self._entries if k not in self._pinned]
+            if not is_out_of_memory(e) or not evictable:
+                raise
+            print(f"Out of memory while loading {key}, evicting all unpinned cached handlers and retrying")
+            for k in evictable:
+                self.evict(k)
+            handler = factory()
+
+        size = self.estimate([handler])
+        self._entries[key] = (handler, size)
+        self._evict_to_budget(keep=key)
+        return handler
+
+    @contextmanager
+    def pin(self, keys):
+        """
+        Keep the handlers of keys, cached already or loaded within the block,
+        from being evicted until the block exits.
+        """
+        keys = list(keys)
+        self._pinned.update(keys)
+        try:
+            yield
+        finally:
+            self._pinned.subtract(keys)
+            self._pinned += Counter()  # drops keys no longer pinned
+            self._evict_to_budget()
+
+    def _evict_to_budget(self, keep=None):
+        if self.max_bytes <= 0:
+            return
+        while self.total_bytes > self.max_bytes:
+            victim = next((k for k in self._entries if k != keep and k not in self._pinned), None)
+            if victim is None:
+                print(f"Pinned handlers exceed the cache budget of {self.max_bytes} bytes")
+                return
+            self.evict(victim)
+
+    def evict(self, key):
+        handler, size = self._entries.pop(key)
+        self.evictions += 1
+        print(f"Evicting handler {key} ({size / 2**30:.2f} GiB)")
+        if hasattr(handler, "release"):
+            try:
+                handler.release()
+            except Exception as e:
+                print(f"Failed to release handler {key}: {e}")
+        del handler
+        release_device_memory()
+
+    def clear(self):
+        for key in list(self._entries):
+            self.evict(key)
+
+    def stats(self):
+        return {
+            "handlers": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,166 @@
+"""
+In-memory stand-in for a pika ``BlockingConnection``.
+
+Implements the subset of the connection and channel API the consumers use
+(queue and exchange declarations, prefetch, publish confirms, publish,
+consume, ack and ``call_later``/``remove_timeout`` timers) so a consumer's ``main()`` can run in-process without
+a RabbitMQ broker, e.g. to benchmark startup or the message path. Patch it
+over ``pika.BlockingConnection``; ``start_consuming`` delivers queued
+messages and fires timers until nothing is queued or unacknowledged, or
+until a given condition holds.
+"""
+import heapq
+import itertools
+import time
+from collections import deque
+from types import SimpleNamespace
+
+
+class LocalChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.queues = {}
+        # exchange -> bound queue names; only fanout exchanges are modelled
+        self.exchanges = {}
+        self.consumers = {}
+        self.unacked = {}
+        self.prefetch_count = 0
+        self.delivery_tags = itertools.count(1)
+        self.consuming = False
+        self.confirming = False
+
+    def queue(self, name):
+        return self.queues.setdefault(name, deque())
+
+    def queue_declare(self, queue="", durable=False, passive=False, exclusive=False, **kwargs):
+        name = queue or f"amq.gen-{len(self.queues)}"
+        return SimpleNamespace(method=SimpleNamespace(queue=name, message_count=len(self.queue(name))))
+
+    def exchange_declare(self, exchange, exchange_type="direct", **kwargs):
+        self.exchanges.setdefault(exchange, set())
+
+    def queue_bind(self, exchange, queue, routing_key=None, **kwargs):
+        self.exchanges.setdefault(exchange, set()).add(queue)
+
+    def confirm_delivery(self):
+        # Publishes are never rejected, so confirms are always positive
+        self.confirming = True
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        self.consumers[queue] = (on_message_callback, auto_ack)
+        self.queue(queue)
+        return queue
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        if self.connection.on_publish is not None:
+            self.connection.on_publish(exchange, routing_key, body, properties)
+        targets = self.exchanges.get(exchange, ()) if exchange else (routing_key,)
+        for name in targets:
+            self.queue(name).append((body, properties))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            for tag in [t for t in self.unacked if t <= delivery_tag]:
+                del self.unacked[tag]
+        else:
+            self.unacked.pop(delivery_tag, None)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        tags = [t for t in self.unacked if t <= delivery_tag] if multiple else [delivery_tag]
+        for tag in tags:
+            queue, body, properties = self.unacked.pop(tag)
+            if requeue:
+                self.queue(queue).appendleft((body, properties))
+
+    def pending(self):
+        """Messages waiting on consumed queues"""
+        return sum(len(self.queues[queue]) for queue in self.consumers)
+
+    def deliver(self):
+        """Deliver as many queued messages as the prefetch window allows, returns the number delivered"""
+        delivered = 0
+        for queue, (callback, auto_ack) in list(self.consumers.items()):
+            messages = self.queues[queue]
+            while messages and (auto_ack or not self.prefetch_count or len(self.unacked) < self.prefetch_count):
+                body, properties = messages.popleft()
+                tag = next(self.delivery_tags)
+                if not auto_ack:
+                    self.unacked[tag] = (queue, body, properties)
+                callback(self, SimpleNamespace(delivery_tag=tag, routing_key=queue), properties, body)
+                delivered += 1
+        return delivered
+
+    def start_consuming(self):
+        self.consuming = True
+        self.connection.ready_at = time.time()
+        if self.connection.on_ready is not None:
+            self.connection.on_ready(self)
+        self.connection.run()
+        self.consuming = False
+
+    def stop_consuming(self):
+        self.consuming = False
+
+
+class LocalConnection:
+    def __init__(self, *args, on_ready=None, on_publish=None, until=None, **kwargs):
+        """
+        on_ready(channel) is called when the consumer starts consuming and
+        on_publish(exchange, routing_key, body, properties) on every publish.
+        Consuming stops once until() is true, by default once the connection is idle.
+        """
+        self.on_ready = on_ready
+        self.on_publish = on_publish
+        self.until = until or self.idle
+        self.ready_at = None
+        self.channels = []
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.is_open = True
+
+    def channel(self):
+        channel = LocalChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def call_later(self, delay, callback):
+        """Run callback after delay seconds; returns the handle remove_timeout takes"""
+        timer_id = next(self.timer_ids)
+        heapq.heappush(self.timers, (time.monotonic() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timer_id):
+        self.timers = [timer for timer in self.timers if timer[1] != timer_id]
+        heapq.heapify(self.timers)
+
+    def process_data_events(self, time_limit=0):
+        self._fire_due_timers()
+        for channel in self.channels:
+            channel.deliver()
+
+    def _fire_due_timers(self):
+        fired = 0
+        while self.timers and self.timers[0][0] <= time.monotonic():
+            _, _, callback = heapq.heappop(self.timers)
+            callback()
+            fired += 1
+        return fired
+
+    def idle(self):
+        return not any(channel.pending() or channel.unacked for channel in self.channels)
+
+    def run(self):
+        """Deliver messages and fire timers until the stop condition holds"""
+        while any(channel.consuming for channel in self.channels) and not self.until():
+            if self._fire_due_timers() or sum(channel.deliver() for channel in self.channels):
+                continue
+            if not self.timers:
+                # With nothing left to deliver or run the condition can never become true
+                break
+            time.sleep(max(0.0, self.timers[0][0] - time.monotonic()))
+
+    def close(self):
+        self.is_open = False
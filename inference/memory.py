@@ -0,0 +1,80 @@
+"""
+Host memory accounting for model loads.
+
+``LoadMemory`` records the peak resident set size of the process while a
+model loads, by resetting the kernel's high-water mark (``VmHWM``) before the
+load and reading it afterwards. Resident memory is also split into anonymous
+pages, which are private to the process, and file-backed pages, which
+memory-mapped weights occupy and which are shared through the page cache with
+every other process mapping the same shards. Outside Linux nothing is
+measured.
+"""
+import time
+
+STATUS_FIELDS = {"VmRSS": "rss", "VmHWM": "peak_rss", "RssAnon": "anon", "RssFile": "file"}
+
+
+def process_memory():
+    """Resident memory of this process in bytes by kind, {} where /proc is unavailable"""
+    memory = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in STATUS_FIELDS:
+                    memory[STATUS_FIELDS[key]] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+def reset_peak_rss():
+    """Restart the VmHWM high-water mark from the current RSS, returns False if the kernel refused"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def format_bytes(n):
+    return f"{n / 2**30:.2f} GB"
+
+
+class LoadMemory:
+    """
+    Context manager measuring one load. Afterwards ``peak_rss`` is the
+    highest RSS during the load (over the whole process lifetime when the
+    high-water mark could not be reset), ``start`` and ``end`` are
+    process_memory() snapshots and ``seconds`` is the load time.
+    """
+    def __init__(self):
+        self.start = {}
+        self.end = {}
+        self.peak_rss = None
+        self.peak_is_lifetime = False
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.peak_is_lifetime = not reset_peak_rss()
+        self.start = process_memory()
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.monotonic() - self.started
+        self.end = process_memory()
+        self.peak_rss = self.end.get("peak_rss")
+        return False
+
+    def summary(self):
+        if self.peak_rss is None:
+            return f"{self.seconds:.2f}s"
+        peak = "peak RSS over process lifetime" if self.peak_is_lifetime else "peak RSS"
+        return (
+            f"{self.seconds:.2f}s, {peak} {format_bytes(self.peak_rss)} "
+            f"(+{format_bytes(self.peak_rss - self.start.get('rss', 0))}), "
+            f"now {format_bytes(self.end.get('anon', 0))} private, "
+            f"{format_bytes(self.end.get('file', 0))} file-backed"
+        )
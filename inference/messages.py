@@ -0,0 +1,157 @@
+"""
+Request messages: prompt composition, attachment text and handler selection.
+
+Nothing here needs torch or transformers, so the consumer can receive and
+parse messages before the model runtime (``inference.runtime``) is imported.
+"""
+import mimetypes
+import os
+
+from inference.documents import DocumentTextCache, read_document
+
+# file_url attachments are fetched and extracted on DOCUMENT_WORKERS threads ahead of generation.
+# Downloads are abandoned after DOCUMENT_FETCH_TIMEOUT_S in total or beyond DOCUMENT_MAX_MB, and
+# extraction after DOCUMENT_EXTRACT_TIMEOUT_S, so slow documents give their worker back.
+DOCUMENT_WORKERS = int(os.environ.get("DOCUMENT_WORKERS", "4"))
+DOCUMENT_FETCH_TIMEOUT_S = float(os.environ.get("DOCUMENT_FETCH_TIMEOUT_S", "10"))
+DOCUMENT_EXTRACT_TIMEOUT_S = float(os.environ.get("DOCUMENT_EXTRACT_TIMEOUT_S", "30"))
+DOCUMENT_MAX_MB = float(os.environ.get("DOCUMENT_MAX_MB", "50"))
+DOCUMENT_MAX_BYTES = int(DOCUMENT_MAX_MB * 2**20) if DOCUMENT_MAX_MB > 0 else None
+
+# Extracted attachment text is cached by content hash (and URL validators),
+# in memory and, when DOCUMENT_CACHE_DIR is set, on disk up to DOCUMENT_CACHE_MAX_MB
+DOCUMENT_CACHE_ENTRIES = int(os.environ.get("DOCUMENT_CACHE_ENTRIES", "256"))
+DOCUMENT_CACHE_DIR = os.environ.get("DOCUMENT_CACHE_DIR", "")
+DOCUMENT_CACHE_MAX_MB = float(os.environ.get("DOCUMENT_CACHE_MAX_MB", "1024"))
+
+# Prompt token budget: each handler's model context, less the tokens to generate and those
+# its chat template adds, and at most MAX_INPUT_TOKENS when that is set (0 uses the context).
+# Attachments are trimmed so the instruction always fits, and extraction stops after about
+# DOCUMENT_CHARS_PER_TOKEN characters per budget token.
+MAX_INPUT_TOKENS = int(os.environ.get("MAX_INPUT_TOKENS", "0"))
+DOCUMENT_CHARS_PER_TOKEN = float(os.environ.get("DOCUMENT_CHARS_PER_TOKEN", "6"))
+
+def document_max_chars(max_tokens=None):
+    """Characters worth extracting for a budget of max_tokens, by default MAX_INPUT_TOKENS; None for no cap"""
+    max_tokens = max_tokens or MAX_INPUT_TOKENS
+    return int(max_tokens * DOCUMENT_CHARS_PER_TOKEN) if max_tokens > 0 else None
+
+DOCUMENT_MAX_CHARS = document_max_chars()
+
+document_cache = (
+    DocumentTextCache(
+        max_entries=DOCUMENT_CACHE_ENTRIES,
+        disk_dir=DOCUMENT_CACHE_DIR or None,
+        max_disk_bytes=int(DOCUMENT_CACHE_MAX_MB * 2**20),
+    )
+    if DOCUMENT_CACHE_ENTRIES > 0 else None
+)
+
+def is_image_file(filepath):
+    mime, _ = mimetypes.guess_type(filepath)
+    return mime is not None and mime.startswith("image")
+
+def compose_prompt(input_list):
+    """
+    Compose the prompt for the model based on the input conversation history
+    If user has rejected a previous response, build a correction prompt
+    Otherwise, just use the latest user prompt
+    """
+    # Find all user and assistant turns
+    user_turns = [msg["content"] for msg in input_list if msg["role"] == "user"]
+    assistant_turns = [msg["content"] for msg in input_list if msg["role"] == "assistant"]
+    
+    # Correction case: at least one user, one assistant, and then a user rejection/comment
+    if len(user_turns) >= 2 and len(assistant_turns) >= 1:
+        original_prompt = user_turns[0]
+        rejected_response = assistant_turns[-1]
+        rejection_comment = user_turns[-1]
+        # Compose correction prompt
+        correction_template = (
+            "You are an intelligent assistant being trained to improve your responses based on user corrections. "
+            "A user has rejected your first answer to their prompt. Your task is to analyse their feedback and provide a superior, corrected answer.\n"
+            "1. Original User Prompt: {original}\n"
+            "2. Your Rejected Response: {rejected}\n"
+            "3. User's Feedback and Reason for Rejection: {feedback}\n\n"
+            "Your Instructions:\n"
+            "Analyse why your previous response was inadequate based on the user's feedback. Identify the key mistake or omission.\n"
+            "Then, provide a new, comprehensive response that fixes the identified issue and fully satisfies the user's original prompt.\n\n"
+        )
+        return correction_template.format(
+            original=original_prompt,
+            rejected=rejected_response,
+            feedback=rejection_comment
+        )
+    else:
+        # Send latest user message
+        for msg in reversed(input_list):
+            if msg["role"] == "user":
+                return msg["content"]
+        # Fallback if no user message found
+        return ""
+    
+def extract_llama3_answer(text):
+    if "<|assistant|>" in text:
+        return text.split("<|assistant|>")[-1].strip()
+    return text.strip()
+
+def fit_document(prompt_text, file_text, tokenizer=None, max_tokens=None):
+    """
+    Append attachment text to the prompt. With a tokenizer and budget, the
+    attachment is cut so that prompt and attachment together fit max_tokens;
+    the prompt itself is never cut.
+    """
+    if tokenizer is None or not max_tokens or not file_text:
+        return prompt_text + "\n" + (file_text or "")
+    prompt_text = prompt_text + "\n"
+    remaining = max_tokens - len(tokenizer(prompt_text, add_special_tokens=False)["input_ids"])
+    if remaining <= 0:
+        print("Prompt fills the token budget, attachment dropped")
+        return prompt_text
+    file_ids = tokenizer(file_text, add_special_tokens=False)["input_ids"]
+    if len(file_ids) > remaining:
+        print(f"Attachment trimmed from {len(file_ids)} to {remaining} tokens")
+        file_text = tokenizer.decode(file_ids[:remaining], skip_special_tokens=True)
+    return prompt_text + file_text
+
+def parse_input(message, is_vision_model=False, file_text=None, tokenizer=None, max_tokens=None):
+    """
+    Build the model input for a message. file_text is the attachment's
+    already extracted text; when None the attachment is read here.
+    With a tokenizer, the attachment is fitted into max_tokens.
+    """
+    input_list = message.get("input", [])
+    file_path = message.get("file_url", None)
+    prompt_text = compose_prompt(input_list)
+
+    if is_vision_model:
+        if not file_path or not is_image_file(file_path):
+            raise ValueError("No image file provided for vision model. Please upload an image with your prompt.")
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "url": file_path},
+                    {"type": "text", "text": prompt_text}
+                ]
+            }
+        ]
+    elif file_path:
+        if file_text is None:
+            file_text, _ = read_document(
+                file_path,
+                fetch_timeout=DOCUMENT_FETCH_TIMEOUT_S,
+                cache=document_cache,
+                max_chars=document_max_chars(max_tokens),
+                extract_timeout=DOCUMENT_EXTRACT_TIMEOUT_S,
+                max_bytes=DOCUMENT_MAX_BYTES,
+            )
+        return fit_document(prompt_text, file_text, tokenizer, max_tokens)
+    else:
+        return prompt_text
+
+def needs_chat_handler(base_model_path):
+    return "instruct" in base_model_path.lower() or "chat" in base_model_path.lower()
+
+def is_vision_handler(base_model_path):
+    return "vision" in base_model_path.lower()
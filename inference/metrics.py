@@ -0,0 +1,262 @@
+"""
+Prometheus metrics for the inference consumer.
+
+Per-request latencies are recorded as histograms labelled by model and
+adapter: queue wait, input preparation (document fetch, text extraction,
+prompt parsing), tokenization, time to first token, generation time and
+tokens per second. Errors are counted by type, cancelled requests by the
+stage they were stopped in along with the tokens generated for them. Model
+loads record their duration and the peak RSS of the process while loading,
+and confirmed publishes their broker round trip. Loaded handlers and their
+memory, and the hits, misses and evictions of the handler cache and the
+prompt prefix cache, are read from the caches at scrape time. The metrics are
+served over HTTP by ``InferenceMetrics.serve``; without prometheus_client
+every method is a no-op.
+"""
+import sys
+import time
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    CollectorRegistry = None
+
+LABELS = ("model", "adapter")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+LOAD_BUCKETS = (1, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+ROUND_TRIP_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+# Stage timings recorded by the consumer, grouped by histogram
+INPUT_STAGES = ("fetch", "extract", "wait", "parse")
+
+
+class GenerationTimer:
+    """
+    Time a generate() call through forward hooks on the model: the first
+    forward pass starts once inputs are tokenized and ends with the first token.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.start = None
+        self.first_forward_start = None
+        self.first_forward_end = None
+        self.end = None
+        self._hooks = []
+
+    def _pre_forward(self, module, args):
+        if self.first_forward_start is None:
+            self.first_forward_start = time.monotonic()
+
+    def _forward(self, module, args, output):
+        if self.first_forward_end is None:
+            self.first_forward_end = time.monotonic()
+
+    def __enter__(self):
+        if self.model is not None:
+            self._hooks = [
+                self.model.register_forward_pre_hook(self._pre_forward),
+                self.model.register_forward_hook(self._forward),
+            ]
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.monotonic()
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        return False
+
+    @property
+    def tokenization(self):
+        return self.first_forward_start - self.start if self.first_forward_start else None
+
+    @property
+    def generation(self):
+        return self.end - self.start
+
+
+class HandlerCacheCollector:
+    def __init__(self, handler_cache):
+        self.handler_cache = handler_cache
+
+    def collect(self):
+        loaded = GaugeMetricFamily("llmedic_loaded_handlers", "Handlers held in the handler cache", labels=LABELS)
+        memory = GaugeMetricFamily(
+            "llmedic_handler_memory_bytes",
+            "Estimated model memory of each cached handler when it was loaded",
+            labels=LABELS,
+        )
+        for key, handler, size in self.handler_cache.entries():
+            labels = handler_labels(handler, key)
+            loaded.add_metric(labels, 1)
+            memory.add_metric(labels, size)
+        yield loaded
+        yield memory
+        yield GaugeMetricFamily(
+            "llmedic_handler_cache_bytes",
+            "Estimated memory of all cached handlers, counting shared weights once",
+            value=self.handler_cache.total_bytes,
+        )
+        lookups = CounterMetricFamily(
+            "llmedic_handler_cache_lookups", "Handler cache lookups by result", labels=("result",)
+        )
+        lookups.add_metric(["hit"], self.handler_cache.hits)
+        lookups.add_metric(["miss"], self.handler_cache.misses)
+        yield lookups
+        yield CounterMetricFamily(
+            "llmedic_handler_cache_evictions", "Handlers evicted from the handler cache",
+            value=self.handler_cache.evictions,
+        )
+
+
+def runtime_prefix_cache():
+    """The runtime's prefix cache once the runtime is loaded; a scrape never imports it"""
+    runtime = sys.modules.get("inference.runtime")
+    return getattr(runtime, "prefix_cache", None)
+
+
+class PrefixCacheCollector:
+    def __init__(self, prefix_cache=runtime_prefix_cache):
+        """prefix_cache returns the PrefixCache to report, or None while there is none"""
+        self.prefix_cache = prefix_cache
+
+    def collect(self):
+        cache = self.prefix_cache()
+        if cache is None:
+            return
+        lookups = CounterMetricFamily(
+            "llmedic_prefix_cache_lookups", "Prompt prefix cache lookups by result", labels=("result",)
+        )
+        lookups.add_metric(["hit"], cache.hits)
+        lookups.add_metric(["miss"], cache.lookups - cache.hits)
+        yield lookups
+        yield CounterMetricFamily(
+            "llmedic_prefix_cache_prompt_tokens", "Prompt tokens looked up in the prefix cache",
+            value=cache.prompt_tokens,
+        )
+        yield CounterMetricFamily(
+            "llmedic_prefix_cache_reused_tokens", "Prompt tokens whose KV was reused from the prefix cache",
+            value=cache.reused_tokens,
+        )
+        yield GaugeMetricFamily("llmedic_prefix_cache_entries", "Prompts held in the prefix cache", value=len(cache))
+        yield GaugeMetricFamily(
+            "llmedic_prefix_cache_bytes", "KV memory held by the prefix cache", value=cache.total_bytes
+        )
+
+
+def handler_labels(handler, key=None):
+    model = getattr(handler, "base_model_path", None) or (key[0] if key else "")
+    return [str(model), str(getattr(handler, "adapter_path", None) or "")]
+
+
+class InferenceMetrics:
+    def __init__(self, handler_cache=None, registry=None):
+        self.enabled = CollectorRegistry is not None
+        if not self.enabled:
+            print("prometheus_client not installed, metrics are disabled")
+            return
+        self.registry = registry if registry is not None else CollectorRegistry()
+
+        def histogram(name, documentation, buckets=LATENCY_BUCKETS, extra_labels=()):
+            return Histogram(name, documentation, LABELS + extra_labels, buckets=buckets, registry=self.registry)
+
+        self.queue_wait = histogram(
+            "llmedic_queue_wait_seconds", "Time from enqueueing to processing", extra_labels=("priority",)
+        )
+        self.input_preparation = histogram(
+            "llmedic_input_preparation_seconds",
+            "Document fetch, text extraction, prefetch wait and prompt parsing time",
+            extra_labels=("stage",),
+        )
+        self.tokenization = histogram("llmedic_tokenization_seconds", "Time from generate call to first forward pass")
+        self.time_to_first_token = histogram(
+            "llmedic_time_to_first_token_seconds", "Time from message arrival to the first generated token"
+        )
+        self.generation = histogram("llmedic_generation_seconds", "Total generation time per request")
+        self.tokens_per_second = histogram(
+            "llmedic_generation_tokens_per_second", "Generated tokens per second per request", buckets=RATE_BUCKETS
+        )
+        self.load_seconds = histogram(
+            "llmedic_model_load_seconds", "Time to build a handler, including weight loading", buckets=LOAD_BUCKETS
+        )
+        self.load_peak_rss = Gauge(
+            "llmedic_model_load_peak_rss_bytes", "Peak process RSS during the last load of a handler", LABELS,
+            registry=self.registry,
+        )
+        self.cancelled = Counter(
+            "llmedic_cancelled_requests", "Requests of cancelled conversations by the stage they were stopped in",
+            LABELS + ("stage",), registry=self.registry,
+        )
+        self.cancelled_tokens = Counter(
+            "llmedic_cancelled_wasted_tokens", "Tokens generated for requests that were then cancelled",
+            LABELS, registry=self.registry,
+        )
+        self.broker_round_trip = Histogram(
+            "llmedic_broker_round_trip_seconds", "Time for the broker to confirm a published message",
+            buckets=ROUND_TRIP_BUCKETS, registry=self.registry,
+        )
+        self.errors = Counter("llmedic_errors", "Failed requests by error type", LABELS + ("type",), registry=self.registry)
+        if handler_cache is not None:
+            self.registry.register(HandlerCacheCollector(handler_cache))
+        self.registry.register(PrefixCacheCollector())
+
+    def serve(self, port):
+        if not self.enabled or not port:
+            return
+        try:
+            start_http_server(port, registry=self.registry)
+            print(f"Serving metrics on port {port}")
+        except OSError as e:
+            print(f"Failed to serve metrics on port {port}: {e}")
+
+    def observe_stages(self, model, adapter, timings, priority=""):
+        """Record the queue and input preparation entries of a request's stage timings"""
+        if not self.enabled:
+            return
+        labels = (model or "", adapter or "")
+        if "queue" in timings:
+            self.queue_wait.labels(*labels, priority).observe(timings["queue"])
+        for stage in INPUT_STAGES:
+            if stage in timings:
+                self.input_preparation.labels(*labels, stage).observe(timings[stage])
+
+    def observe_generation(self, model, adapter, timer, received_at, new_tokens):
+        """Record tokenization, time to first token, generation time and tokens/sec of one request"""
+        if not self.enabled:
+            return
+        labels = (model or "", adapter or "")
+        if timer.tokenization is not None:
+            self.tokenization.labels(*labels).observe(timer.tokenization)
+        if timer.first_forward_end is not None:
+            self.time_to_first_token.labels(*labels).observe(timer.first_forward_end - received_at)
+        self.generation.labels(*labels).observe(timer.generation)
+        if timer.generation > 0:
+            self.tokens_per_second.labels(*labels).observe(new_tokens / timer.generation)
+
+    def observe_load(self, model, adapter, load):
+        """Record a handler load measured by inference.memory.LoadMemory"""
+        if not self.enabled:
+            return
+        labels = (model or "", adapter or "")
+        self.load_seconds.labels(*labels).observe(load.seconds)
+        if load.peak_rss is not None:
+            self.load_peak_rss.labels(*labels).set(load.peak_rss)
+
+    def observe_cancelled(self, model, adapter, stage, wasted_tokens):
+        if not self.enabled:
+            return
+        labels = (model or "", adapter or "")
+        self.cancelled.labels(*labels, stage).inc()
+        self.cancelled_tokens.labels(*labels).inc(wasted_tokens)
+
+    def observe_round_trip(self, seconds):
+        if self.enabled:
+            self.broker_round_trip.observe(seconds)
+
+    def error(self, model, adapter, error_type):
+        if self.enabled:
+            self.errors.labels(model or "", adapter or "", error_type).inc()
@@ -0,0 +1,293 @@
+"""
+Offline batch inference over a prompt file, without RabbitMQ.
+
+Runs an evaluation set through the same handlers as the inference consumer
+(``inference.runtime``) in large batches and writes one JSON line per record
+to the output file as each batch finishes:
+
+    python -m inference.offline_batch prompts.jsonl --model /models/Llama-3-8B-Instruct \\
+        --output results.jsonl --batch-size 32 --generation-args '{"max_new_tokens": 256}'
+
+The input is read as a stream and may be JSONL, a JSON array, or JSON objects
+concatenated with blank lines in between (as in ``concode/data/inference-prompts``).
+A record is either a consumer message (``"input"`` as a list of turns, with an
+optional ``file_url``) or an object with the prompt text under ``"input"``,
+``"prompt"`` or ``"text"``. Records are read ``--sort-window`` at a time and
+sorted by prompt length, so each batch pads to similar lengths. Output lines
+carry the record's ``index`` in the input; ``--resume`` skips the records the
+output file already has and ``--offset`` skips the first records of the input.
+
+Offline runs never touch the broker. Point them at a card no worker uses
+(``HABANA_VISIBLE_DEVICES``/``CUDA_VISIBLE_DEVICES``), and on a shared host the
+process lowers its CPU priority (``--nice``) so live workers keep theirs.
+"""
+import argparse
+import json
+import os
+import time
+
+from inference.memory import LoadMemory
+from inference.messages import extract_llama3_answer, is_vision_handler, parse_input
+
+# Fields copied from the input record to its output line
+PASSTHROUGH_FIELDS = ("conversation_id", "id")
+PROMPT_FIELDS = ("input", "prompt", "text")
+
+
+def iter_records(f, chunk_size=1 << 16):
+    """
+    JSON values of a stream of JSONL, a top-level JSON array, or concatenated
+    JSON documents, decoded one at a time without reading the whole file
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    in_array = None
+
+    def fill():
+        nonlocal buffer, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+    while True:
+        # Skip whitespace and, inside an array, the separators between elements
+        position = 0
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (in_array and buffer[position] == ",")):
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer, position = "", 0
+            fill()
+        buffer = buffer[position:]
+        if not buffer:
+            return
+        if in_array is None:
+            in_array = buffer[0] == "["
+            if in_array:
+                buffer = buffer[1:]
+                continue
+        if in_array and buffer[0] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        if end == len(buffer) and not eof and isinstance(value, (int, float)):
+            # A number may continue in the next chunk
+            fill()
+            continue
+        buffer = buffer[end:]
+        yield value
+
+
+def record_message(record):
+    """Consumer-style message for an input record"""
+    if isinstance(record, str):
+        return {"input": [{"role": "user", "content": record}]}
+    if not isinstance(record, dict):
+        raise ValueError(f"Record is a {type(record).__name__}, not a prompt or an object")
+    if isinstance(record.get("input"), list):
+        return record
+    for field in PROMPT_FIELDS:
+        if isinstance(record.get(field), str):
+            message = {"input": [{"role": "user", "content": record[field]}]}
+            if record.get("file_url"):
+                message["file_url"] = record["file_url"]
+            return message
+    raise ValueError(f"Record has no prompt under {', '.join(PROMPT_FIELDS)}")
+
+
+def completed_indices(output_path):
+    """
+    Indices already written to output_path. A partly written last line, left
+    by an interrupted run, is cut off so appending starts on a fresh line.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    done = set()
+    for line in data.splitlines():
+        try:
+            done.add(json.loads(line)["index"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
+
+
+def sorted_batches(items, batch_size, window, length):
+    """Batches of items, sorted by length() within each window of consecutive items"""
+    pending = []
+
+    def drain():
+        pending.sort(key=length)
+        for start in range(0, len(pending), batch_size):
+            yield pending[start:start + batch_size]
+        pending.clear()
+
+    for item in items:
+        pending.append(item)
+        if len(pending) >= window:
+            yield from drain()
+    yield from drain()
+
+
+class ThroughputReport:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.records = 0
+        self.errors = 0
+        self.batches = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "records": self.records,
+            "errors": self.errors,
+            "batches": self.batches,
+            "elapsed_seconds": round(elapsed, 3),
+            "generation_seconds": round(self.generation_seconds, 3),
+            "records_per_second": round(self.records / elapsed, 3) if elapsed else 0.0,
+            "generated_tokens_per_second": round(self.generated_tokens / self.generation_seconds, 3)
+            if self.generation_seconds else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+        }
+
+
+def run(args):
+    if is_vision_handler(args.model):
+        raise SystemExit("Vision models are not supported by offline batches")
+    generation_args = json.loads(args.generation_args) if args.generation_args else None
+
+    from inference import runtime
+
+    with LoadMemory() as load:
+        handler = runtime.build_handler(args.model, args.device, args.adapter)
+    print(f"Loaded {args.model}, adapter: {args.adapter} in {load.summary()}")
+    if generation_args is None:
+        generation_args = dict(handler.default_generation_args)
+
+    done = completed_indices(args.output) if args.resume else set()
+    if done:
+        print(f"Resuming, {len(done)} record(s) already in {args.output}")
+    report = ThroughputReport()
+
+    def prepared(records):
+        """(index, record, prompt, prompt tokens) of the records still to run"""
+        for index, record in enumerate(records):
+            if index < args.offset or index in done:
+                continue
+            try:
+                prompt = parse_input(
+                    record_message(record),
+                    tokenizer=handler.tokenizer,
+                    max_tokens=runtime.input_budget(handler, generation_args),
+                )
+            except ValueError as e:
+                yield index, record, None, str(e)
+                continue
+            yield index, record, prompt, runtime.count_tokens(handler, prompt)
+
+    def output_line(index, record, **fields):
+        line = {"index": index}
+        if isinstance(record, dict):
+            line.update({k: record[k] for k in PASSTHROUGH_FIELDS if k in record})
+            if "output" in record:
+                line["reference"] = record["output"]
+        line.update(fields)
+        return json.dumps(line) + "\n"
+
+    def generate(prompts):
+        try:
+            return handler.infer_batch(prompts, **dict(generation_args)), [None] * len(prompts)
+        except Exception as e:
+            if len(prompts) == 1:
+                return [None], [f"{type(e).__name__}: {e}"]
+            print(f"Batch of {len(prompts)} failed ({e}), running its records one by one")
+            results, errors = [], []
+            for prompt in prompts:
+                result, error = generate([prompt])
+                results += result
+                errors += error
+            return results, errors
+
+    with open(args.input) as source, open(args.output, "a") as sink:
+        def runnable():
+            """Prepared records; the ones that failed to parse are written straight away"""
+            for index, record, prompt, extra in prepared(iter_records(source)):
+                if prompt is None:
+                    sink.write(output_line(index, record, error=extra))
+                    report.records += 1
+                    report.errors += 1
+                else:
+                    yield index, record, prompt, extra
+
+        for batch in sorted_batches(runnable(), args.batch_size, args.sort_window, length=lambda item: item[3]):
+            start = time.monotonic()
+            results, errors = generate([prompt for _, _, prompt, _ in batch])
+            report.generation_seconds += time.monotonic() - start
+            report.batches += 1
+            for (index, record, _, prompt_tokens), result, error in zip(batch, results, errors):
+                report.records += 1
+                report.prompt_tokens += prompt_tokens
+                if error is not None:
+                    report.errors += 1
+                    sink.write(output_line(index, record, error=error))
+                    continue
+                result = extract_llama3_answer(result)
+                report.generated_tokens += runtime.count_tokens(handler, result)
+                sink.write(output_line(index, record, result=result))
+            sink.flush()
+            if report.batches % args.report_every == 0:
+                print(f"Progress: {json.dumps(report.summary())}")
+
+    summary = report.summary()
+    print(json.dumps(summary))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline batch inference over a JSONL/JSON prompt file")
+    parser.add_argument("input", help="JSONL, JSON array or concatenated JSON prompt file")
+    parser.add_argument("--model", required=True, help="base model path")
+    parser.add_argument("--adapter", default=None, help="LoRA adapter path")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--device", default=os.environ.get("INFERENCE_DEVICE", "hpu"))
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--sort-window", type=int, default=1024, help="records read ahead and sorted by length")
+    parser.add_argument("--generation-args", default=None, help="JSON generation arguments, handler defaults if unset")
+    parser.add_argument("--offset", type=int, default=0, help="skip the first records of the input")
+    parser.add_argument("--resume", action="store_true", help="skip records already in the output file")
+    parser.add_argument("--report", default=None, help="also write the throughput report to this file")
+    parser.add_argument("--report-every", type=int, default=10, help="batches between progress reports")
+    parser.add_argument("--nice", type=int, default=10, help="CPU niceness increment, 0 keeps the priority")
+    args = parser.parse_args(argv)
+    args.sort_window = max(args.sort_window, args.batch_size)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.nice > 0 and hasattr(os, "nice"):
+        os.nice(args.nice)
+    return run(args)
+
+
+if __name__ == "__main__":
+    main()
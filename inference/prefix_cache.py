@@ -0,0 +1,152 @@
+"""
+Shared-prefix KV cache for single-sequence generation.
+
+Prompts built from the few-shot, chain-of-thought and correction templates
+start with the same long preamble. After a prompt has been prefilled its key
+and value tensors are kept, keyed by the prompt's token ids, per model and
+adapter namespace. A later prompt reuses a copy of the cache cropped to the
+longest common token prefix, so generate() only prefills the remaining
+suffix. Padding (masked positions) never counts towards a match, so prompts
+sharing only their padding are not hits. Entries are evicted
+least-recently-used first beyond ``max_bytes``.
+"""
+import copy
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+
+def cache_bytes(cache):
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in list(cache.key_cache) + list(cache.value_cache)
+    )
+
+
+def unpadded_ids(input_ids, attention_mask=None):
+    """input_ids on the host with masked positions replaced by -1, and their number"""
+    input_ids = input_ids.detach().cpu()
+    if attention_mask is None:
+        return input_ids, 0
+    masked = attention_mask.detach().cpu() == 0
+    return input_ids.masked_fill(masked, -1), int(masked.sum())
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class PrefixCache:
+    def __init__(self, max_bytes, min_prefix_tokens=32):
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries = OrderedDict()  # (namespace, token ids) -> (ids tensor, cache, bytes)
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return sum(size for _, _, size in self._entries.values())
+
+    def lookup(self, namespace, input_ids, attention_mask=None):
+        """
+        Return a private cache covering the longest cached prefix of input_ids
+        and its length, or (None, 0). At least one token is always left for
+        generate() to prefill. Prompts match on their attended tokens: the
+        prefix must hold min_prefix_tokens besides padding, with the padding
+        at the same positions.
+        """
+        input_ids, padding = unpadded_ids(input_ids, attention_mask)
+        self.lookups += 1
+        self.prompt_tokens += len(input_ids) - padding
+
+        best_key, best_length, reused = self._best_match(namespace, input_ids)
+        if best_key is None:
+            return None, 0
+
+        self._entries.move_to_end(best_key)
+        cache = copy.deepcopy(self._entries[best_key][1])
+        cache.crop(best_length)
+        self.hits += 1
+        self.reused_tokens += reused
+        return cache, best_length
+
+    def match_length(self, namespace, input_ids, attention_mask=None):
+        """Length of the prefix lookup() would reuse, without counting a lookup"""
+        return self._best_match(namespace, unpadded_ids(input_ids, attention_mask)[0])[1]
+
+    def _best_match(self, namespace, input_ids):
+        """Key, length and attended tokens of the longest usable cached prefix, or (None, 0, 0)"""
+        best_key, best_length = None, 0
+        for key, (ids, _, _) in self._entries.items():
+            if key[0] != namespace:
+                continue
+            length = min(common_prefix_length(ids, input_ids), len(input_ids) - 1)
+            if length > best_length:
+                best_key, best_length = key, length
+
+        reused = best_length - int((input_ids[:best_length] == -1).sum())
+        if best_key is None or reused < self.min_prefix_tokens:
+            return None, 0, 0
+        return best_key, best_length, reused
+
+    def store(self, namespace, input_ids, cache, attention_mask=None):
+        """Keep the prompt part of a cache that generate() has just filled"""
+        input_ids, padding = unpadded_ids(input_ids, attention_mask)
+        if len(input_ids) - padding < self.min_prefix_tokens or cache.get_seq_length() < len(input_ids):
+            return
+        key = (namespace, tuple(input_ids.tolist()))
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        cache.crop(len(input_ids))
+        size = cache_bytes(cache)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (input_ids, cache, size)
+        while self.total_bytes > self.max_bytes:
+            self._entries.popitem(last=False)
+
+    def drop(self, namespace):
+        for key in [k for k in self._entries if k[0] == namespace]:
+            del self._entries[key]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "reused_token_ratio": self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
+
+
+def generate_with_prefix_cache(model, prefix_cache, namespace, inputs, **generate_kwargs):
+    """
+    generate() that reuses and then records prompt KV in prefix_cache.
+    Falls back to a plain generate() for batches or when the cache is disabled.
+    """
+    input_ids = inputs["input_ids"]
+    if prefix_cache is None or input_ids.shape[0] != 1 or "past_key_values" in generate_kwargs:
+        return model.generate(**inputs, **generate_kwargs)
+
+    attention_mask = inputs.get("attention_mask")
+    attention_mask = None if attention_mask is None else attention_mask[0]
+    cache, _ = prefix_cache.lookup(namespace, input_ids[0], attention_mask)
+    if cache is None:
+        cache = DynamicCache()
+    with torch.no_grad():
+        outputs = model.generate(**inputs, past_key_values=cache, **generate_kwargs)
+    # Beam search and multiple return sequences reshape the cache; only plain runs are kept
+    if cache.key_cache and cache.key_cache[0].shape[0] == 1:
+        prefix_cache.store(namespace, input_ids[0], cache, attention_mask)
+    return outputs
@@ -0,0 +1,128 @@
+"""
+Startup preloading and warmup of inference handlers.
+
+The manifest lists the models to build before the service starts consuming.
+It is either a YAML file (``PRELOAD_MANIFEST``)::
+
+    warmup_tokens: [32, 512]
+    models:
+      - base_model_path: /models/Llama-3.2-3B-Instruct
+      - base_model_path: /models/Llama-3.2-3B-Instruct
+        adapter_path: /models/adapters/cardiology
+        warmup_tokens: [1024]
+
+or a comma separated list (``PRELOAD_MODELS``) of ``base_model_path`` or
+``base_model_path=adapter_path`` entries. Each handler is built and then run
+once per warmup prompt length so that device placement and graph compilation
+happen before the first request.
+"""
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+WARMUP_WORDS = "the patient is a summary and the patient"
+
+
+@dataclass
+class PreloadEntry:
+    base_model_path: str
+    adapter_path: Optional[str] = None
+    warmup_tokens: Optional[List[int]] = None
+
+
+def parse_token_lengths(value):
+    if value is None or value == "":
+        return []
+    if isinstance(value, int):
+        return [value]
+    if isinstance(value, str):
+        value = value.split(",")
+    return [int(v) for v in value if str(v).strip()]
+
+
+def parse_preload_models(spec):
+    """Entries from a "base[=adapter],..." string"""
+    entries = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        base_model_path, _, adapter_path = item.partition("=")
+        entries.append(PreloadEntry(base_model_path.strip(), adapter_path.strip() or None))
+    return entries
+
+
+def load_preload_manifest(path):
+    """Entries and default warmup lengths from a YAML manifest"""
+    import yaml
+
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = yaml.safe_load(f) or {}
+    if isinstance(manifest, list):
+        manifest = {"models": manifest}
+
+    entries = []
+    for model in manifest.get("models") or []:
+        if isinstance(model, str):
+            model = {"base_model_path": model}
+        if not model.get("base_model_path"):
+            raise ValueError(f"Preload manifest entry without base_model_path: {model}")
+        entries.append(PreloadEntry(
+            model["base_model_path"],
+            model.get("adapter_path") or None,
+            parse_token_lengths(model["warmup_tokens"]) if "warmup_tokens" in model else None,
+        ))
+    warmup_tokens = parse_token_lengths(manifest["warmup_tokens"]) if "warmup_tokens" in manifest else None
+    return entries, warmup_tokens
+
+
+def warmup_prompt(tokenizer, n_tokens):
+    """A prompt of about n_tokens tokens for the given tokenizer"""
+    words = WARMUP_WORDS.split()
+    text = " ".join(words[i % len(words)] for i in range(n_tokens))
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"][:n_tokens]
+    return tokenizer.decode(ids, skip_special_tokens=True)
+
+
+def warmup_handler(handler, warmup_tokens, max_new_tokens=8):
+    """Run one short greedy generation per prompt length; returns seconds per length"""
+    timings = {}
+    tokenizer = getattr(handler, "tokenizer", None)
+    if tokenizer is None or not hasattr(handler, "infer_batch"):
+        # Vision handlers need an image in every request; they are loaded but not run
+        return timings
+    for n_tokens in warmup_tokens:
+        prompt = warmup_prompt(tokenizer, n_tokens)
+        start = time.monotonic()
+        handler.infer(prompt, max_new_tokens=max_new_tokens, min_new_tokens=1, do_sample=False)
+        timings[n_tokens] = time.monotonic() - start
+    return timings
+
+
+def preload_handlers(entries, get_handler, default_warmup_tokens=(), max_new_tokens=8, after_warmup=None):
+    """
+    Build and warm up the handler of every entry in order. A failing entry is
+    reported and skipped so the service can still start. Returns one report
+    dict per entry.
+    """
+    reports = []
+    for entry in entries:
+        name = entry.base_model_path + (f" + {entry.adapter_path}" if entry.adapter_path else "")
+        report = {"base_model_path": entry.base_model_path, "adapter_path": entry.adapter_path}
+        try:
+            start = time.monotonic()
+            handler = get_handler(entry.base_model_path, entry.adapter_path)
+            report["load_seconds"] = time.monotonic() - start
+
+            warmup_tokens = entry.warmup_tokens if entry.warmup_tokens is not None else list(default_warmup_tokens)
+            report["warmup_seconds"] = warmup_handler(handler, warmup_tokens, max_new_tokens)
+            if after_warmup is not None:
+                after_warmup(handler)
+
+            warmup = ", ".join(f"{n} tokens={s:.2f}s" for n, s in report["warmup_seconds"].items()) or "skipped"
+            print(f"Preloaded {name}: load={report['load_seconds']:.2f}s, warmup: {warmup}")
+        except Exception as e:
+            report["error"] = str(e)
+            print(f"Failed to preload {name}: {e}")
+        reports.append(report)
+    return reports
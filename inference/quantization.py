@@ -0,0 +1,233 @@
+"""
+Weight-only quantization of the linear layers of loaded models.
+
+Weights are stored as int8 (one scale per output channel), int4 (one scale
+per group of ``QUANTIZATION_GROUP_SIZE`` input channels, two weights per
+byte) or fp8 e4m3 (one scale per output channel, where the device can hold
+float8 tensors), while activations stay in the model's dtype. A model takes
+about a half (int8, fp8) or a quarter (int4) of its bf16 memory, so more
+models fit on a card. Layers multiply through PyTorch's fused weight-only
+kernels (int8 and int4 on CPU; probed with ``fused_kernel_supported``).
+Quantizing only saves memory with such a kernel, so ``quantize_model`` refuses
+a mode the device has none for, including fp8, which has no fused kernel
+anywhere, and loads the model unquantized with a warning; int4 layers whose
+shape the kernel does not take are likewise kept unquantized. A
+QuantizedLinear built directly without a fused kernel dequantizes its weight
+in every forward pass and keeps no copy, which is slow but enough to measure
+accuracy. ``lm_head`` is kept as is, since it is often tied to the input
+embeddings and is the layer most sensitive to rounding.
+
+The mode of each model is configured in ``inference.quantization_modes``.
+Use ``python -m inference.quantization_check`` to compare a mode's outputs
+with the unquantized model before enabling it.
+"""
+import functools
+import os
+
+import torch
+import torch.nn.functional as F
+
+from inference.quantization_modes import (
+    QUANTIZATION_MODES,
+    normalize_mode,
+    parse_quantize_models,
+    quantization_for,
+)
+
+QUANTIZATION_GROUP_SIZE = int(os.environ.get("QUANTIZATION_GROUP_SIZE", "128"))
+QUANTIZATION_SKIP = ("lm_head",)
+# Group sizes the fused CPU int4 kernel accepts; it also needs a multiple of 16 output channels
+INT4_FUSED_GROUP_SIZES = (32, 64, 128, 256)
+
+FP8_DTYPE = getattr(torch, "float8_e4m3fn", None)
+FP8_MAX = 448.0
+
+
+def fp8_supported(device):
+    if FP8_DTYPE is None:
+        return False
+    try:
+        torch.zeros(1, device=device).to(FP8_DTYPE)
+        return True
+    except (RuntimeError, TypeError):
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def fused_kernel_supported(mode, device_type):
+    """Whether PyTorch's fused weight-only matmul for mode runs on device_type"""
+    device = torch.device(device_type)
+    x = torch.ones(1, 32, dtype=torch.bfloat16, device=device)
+    try:
+        if mode == "int8":
+            weight = torch.ones(8, 32, dtype=torch.int8, device=device)
+            torch._weight_int8pack_mm(x, weight, torch.ones(8, dtype=torch.bfloat16, device=device))
+        elif mode == "int4":
+            weight = torch._convert_weight_to_int4pack_for_cpu(torch.zeros(16, 32, dtype=torch.int32, device=device), 1)
+            scales = torch.ones(1, 16, 2, dtype=torch.bfloat16, device=device)
+            torch._weight_int4pack_mm_for_cpu(x, weight, 32, scales)
+        else:
+            return False
+    except (AttributeError, NotImplementedError, RuntimeError, TypeError):
+        return False
+    return True
+
+
+class QuantizedLinear(torch.nn.Module):
+    """
+    Drop-in replacement of an nn.Linear holding quantized weights. The weights
+    are quantized where linear is and stored on device, by default there too.
+    """
+
+    def __init__(self, linear, mode, group_size=QUANTIZATION_GROUP_SIZE, device=None):
+        super().__init__()
+        weight = linear.weight.detach()
+        device = weight.device if device is None else torch.device(device)
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.mode = mode
+        self.group_size = group_size
+        self.fused = False
+        self.bias = None if linear.bias is None else torch.nn.Parameter(linear.bias.detach(), requires_grad=False)
+        device_type = device.type
+        dtype = weight.dtype
+        weight = weight.float()
+
+        if mode == "int8":
+            scale = (weight.abs().amax(dim=1) / 127).clamp(min=1e-8)
+            self.register_buffer("qweight", (weight / scale[:, None]).round().clamp(-127, 127).to(torch.int8))
+            self.register_buffer("scale", scale.to(dtype))
+            self.fused = fused_kernel_supported("int8", device_type)
+        elif mode == "int4":
+            padding = -self.in_features % group_size
+            groups = weight.shape[1] + padding
+            weight = F.pad(weight, (0, padding)).reshape(self.out_features, groups // group_size, group_size)
+            scale = (weight.abs().amax(dim=2) / 7).clamp(min=1e-8)
+            # Stored offset by 8: 0..15 stands for -8..7 times the group's scale
+            q = ((weight / scale[..., None]).round().clamp(-8, 7) + 8).to(torch.uint8).reshape(self.out_features, -1)
+            self.fused = int4_fusable(linear, group_size) and fused_kernel_supported("int4", device_type)
+            if self.fused:
+                self.register_buffer("qweight", torch._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 1))
+                # The fused kernel takes (scale, zero) per group and output channel; the offset is built in
+                scales_and_zeros = torch.stack([scale.t(), torch.zeros_like(scale.t())], dim=-1)
+                self.register_buffer("scale", scales_and_zeros.to(dtype).contiguous())
+            else:
+                self.register_buffer("qweight", q[:, 0::2] | (q[:, 1::2] << 4))
+                self.register_buffer("scale", scale.to(dtype))
+        elif mode == "fp8":
+            if not fp8_supported(device):
+                raise ValueError(f"fp8 weights are not supported on {device}")
+            scale = (weight.abs().amax(dim=1) / FP8_MAX).clamp(min=1e-12)
+            self.register_buffer("qweight", (weight / scale[:, None]).to(FP8_DTYPE))
+            self.register_buffer("scale", scale.to(dtype))
+        else:
+            raise ValueError(f"Unknown quantization mode {mode!r}")
+        self.to(device)
+
+    @property
+    def weight_dtype(self):
+        return self.scale.dtype
+
+    def dequantize(self, block_size=256):
+        """The weight in the model's dtype"""
+        dtype = self.weight_dtype
+        if self.mode == "int4":
+            if self.fused:
+                # The packed layout is only read by the kernel: multiply blocks of the identity through it
+                blocks = []
+                for start in range(0, self.in_features, block_size):
+                    rows = min(block_size, self.in_features - start)
+                    identity = torch.zeros(rows, self.in_features, dtype=dtype, device=self.qweight.device)
+                    identity[torch.arange(rows), torch.arange(start, start + rows)] = 1
+                    blocks.append(
+                        torch._weight_int4pack_mm_for_cpu(identity, self.qweight, self.group_size, self.scale)
+                    )
+                return torch.cat(blocks).t()
+            q = torch.stack([self.qweight & 0xF, self.qweight >> 4], dim=-1).reshape(self.out_features, -1)
+            weight = (q.to(dtype) - 8).reshape(self.out_features, -1, self.group_size) * self.scale[..., None]
+            return weight.reshape(self.out_features, -1)[:, :self.in_features]
+        return self.qweight.to(dtype) * self.scale[:, None]
+
+    def forward(self, x):
+        dtype = x.dtype
+        x = x.to(self.weight_dtype)
+        if not self.fused:
+            # Dequantized for this pass only, so no full-precision copy stays resident
+            return F.linear(x, self.dequantize(), self.bias).to(dtype)
+        shape = x.shape
+        x = x.reshape(-1, self.in_features).contiguous()
+        if self.mode == "int8":
+            out = torch._weight_int8pack_mm(x, self.qweight, self.scale)
+        else:
+            out = torch._weight_int4pack_mm_for_cpu(x, self.qweight, self.group_size, self.scale)
+        out = out.reshape(*shape[:-1], self.out_features)
+        return (out if self.bias is None else out + self.bias).to(dtype)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}"
+
+
+def module_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def int4_fusable(linear, group_size=QUANTIZATION_GROUP_SIZE):
+    """Whether the fused int4 kernel takes linear's shape with groups of group_size"""
+    return (
+        group_size in INT4_FUSED_GROUP_SIZES and linear.in_features % group_size == 0
+        and linear.out_features % 16 == 0
+    )
+
+
+def quantized_mode(model):
+    """The mode of model's quantized layers, or None if it has none"""
+    for module in model.modules():
+        if isinstance(module, QuantizedLinear):
+            return module.mode
+    return None
+
+
+def quantize_model(model, mode, group_size=QUANTIZATION_GROUP_SIZE, skip=QUANTIZATION_SKIP, device=None):
+    """
+    Replace model's linear layers, except those named in skip, by quantized ones.
+    Layers are converted one at a time, so memory never holds two copies of the model.
+    With device, a model loaded on the host is moved there as it is quantized,
+    each layer's quantized weights on their own, so the device never holds the
+    unquantized weights. Only layers a fused kernel of the device multiplies
+    are quantized; without one the model is left unquantized. Returns the model.
+    """
+    mode = normalize_mode(mode)
+    if mode is None:
+        return model if device is None else model.to(device)
+    device_type = torch.device(device).type if device is not None else next(model.parameters()).device.type
+    if not fused_kernel_supported(mode, device_type):
+        print(
+            f"Warning: no fused {mode} kernel on {device_type}; loading the model unquantized, "
+            f"since {mode} weights would be dequantized for every forward pass there"
+        )
+        return model if device is None else model.to(device)
+    before = module_bytes(model)
+    converted = kept = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child) is not torch.nn.Linear or child_name in skip:
+                continue
+            if mode == "int4" and not int4_fusable(child, group_size):
+                kept += 1
+                continue
+            setattr(module, child_name, QuantizedLinear(child, mode, group_size, device=device))
+            converted += 1
+    if device is not None:
+        # Embeddings, norms and the layers kept unquantized
+        model.to(device)
+    after = module_bytes(model)
+    print(
+        f"Quantized {converted} linear layers to {mode}: "
+        f"{before / 2**30:.2f} GiB -> {after / 2**30:.2f} GiB"
+    )
+    if kept:
+        print(
+            f"Warning: kept {kept} linear layer(s) unquantized: the fused int4 kernel needs groups of "
+            f"{', '.join(map(str, INT4_FUSED_GROUP_SIZES))} dividing the input and a multiple of 16 outputs"
+        )
+    return model
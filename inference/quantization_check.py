@@ -0,0 +1,202 @@
+"""
+Quality check of weight-only quantization against the unquantized model.
+
+Loads a model unquantized and then in each quantization mode, runs a
+reference prompt set through each with greedy decoding, and compares:
+
+- ``exact_match``: share of prompts whose output is identical
+- ``prefix_agreement``: share of the reference output's tokens generated
+  identically before the first difference
+- ``top1_agreement`` and ``kl_divergence``: with the reference output fed to
+  both models (teacher forcing), how often their most likely next token
+  agrees and the mean KL divergence of the quantized model's next-token
+  distribution from the reference's
+
+along with model memory, once loaded and while generating, and generation
+throughput:
+
+    python -m inference.quantization_check --model /models/Llama3-Med42-8B \\
+        --modes int8,int4 --device cpu --output report.json
+
+Prompts are read with the offline batch reader (``--prompts``, JSONL, a JSON
+array or concatenated JSON), by default ``DEFAULT_PROMPTS``. With
+``--min-top1`` the command fails when a mode's top-1 agreement is below it.
+Only one model is loaded at a time.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from inference.memory import LoadMemory
+from inference.messages import is_vision_handler, parse_input
+from inference.offline_batch import iter_records, record_message
+
+DEFAULT_PROMPTS = [
+    "What are the first-line treatments for community-acquired pneumonia in adults?",
+    "Summarise the key symptoms of diabetic ketoacidosis.",
+    "A 64-year-old man presents with crushing chest pain radiating to the left arm. What is the differential diagnosis?",
+    "Explain the mechanism of action of metformin.",
+    "List the contraindications for thrombolysis in acute ischaemic stroke.",
+    "What monitoring is required for a patient started on lithium?",
+    "Describe the stages of chronic kidney disease.",
+    "How is sepsis defined and what are the initial management steps?",
+]
+
+
+def load_prompts(path=None):
+    """Consumer-style messages of the prompt file, or of DEFAULT_PROMPTS"""
+    if not path:
+        return [record_message(prompt) for prompt in DEFAULT_PROMPTS]
+    with open(path) as f:
+        return [record_message(record) for record in iter_records(f)]
+
+
+def prefix_agreement(reference_ids, ids):
+    """Share of reference_ids that ids reproduces before the first difference"""
+    if not reference_ids:
+        return 1.0
+    matched = 0
+    for expected, actual in zip(reference_ids, ids):
+        if expected != actual:
+            break
+        matched += 1
+    return matched / len(reference_ids)
+
+
+def completion_log_probs(handler, prompt, completion):
+    """Next-token log probabilities over completion, given prompt, as a float32 CPU tensor"""
+    import torch
+    from inference import runtime
+
+    tokenizer = handler.tokenizer
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    completion_ids = tokenizer(completion, add_special_tokens=False)["input_ids"]
+    if not completion_ids:
+        return None
+    model = runtime.generation_model(handler)
+    input_ids = torch.tensor([prompt_ids + completion_ids], device=model.device)
+    with torch.no_grad():
+        logits = model(input_ids=input_ids).logits[0, len(prompt_ids) - 1:-1]
+    return torch.log_softmax(logits.float(), dim=-1).cpu()
+
+
+def compare(reference_log_probs, log_probs):
+    """(tokens, top-1 agreements, summed KL divergence) of two teacher-forced runs"""
+    import torch
+
+    if reference_log_probs is None or log_probs is None:
+        return 0, 0, 0.0
+    agreements = (reference_log_probs.argmax(-1) == log_probs.argmax(-1)).sum().item()
+    kl = torch.nn.functional.kl_div(log_probs, reference_log_probs, log_target=True, reduction="sum").item()
+    return reference_log_probs.shape[0], agreements, kl
+
+
+def run_mode(model_path, device, mode, messages, generation_args, batch_size):
+    """Outputs, teacher-forcing inputs and load/throughput figures of one quantization mode"""
+    from inference import runtime
+    from inference.handler_cache import release_device_memory
+    from inference.quantization import module_bytes
+
+    with LoadMemory() as load:
+        handler = runtime.build_handler(model_path, device, quantization=mode)
+    print(f"Loaded {model_path} ({mode}) in {load.summary()}")
+    model_bytes = module_bytes(runtime.generation_model(handler))
+    texts = [
+        parse_input(message, tokenizer=handler.tokenizer, max_tokens=runtime.input_budget(handler, generation_args))
+        for message in messages
+    ]
+    start = time.monotonic()
+    results = []
+    for offset in range(0, len(texts), batch_size):
+        results += handler.infer_batch(texts[offset:offset + batch_size], **dict(generation_args))
+    seconds = time.monotonic() - start
+    token_ids = [handler.tokenizer(result, add_special_tokens=False)["input_ids"] for result in results]
+    stats = {
+        # None when the device has no fused kernel for the mode and the model was loaded unquantized
+        "quantized": getattr(handler, "quantization", None),
+        "model_bytes": model_bytes,
+        "generating_bytes": module_bytes(runtime.generation_model(handler)),
+        "load_seconds": load.seconds,
+        "generation_seconds": seconds,
+        "tokens_per_second": sum(len(ids) for ids in token_ids) / seconds if seconds > 0 else 0.0,
+    }
+    return handler, texts, results, token_ids, stats, release_device_memory
+
+
+def run(args):
+    if is_vision_handler(args.model):
+        raise SystemExit("Vision models are not supported by the quantization check")
+    from inference.quantization import normalize_mode
+
+    modes = [normalize_mode(mode) for mode in args.modes.split(",") if mode.strip()]
+    prompts = load_prompts(args.prompts)
+    generation_args = {"max_new_tokens": args.max_new_tokens, "do_sample": False}
+
+    handler, texts, reference, reference_ids, reference_stats, release = run_mode(
+        args.model, args.device, "none", prompts, generation_args, args.batch_size
+    )
+    reference_log_probs = [completion_log_probs(handler, text, result) for text, result in zip(texts, reference)]
+    del handler
+    release()
+
+    report = {"model": args.model, "prompts": len(prompts), "reference": reference_stats, "modes": {}}
+    for mode in modes:
+        handler, texts, results, token_ids, stats, release = run_mode(
+            args.model, args.device, mode, prompts, generation_args, args.batch_size
+        )
+        tokens = agreements = 0
+        kl = 0.0
+        for text, expected, log_probs in zip(texts, reference, reference_log_probs):
+            counts = compare(log_probs, completion_log_probs(handler, text, expected))
+            tokens, agreements, kl = tokens + counts[0], agreements + counts[1], kl + counts[2]
+        del handler
+        release()
+        stats.update(
+            exact_match=sum(a == b for a, b in zip(reference, results)) / len(prompts),
+            prefix_agreement=sum(map(prefix_agreement, reference_ids, token_ids)) / len(prompts),
+            top1_agreement=agreements / tokens if tokens else 1.0,
+            kl_divergence=kl / tokens if tokens else 0.0,
+            memory_ratio=stats["model_bytes"] / reference_stats["model_bytes"],
+            generating_memory_ratio=stats["generating_bytes"] / reference_stats["generating_bytes"],
+        )
+        if args.show_outputs:
+            stats["outputs"] = [{"reference": a, "quantized": b} for a, b in zip(reference, results)]
+        report["modes"][mode] = stats
+        print(f"{mode}: {json.dumps({k: v for k, v in stats.items() if k != 'outputs'})}")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare quantized model outputs with the unquantized model")
+    parser.add_argument("--model", required=True, help="base model path")
+    parser.add_argument("--modes", default="int8,int4", help="comma-separated quantization modes to check")
+    parser.add_argument("--prompts", default=None, help="JSONL/JSON prompt file, built-in prompts if unset")
+    parser.add_argument("--device", default=os.environ.get("INFERENCE_DEVICE", "cpu"))
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--output", default=None, help="also write the JSON report here")
+    parser.add_argument("--show-outputs", action="store_true", help="include every output pair in the report")
+    parser.add_argument("--min-top1", type=float, default=None, help="fail if a mode's top-1 agreement is lower")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    if args.min_top1 is not None:
+        failing = [mode for mode, stats in report["modes"].items() if stats["top1_agreement"] < args.min_top1]
+        if failing:
+            print(f"Top-1 agreement below {args.min_top1} for: {', '.join(failing)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""
+Quantization mode of each model, without importing torch.
+
+The mode is chosen per model family with ``QUANTIZE_MODELS``
+("family=mode,..." matched against the base model directory name, e.g.
+"Llama-3.1-70B=int4,Med42=int8"), falling back to ``QUANTIZATION`` for every
+other model. Adapters are served by an unquantized base model.
+"""
+import os
+
+from inference.messages import is_vision_handler
+
+QUANTIZATION_MODES = ("int8", "int4", "fp8")
+QUANTIZATION = os.environ.get("QUANTIZATION", "")
+QUANTIZE_MODELS = os.environ.get("QUANTIZE_MODELS", "")
+
+
+def normalize_mode(mode):
+    """A quantization mode, or None for unquantized weights"""
+    mode = (mode or "").strip().lower()
+    if mode in ("", "none", "bf16"):
+        return None
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {', '.join(QUANTIZATION_MODES)}")
+    return mode
+
+
+def parse_quantize_models(spec):
+    """{family: mode} from a "family=mode,..." string"""
+    mapping = {}
+    for item in (spec or "").split(","):
+        family, _, mode = item.partition("=")
+        if family.strip() and mode.strip():
+            mapping[family.strip()] = mode.strip()
+    return mapping
+
+
+def quantization_for(base_model_path, quantize_models=None, default=None):
+    """Quantization mode for base_model_path, using the longest matching family"""
+    quantize_models = parse_quantize_models(QUANTIZE_MODELS) if quantize_models is None else quantize_models
+    name = os.path.basename(os.path.normpath(base_model_path)).lower()
+    matches = [family for family in quantize_models if family.lower() in name]
+    if matches:
+        return normalize_mode(quantize_models[max(matches, key=len)])
+    return normalize_mode(QUANTIZATION if default is None else default)
+
+
+def handler_quantization(base_model_path, adapter_path=None):
+    """Mode of the weights serving base_model_path with adapter_path, None when unquantized"""
+    if adapter_path and not is_vision_handler(base_model_path):
+        return None
+    return quantization_for(base_model_path)
@@ -0,0 +1,116 @@
+"""
+Exact-match cache of generated results for deterministic requests.
+
+Only generations that are reproducible are cached: greedy decoding
+(``do_sample`` false) or sampling with a fixed ``seed``. Entries are keyed by
+a hash of the model, adapter, quantization mode, composed prompt and
+generation args, held in an in-memory LRU and optionally in an on-disk tier.
+Both tiers expire entries after ``ttl`` seconds.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+
+def is_deterministic(generation_args):
+    generation_args = generation_args or {}
+    return generation_args.get("do_sample") is False or generation_args.get("seed") is not None
+
+
+def response_key(base_model_path, adapter_path, prompt, generation_args, quantization=None):
+    payload = json.dumps(
+        {
+            "base_model_path": base_model_path,
+            "adapter_path": adapter_path,
+            "quantization": quantization,
+            "prompt": prompt,
+            "generation_args": generation_args or {},
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, disk_dir=None, ttl=86400):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (result, created)
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        entry = self._memory.get(key)
+        if entry is not None and not self._expired(entry[1]):
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self._memory.pop(key, None)
+
+        if self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._remember(key, entry["result"], entry["created"])
+                self.hits += 1
+                return entry["result"]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        created = time.time()
+        self._remember(key, result, created)
+        if self.disk_dir:
+            self._write_disk(key, result, created)
+
+    def _remember(self, key, result, created):
+        self._memory[key] = (result, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry.get("created", 0)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def _write_disk(self, key, result, created):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"result": result, "created": created}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write response cache entry {path}: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,261 @@
+"""
+Model-affinity routing of inference requests to workers.
+
+With ``MODEL_ROUTING`` enabled every worker consumes its own queue
+(``inference_worker_<WORKER_ID>``) and periodically advertises the models it
+holds and its backlog on the ``inference_workers`` fanout exchange. The
+router consumes the shared input queue and forwards each request to a worker
+that already holds its ``(base_model_path, adapter_path)``. Failing that,
+adapter requests go to a worker holding the same base model, since a new
+adapter attaches to the resident base. Remaining requests, and requests whose
+preferred worker is backlogged, go to the least loaded worker. A model routed
+to a worker is treated as resident there until the worker's status confirms
+it or the assignment expires, so a burst of requests for a cold model loads
+it once. Each priority class is routed from its own input queue to the
+worker's queue of the same class.
+"""
+import json
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
+
+import pika
+
+from inference.batching import DEFAULT_PRIORITY, PRIORITY_CLASSES, class_queue, priority_of
+from inference.transport import Transport
+
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "128.16.12.219")
+RABBITMQ_PORT = int(os.environ.get("RABBITMQ_PORT", "5672"))
+RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
+RABBITMQ_PASS = os.environ.get("RABBITMQ_PASS", "guest")
+INPUT_QUEUE = os.environ.get("INPUT_QUEUE", "engineered_prompt")
+
+WORKER_STATUS_EXCHANGE = os.environ.get("WORKER_STATUS_EXCHANGE", "inference_workers")
+WORKER_QUEUE_PREFIX = os.environ.get("WORKER_QUEUE_PREFIX", "inference_worker_")
+WORKER_STATUS_INTERVAL_S = float(os.environ.get("WORKER_STATUS_INTERVAL_S", "5"))
+# Workers that have not reported for this long are not routed to
+WORKER_STATUS_TTL_S = float(os.environ.get("WORKER_STATUS_TTL_S", "20"))
+# How long a routed model counts as resident before the worker confirms it
+ASSIGNMENT_TTL_S = float(os.environ.get("ROUTING_ASSIGNMENT_TTL_S", "300"))
+# Backlog above which a resident worker is passed over for the least loaded one
+ROUTING_MAX_BACKLOG = int(os.environ.get("ROUTING_MAX_BACKLOG", "64"))
+ROUTER_PREFETCH = int(os.environ.get("ROUTER_PREFETCH", "256"))
+
+ModelKey = Tuple[str, Optional[str]]
+
+
+def worker_queue(worker_id):
+    return f"{WORKER_QUEUE_PREFIX}{worker_id}"
+
+
+def model_key(message):
+    return (message.get("base_model_path"), message.get("adapter_path") or None)
+
+
+def worker_status(worker_id, queue, handler_keys, backlog):
+    """
+    Status advertised by a worker. handler_keys are its handler cache keys,
+    (base_model_path, adapter_path, device); draft models are left out.
+    """
+    loaded = sorted(
+        {(key[0], key[1]) for key in handler_keys if key[0] != "draft"},
+        key=lambda k: (k[0] or "", k[1] or ""),
+    )
+    return {
+        "worker_id": str(worker_id),
+        "queue": queue,
+        "loaded": [list(key) for key in loaded],
+        "backlog": int(backlog),
+        "sent_at": time.time(),
+    }
+
+
+@dataclass
+class WorkerState:
+    worker_id: str
+    queue: str
+    loaded: Set[ModelKey] = field(default_factory=set)
+    backlog: int = 0
+    seen_at: float = 0.0
+    # Requests routed since the last status report
+    routed: int = 0
+    # Models routed here that the worker has not reported yet -> time of routing
+    assigned: Dict[ModelKey, float] = field(default_factory=dict)
+
+    @property
+    def load(self):
+        return self.backlog + self.routed
+
+    def holds(self, key, now, assignment_ttl):
+        if key in self.loaded:
+            return True
+        assigned_at = self.assigned.get(key)
+        return assigned_at is not None and now - assigned_at < assignment_ttl
+
+    def holds_base(self, base_model_path, now, assignment_ttl):
+        keys = set(self.loaded) | {k for k, t in self.assigned.items() if now - t < assignment_ttl}
+        return any(base == base_model_path and adapter for base, adapter in keys)
+
+
+class WorkerTable:
+    def __init__(self, status_ttl=WORKER_STATUS_TTL_S, assignment_ttl=ASSIGNMENT_TTL_S,
+                 max_backlog=ROUTING_MAX_BACKLOG):
+        self.status_ttl = status_ttl
+        self.assignment_ttl = assignment_ttl
+        self.max_backlog = max_backlog
+        self.workers: Dict[str, WorkerState] = {}
+        self.resident_routes = 0
+        self.cold_routes = 0
+
+    def update(self, status, now=None):
+        now = time.monotonic() if now is None else now
+        worker_id = str(status["worker_id"])
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            worker = self.workers[worker_id] = WorkerState(worker_id, status["queue"])
+            print(f"Worker {worker_id} joined with queue {worker.queue}")
+        worker.queue = status["queue"]
+        worker.loaded = {(base, adapter or None) for base, adapter in status.get("loaded", [])}
+        worker.backlog = int(status.get("backlog", 0))
+        worker.seen_at = now
+        worker.routed = 0
+        worker.assigned = {
+            key: t for key, t in worker.assigned.items()
+            if key not in worker.loaded and now - t < self.assignment_ttl
+        }
+        return worker
+
+    def live_workers(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [w for w in self.workers.values() if now - w.seen_at < self.status_ttl]
+
+    def choose(self, key, now=None):
+        """Worker to serve model key, or None while no worker is live"""
+        now = time.monotonic() if now is None else now
+        live = self.live_workers(now)
+        if not live:
+            return None
+        base_model_path, adapter_path = key
+
+        def least_loaded(workers):
+            return min(workers, key=lambda w: (w.load, w.worker_id))
+
+        candidates = [w for w in live if w.holds(key, now, self.assignment_ttl)]
+        if not candidates and adapter_path:
+            candidates = [w for w in live if w.holds_base(base_model_path, now, self.assignment_ttl)]
+        worker = least_loaded(candidates) if candidates else None
+        if worker is not None and self.max_backlog and worker.load >= self.max_backlog:
+            # The resident worker is backlogged; loading elsewhere is cheaper than waiting
+            worker = least_loaded(live)
+        if worker is not None and worker in candidates:
+            self.resident_routes += 1
+        else:
+            worker = worker or least_loaded(live)
+            self.cold_routes += 1
+
+        if base_model_path:
+            worker.assigned.setdefault(key, now)
+        worker.routed += 1
+        return worker
+
+    def stats(self):
+        routes = self.resident_routes + self.cold_routes
+        return {
+            "workers": len(self.workers),
+            "resident_routes": self.resident_routes,
+            "cold_routes": self.cold_routes,
+            "resident_ratio": self.resident_routes / routes if routes else 0.0,
+        }
+
+
+class Router:
+    def __init__(self, channel, table=None, transport=None):
+        """
+        Requests are forwarded through transport, so one the broker does not
+        confirm or cannot route is requeued on the input queue instead of acked.
+        """
+        self.channel = channel
+        self.table = table or WorkerTable()
+        self.transport = transport or Transport()
+        self.transport.open(channel)
+        # Requests held unacked until a worker is live
+        self.waiting = deque()
+        self.declared = set()
+
+    def _forward(self, worker, method, properties, body, priority):
+        queue = class_queue(worker.queue, priority)
+        if queue not in self.declared:
+            self.channel.queue_declare(queue=queue, durable=True)
+            self.declared.add(queue)
+        self.transport.publish(
+            self.channel,
+            queue,
+            body,
+            delivery_tag=method.delivery_tag,
+            properties=properties or pika.BasicProperties(delivery_mode=2),
+        )
+        self.transport.settle(self.channel, [method.delivery_tag])
+
+    def on_request(self, ch, method, properties, body):
+        # Registered so a batched ack never covers a request still waiting for a worker
+        self.transport.delivered(self.channel, method.delivery_tag)
+        try:
+            message = json.loads(body)
+            key, priority = model_key(message), priority_of(message)
+        except Exception:
+            # Undecodable requests are left to a worker to reject and count
+            key, priority = (None, None), DEFAULT_PRIORITY
+        worker = self.table.choose(key)
+        if worker is None:
+            self.waiting.append((method, properties, body, key, priority))
+            return
+        self._forward(worker, method, properties, body, priority)
+
+    def on_status(self, ch, method, properties, body):
+        try:
+            self.table.update(json.loads(body))
+        except Exception as e:
+            print(f"Invalid worker status: {e}")
+            return
+        while self.waiting:
+            method, properties, body, key, priority = self.waiting[0]
+            worker = self.table.choose(key)
+            if worker is None:
+                return
+            self.waiting.popleft()
+            self._forward(worker, method, properties, body, priority)
+
+
+def main():
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials)
+    )
+    channel = connection.channel()
+    input_queues = [class_queue(INPUT_QUEUE, priority) for priority in PRIORITY_CLASSES]
+    for queue in input_queues:
+        channel.queue_declare(queue=queue, durable=True)
+    channel.exchange_declare(exchange=WORKER_STATUS_EXCHANGE, exchange_type="fanout")
+    status_queue = channel.queue_declare(queue="", exclusive=True).method.queue
+    channel.queue_bind(exchange=WORKER_STATUS_EXCHANGE, queue=status_queue)
+    channel.basic_qos(prefetch_count=ROUTER_PREFETCH)
+
+    router = Router(channel, transport=Transport(connection, prefetch_count=ROUTER_PREFETCH))
+
+    def report():
+        print(f"Routing: {router.table.stats()}, waiting for a worker: {len(router.waiting)}, "
+              f"transport: {router.transport.stats()}")
+        connection.call_later(60, report)
+
+    channel.basic_consume(queue=status_queue, on_message_callback=router.on_status, auto_ack=True)
+    for queue in input_queues:
+        channel.basic_consume(queue=queue, on_message_callback=router.on_request)
+    connection.call_later(60, report)
+    print(f"Routing {INPUT_QUEUE} to inference workers. To exit press CTRL+C")
+    channel.start_consuming()
+
+
+if __name__ == "__main__":
+    main()
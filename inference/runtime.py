@@ -0,0 +1,799 @@
+"""
+Model runtime: loading models and adapters into handlers and generating with them.
+
+This is where torch, transformers and peft are imported. The consumer imports
+this module when it builds its first handler, so a worker is connected and
+receiving messages without paying for those imports up front.
+"""
+import os
+os.environ["HF_HOME"] = "/models"
+
+import contextlib
+import re
+import weakref
+
+from transformers import pipeline as hf_pipeline, AutoModelForCausalLM, AutoTokenizer, AutoProcessor, AutoModelForVision2Seq
+import transformers
+print("Transformers cache dir:", transformers.utils.default_cache_path)
+import torch
+from inference.handler_cache import handler_models
+from inference.adapter_cache import prepare_adapter
+from inference.prefix_cache import PrefixCache, generate_with_prefix_cache
+from inference.shape_buckets import ShapeBuckets
+from inference.speculative import generate_with_draft
+from inference.weights import load_pretrained_mmap
+from inference.messages import MAX_INPUT_TOKENS, is_vision_handler, needs_chat_handler
+from inference.stopping import (
+    ANSWER_HEADERS, STOP_CHECK_TOKENS, answer_start, answer_started, stops_for, trim_at_stop,
+)
+from inference.quantization import normalize_mode, quantization_for, quantize_model, quantized_mode
+
+try:
+    from peft import PeftModel
+except ImportError:
+    PeftModel = None
+
+# KV of recent prompts is kept so prompts sharing a template preamble only prefill
+# their suffix; prefixes shorter than PREFIX_CACHE_MIN_TOKENS are not reused (0 MB disables it)
+PREFIX_CACHE_MAX_MB = float(os.environ.get("PREFIX_CACHE_MAX_MB", "0"))
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get("PREFIX_CACHE_MIN_TOKENS", "32"))
+
+prefix_cache = (
+    PrefixCache(int(PREFIX_CACHE_MAX_MB * 2**20), min_prefix_tokens=PREFIX_CACHE_MIN_TOKENS)
+    if PREFIX_CACHE_MAX_MB > 0 else None
+)
+
+# Pad prompts to power-of-two lengths so graph-compiled backends see few distinct shapes
+SHAPE_BUCKETING = os.environ.get("SHAPE_BUCKETING", "0").lower() in ("1", "true", "yes")
+SHAPE_BUCKET_MIN = int(os.environ.get("SHAPE_BUCKET_MIN", "16"))
+
+input_shapes = ShapeBuckets(enabled=SHAPE_BUCKETING, min_length=SHAPE_BUCKET_MIN)
+
+# Read safetensors weights through shared memory maps and stream them to the device,
+# so workers loading the same model share the page cache instead of private copies
+MMAP_WEIGHTS = os.environ.get("MMAP_WEIGHTS", "0").lower() in ("1", "true", "yes")
+
+def load_model(model_class, model_path, device, torch_dtype=torch.bfloat16, **kwargs):
+    """model_class.from_pretrained onto device, memory-mapping local safetensors shards with MMAP_WEIGHTS"""
+    if MMAP_WEIGHTS and os.path.isdir(model_path):
+        return load_pretrained_mmap(model_class, model_path, torch_dtype=torch_dtype, device_map=device, **kwargs)
+    return model_class.from_pretrained(model_path, torch_dtype=torch_dtype, device_map=device, **kwargs)
+
+def load_quantized_model(model_class, model_path, device, quantization, **kwargs):
+    """
+    load_model with its linear layers quantized to quantization. The model is
+    loaded on the host, memory-mapped with MMAP_WEIGHTS, and moved to device
+    layer by layer as it is quantized, so the device never holds its
+    unquantized weights. Returns the model and the mode applied.
+    """
+    quantization = normalize_mode(quantization)
+    if quantization is None:
+        return load_model(model_class, model_path, device, **kwargs), None
+    model = quantize_model(load_model(model_class, model_path, "cpu", **kwargs), quantization, device=device)
+    # Devices without a fused kernel for the mode get the model unquantized
+    return model, quantized_mode(model)
+
+def adapter_quantization(quantization, base_model_path, adapter_path):
+    """Adapters' base models are loaded unquantized: LoRA layers wrap nn.Linear modules"""
+    quantization = normalize_mode(quantization)
+    if quantization is not None:
+        print(
+            f"Warning: {quantization} quantization is not applied to adapters; "
+            f"{base_model_path} is served unquantized for adapter {adapter_path}"
+        )
+    return None
+
+def prepare_tokenizer_for_batching(tokenizer):
+    """Decoder-only models need left padding and a pad token to generate in batches"""
+    if getattr(tokenizer, "pad_token", None) is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+# One resident PEFT model per (base_model_path, device); adapters are attached to it by name.
+# Entries disappear once no handler references the model any more.
+_shared_lora_models = weakref.WeakValueDictionary()
+
+def adapter_name_for(adapter_path):
+    """PEFT adapter names become module keys, so they cannot contain dots"""
+    return re.sub(r"\W", "_", adapter_path.strip("/")) or "default"
+
+def load_lora_model(base_model_path, adapter_path, device):
+    """
+    Attach adapter_path to the resident PEFT model for base_model_path,
+    loading the base model only on first use.
+    Returns the shared model and the adapter's name within it.
+    """
+    key = (base_model_path, device)
+    adapter_name = adapter_name_for(adapter_path)
+    model = _shared_lora_models.get(key)
+    if model is not None and adapter_name in model.peft_config:
+        return model, adapter_name
+
+    # Read the PEFT-native copy of the adapter so no weights need fixing after load
+    native_adapter_path = prepare_adapter(adapter_path)
+    if model is None:
+        print(f"Loading base model for PEFT: {base_model_path}")
+        base_model = load_model(
+            AutoModelForCausalLM,
+            base_model_path,
+            device,
+            trust_remote_code=True,
+            low_cpu_mem_usage=True
+        )
+        print(f"Loading PEFT adapter: {adapter_path}")
+        model = PeftModel.from_pretrained(
+            base_model,
+            native_adapter_path,
+            adapter_name=adapter_name,
+            torch_dtype=torch.bfloat16,
+            device_map=device
+        )
+        model.eval()
+        _shared_lora_models[key] = model
+    else:
+        print(f"Attaching PEFT adapter {adapter_path} to resident {base_model_path}")
+        model.load_adapter(native_adapter_path, adapter_name=adapter_name)
+        model.eval()
+    return model, adapter_name
+
+def resident_lora_model(base_model_path, device, quantization=None):
+    """
+    The resident PEFT model of base_model_path, which serves base-only requests
+    too, with its adapters disabled, or None. Quantized base models are loaded
+    on their own, since adapters' base models are not quantized.
+    """
+    if not PeftModel or normalize_mode(quantization) is not None:
+        return None
+    return _shared_lora_models.get((base_model_path, device))
+
+def adapters_disabled(model, disabled):
+    """Context running a shared PEFT model as its base model when disabled is set"""
+    return model.disable_adapter() if disabled else contextlib.nullcontext()
+
+def unload_lora_adapter(model, adapter_name):
+    """Drop one adapter from a shared model; the last one goes away with the model itself"""
+    if adapter_name in model.peft_config and len(model.peft_config) > 1:
+        print(f"Removing PEFT adapter {adapter_name}")
+        model.delete_adapter(adapter_name)
+
+def lora_generate_kwargs(model, adapter_names):
+    """
+    Select the adapters for a generate() call. A single adapter is activated
+    directly; a mixed batch routes each row through its own adapter.
+    """
+    if not adapter_names:
+        return {}
+    if len(set(adapter_names)) == 1:
+        if model.active_adapter != adapter_names[0]:
+            model.set_adapter(adapter_names[0])
+        return {}
+    return {"adapter_names": list(adapter_names)}
+
+def context_length(tokenizer, model):
+    """Tokens the model attends to, the smaller of the tokenizer's and the config's limits, or None"""
+    limits = []
+    model_max_length = getattr(tokenizer, "model_max_length", None)
+    # Tokenizers without a limit report a huge placeholder
+    if isinstance(model_max_length, int) and model_max_length < 10**7:
+        limits.append(model_max_length)
+    max_positions = getattr(getattr(model, "config", None), "max_position_embeddings", None)
+    if isinstance(max_positions, int):
+        limits.append(max_positions)
+    return min(limits) if limits else None
+
+def input_limit(tokenizer, model):
+    """Input tokens a handler accepts: MAX_INPUT_TOKENS, bounded by the model's context"""
+    context = context_length(tokenizer, model)
+    if MAX_INPUT_TOKENS > 0 and context:
+        return min(MAX_INPUT_TOKENS, context)
+    return context or MAX_INPUT_TOKENS
+
+def template_tokens(tokenizer, chat=False):
+    """Tokens the chat template (chat) or the tokenizer's special tokens add to a prompt"""
+    if chat:
+        return len(tokenizer.apply_chat_template(
+            [{"role": "user", "content": ""}], add_generation_prompt=True, tokenize=True
+        ))
+    return len(tokenizer("")["input_ids"])
+
+def input_budget(handler, generation_args=None):
+    """
+    Tokens a prompt's text may take with handler: its input limit, and the
+    model's context less the tokens to generate, without the tokens the chat
+    template or special tokens add. None when the handler has no limit.
+    """
+    limit = getattr(handler, "max_input_tokens", None)
+    if not limit:
+        return None
+    generation_args = generation_args or handler.default_generation_args
+    context = getattr(handler, "context_length", None)
+    if context:
+        limit = min(limit, context - int(generation_args.get("max_new_tokens") or 0))
+    # At least one token, since fit_document reads no budget as unlimited
+    return max(1, limit - getattr(handler, "template_tokens", 0))
+
+def bucket_inputs(inputs, model, pad_token_id, max_input_tokens=None, namespace=None):
+    """
+    Pad tokenized inputs to their shape bucket, bounded by the model's context and the input budget.
+    Single prompts go through the prefix cache, which prefills them from the end of the cached
+    prefix in namespace, so only that part is padded to its bucket.
+    """
+    max_length = getattr(getattr(model, "config", None), "max_position_embeddings", None)
+    if not isinstance(max_length, int):
+        max_length = None
+    if max_input_tokens:
+        max_length = min(max_length, max_input_tokens) if max_length else max_input_tokens
+    prefix_length = None
+    if input_shapes.enabled and prefix_cache is not None and inputs["input_ids"].shape[0] == 1:
+        attention_mask = inputs.get("attention_mask")
+        prefix_length = prefix_cache.match_length(
+            namespace, inputs["input_ids"][0], None if attention_mask is None else attention_mask[0]
+        )
+    return input_shapes.prepare(inputs, pad_token_id, max_length, prefix_length=prefix_length)
+
+def generate_for(model, namespace, inputs, assistant_model=None, **generate_kwargs):
+    """
+    generate() for a handler: single sequences are assisted by the draft model
+    when one is given, everything else goes through the prefix cache.
+    """
+    start_stop_criteria(generate_kwargs.get("stopping_criteria"), inputs["input_ids"].shape[1])
+    if assistant_model is not None and inputs["input_ids"].shape[0] == 1:
+        outputs, stats = generate_with_draft(model, assistant_model, inputs, **generate_kwargs)
+        print(
+            f"Assisted decoding: {stats['new_tokens']} tokens, "
+            f"acceptance rate {stats['acceptance_rate']:.2f}, "
+            f"{stats['tokens_per_target_forward']:.2f} tokens per target pass, "
+            f"{stats['tokens_per_second']:.1f} tokens/s"
+        )
+        return outputs
+    return generate_with_prefix_cache(model, prefix_cache, namespace, inputs, **generate_kwargs)
+
+class CancellationCriteria(transformers.StoppingCriteria):
+    """
+    Ends the rows of a generate() call whose request was cancelled. checks holds
+    one callable per request, true once it is cancelled; rows map to requests in
+    order, several consecutive rows per request with num_return_sequences.
+    Requests are checked every check_every decode steps.
+    """
+    def __init__(self, checks, check_every=1):
+        self.checks = checks
+        self.check_every = max(1, check_every)
+        self.cancelled = [False] * len(checks)
+        self.steps = 0
+        self._done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        rows = input_ids.shape[0]
+        if self._done is None or self._done.shape[0] != rows:
+            self._done = torch.zeros(rows, dtype=torch.bool, device=input_ids.device)
+        self.steps += 1
+        if self.steps % self.check_every == 0:
+            changed = False
+            for index, check in enumerate(self.checks):
+                if not self.cancelled[index] and check():
+                    self.cancelled[index] = changed = True
+            if changed:
+                per_request = max(1, rows // len(self.checks))
+                self._done = torch.tensor(
+                    [self.cancelled[min(row // per_request, len(self.checks) - 1)] for row in range(rows)],
+                    dtype=torch.bool, device=input_ids.device,
+                )
+        return self._done
+
+def cancellation_criteria(checks, check_every=1):
+    """stopping_criteria argument for generate() ending cancelled requests"""
+    return transformers.StoppingCriteriaList([CancellationCriteria(checks, check_every)])
+
+class StopSequenceCriteria(transformers.StoppingCriteria):
+    """
+    Ends each row of a generate() call once it generates one of stop_strings.
+
+    After every step, the tokens added since the previous one (several with
+    assisted decoding) are compared on the device with each stop string's
+    token sequences, standalone and after a space or newline, so no step
+    waits for the host. Every check_every steps the tokens since the last
+    check are decoded and searched, which also finds stop strings tokenized
+    some other way; those may end a row up to check_every - 1 tokens late,
+    and results are cut at the stop string anyway. Nothing before the answer
+    is searched: not the prompt, whose length generate_for() sets (otherwise
+    it is taken to end one token before the first check, as when every step
+    adds one token), nor an answer header the output opens with.
+    """
+    def __init__(self, tokenizer, stop_strings, check_every=STOP_CHECK_TOKENS):
+        self.tokenizer = tokenizer
+        self.stop_strings = stop_strings
+        self.check_every = max(1, check_every)
+        encode = lambda text: tokenizer(text, add_special_tokens=False)["input_ids"]
+        # A stop string may also start inside the token before its first full token
+        self.window = max(len(encode(stop)) for stop in stop_strings) + 1
+        # An answer header only stops a row after its answer started, which the decoded check tells
+        self.token_sequences = list(dict.fromkeys(
+            tuple(encode(prefix + stop)[-len(encode(stop)):])
+            for stop in stop_strings if stop not in ANSWER_HEADERS
+            for prefix in ("", " ", "\n")
+        ))
+        self.prompt_length = None
+        self.steps = 0
+        self.seen_length = None
+        self.checked_length = None
+        self.stopped = []
+        self.answer_from = []
+        self._sequences = None
+        self._done = None
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=False)
+
+    def _tokens_before(self, ids, chars):
+        """Number of leading ids that decode to at most chars characters"""
+        count = 0
+        while count < len(ids) and len(self._decode(ids[:count + 1])) <= chars:
+            count += 1
+        return count
+
+    def _match_tokens(self, input_ids, length):
+        """Rows whose new tokens end with a stop string's token sequence, computed on the device"""
+        if self._sequences is None:
+            self._sequences = [
+                torch.tensor(sequence, dtype=input_ids.dtype, device=input_ids.device)
+                for sequence in self.token_sequences if sequence
+            ]
+        done = self._done
+        for sequence in self._sequences:
+            start = max(self.prompt_length, self.seen_length - len(sequence) + 1)
+            if length - start >= len(sequence):
+                windows = input_ids[:, start:].unfold(1, len(sequence), 1)
+                done = done | (windows == sequence).all(-1).any(-1)
+        return done
+
+    def _match_text(self, input_ids, length):
+        """Rows whose text decoded since the last check holds a stop string"""
+        done = self._done.tolist()
+        # Until its answer has started a row is decoded from the end of the prompt
+        starts = [
+            self.prompt_length if answer_from is None else max(answer_from, self.checked_length - self.window)
+            for answer_from in self.answer_from
+        ]
+        offset = min(starts)
+        for row, tail in enumerate(input_ids[:, offset:].tolist()):
+            if done[row]:
+                self.stopped[row] = True
+            if self.stopped[row]:
+                continue
+            tail = tail[starts[row] - offset:]
+            text = self._decode(tail)
+            if self.answer_from[row] is None:
+                begin = answer_start(text)
+                if answer_started(text):
+                    self.answer_from[row] = self.prompt_length + self._tokens_before(tail, begin)
+                text = text[begin:]
+            if any(stop in text for stop in self.stop_strings):
+                self.stopped[row] = True
+        self.checked_length = length
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        rows, length = input_ids.shape
+        if self.prompt_length is None:
+            self.prompt_length = length - 1
+        if self._done is None or self._done.shape[0] != rows:
+            self.stopped = [False] * rows
+            self.answer_from = [None] * rows
+            self.seen_length = self.checked_length = self.prompt_length
+            self._done = torch.zeros(rows, dtype=torch.bool, device=input_ids.device)
+        self._done = self._match_tokens(input_ids, length)
+        self.seen_length = length
+        self.steps += 1
+        if self.steps % self.check_every == 0:
+            self._done = self._match_text(input_ids, length)
+        return self._done
+
+def start_stop_criteria(stopping_criteria, prompt_length):
+    """Tell the stop criteria of a generate() call where its prompt ends"""
+    for criteria in stopping_criteria or []:
+        if isinstance(criteria, StopSequenceCriteria):
+            criteria.prompt_length = prompt_length
+
+def special_token_id(tokenizer, text):
+    """Id of text if it is exactly one of tokenizer's special tokens"""
+    for token_id, token in getattr(tokenizer, "added_tokens_decoder", {}).items():
+        if token.special and token.content == text:
+            return token_id
+    if text in tokenizer.all_special_tokens:
+        return tokenizer.convert_tokens_to_ids(text)
+    return None
+
+def apply_stops(tokenizer, base_model_path, generation_args, eos_token_id=None):
+    """
+    generation_args for generate() with the model's and the request's stop
+    sequences. Every stop string gets a stopping criterion, which also matches
+    it when it is tokenized differently in context; special tokens among them
+    also join eos_token_id, like stop_token_ids. Returns the arguments and the
+    stop strings to trim results at.
+    """
+    generation_args = dict(generation_args)
+    stop_strings, stop_token_ids = stops_for(
+        base_model_path, generation_args.pop("stop", None), generation_args.pop("stop_token_ids", None)
+    )
+    for stop in stop_strings:
+        token_id = special_token_id(tokenizer, stop)
+        if token_id is not None:
+            stop_token_ids.append(token_id)
+    eos_token_id = generation_args.get("eos_token_id", eos_token_id)
+    if eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    eos_token_ids = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id or [])
+    generation_args["eos_token_id"] = list(dict.fromkeys(eos_token_ids + stop_token_ids))
+    if stop_strings:
+        criteria = transformers.StoppingCriteriaList(generation_args.get("stopping_criteria") or [])
+        criteria.append(StopSequenceCriteria(tokenizer, stop_strings))
+        generation_args["stopping_criteria"] = criteria
+    # Stop tokens that are not special survive decoding and are trimmed like the strings
+    return generation_args, stop_strings
+
+def model_eos_token_id(model):
+    generation_config = getattr(model, "generation_config", None)
+    return getattr(generation_config, "eos_token_id", None)
+
+class PipelineHandler:
+    def __init__(self, base_model_path, device, adapter_path=None, quantization=None):
+        self.adapter_name = None
+        self.quantization = None
+        # Set when base-only requests are served by the resident PEFT model of base_model_path
+        self.disable_adapters = False
+        resident = None if adapter_path else resident_lora_model(base_model_path, device, quantization)
+        if adapter_path and PeftModel:
+            # Share the base model with every other adapter of base_model_path
+            self.model, self.adapter_name = load_lora_model(base_model_path, adapter_path, device)
+            self.tokenizer = prepare_tokenizer_for_batching(AutoTokenizer.from_pretrained(base_model_path))
+            self.pipe = None
+            self.quantization = adapter_quantization(quantization, base_model_path, adapter_path)
+        elif resident is not None:
+            print(f"Serving {base_model_path} from its resident PEFT model with adapters disabled")
+            self.model, self.disable_adapters = resident, True
+            self.tokenizer = prepare_tokenizer_for_batching(AutoTokenizer.from_pretrained(base_model_path))
+            self.pipe = None
+        elif MMAP_WEIGHTS or normalize_mode(quantization):
+            model, self.quantization = load_quantized_model(AutoModelForCausalLM, base_model_path, device, quantization)
+            self.pipe = hf_pipeline(
+                "text-generation",
+                model=model,
+                tokenizer=AutoTokenizer.from_pretrained(base_model_path),
+            )
+            self.tokenizer = prepare_tokenizer_for_batching(self.pipe.tokenizer)
+            self.model = None
+        else:
+            self.pipe = hf_pipeline(
+                "text-generation",
+                model=base_model_path,
+                torch_dtype=torch.bfloat16,
+                device_map=device,
+            )
+            self.tokenizer = prepare_tokenizer_for_batching(self.pipe.tokenizer)
+            self.model = None
+
+        self.adapter_path = adapter_path
+        self.base_model_path = base_model_path
+        self.device = device
+        self.prefix_namespace = (base_model_path, adapter_path)
+        model = self.model if self.model is not None else self.pipe.model
+        self.context_length = context_length(self.tokenizer, model)
+        self.max_input_tokens = input_limit(self.tokenizer, model)
+        self.template_tokens = 0 if self.model is not None else template_tokens(self.tokenizer)
+
+    @property
+    def default_generation_args(self):
+        return {
+            "max_new_tokens": 512,
+            "do_sample": True,
+            "temperature": 0.4,
+            "top_k": 150,
+            "top_p": 0.75,
+        }
+
+    def infer(self, prompt, streamer=None, **generation_args):
+        if not generation_args:
+            generation_args = self.default_generation_args
+            
+        if getattr(self, "model", None) is not None:
+            return self.infer_batch([prompt], streamer=streamer, **generation_args)[0]
+        elif prefix_cache is not None or input_shapes.enabled or generation_args.get("assistant_model") is not None:
+            return self._infer_on_model([prompt], streamer, generation_args)[0]
+        else:
+            # Use pipeline inference for non-PEFT models
+            generation_args, stops = self._apply_stops(generation_args)
+            if streamer is not None:
+                generation_args = dict(generation_args, streamer=streamer)
+            outputs = self.pipe(prompt, **generation_args)
+            generated = outputs[0]["generated_text"]
+            return trim_at_stop(generated[len(prompt):] if generated.startswith(prompt) else generated, stops)
+
+    def _apply_stops(self, generation_args):
+        model = getattr(self, "model", None)
+        if model is None:
+            model = getattr(self.pipe, "model", None)
+        if model is None:
+            # Nothing to generate with, so nothing to stop
+            generation_args = {k: v for k, v in generation_args.items() if k not in ("stop", "stop_token_ids")}
+            return generation_args, []
+        return apply_stops(self.tokenizer, self.base_model_path, generation_args, model_eos_token_id(model))
+
+    def _infer_on_model(self, prompts, streamer, generation_args):
+        """
+        Pipeline-equivalent generation on the pipeline's model, reusing cached
+        prompt prefixes and padding prompts to their shape bucket
+        """
+        model = self.pipe.model
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        inputs = bucket_inputs(
+            inputs, model, self.tokenizer.pad_token_id, self.max_input_tokens, self.prefix_namespace
+        )
+        inputs = {k: v.to(model.device) for k, v in inputs.items()}
+        input_length = inputs["input_ids"].shape[1]
+        generation_args, stops = self._apply_stops(generation_args)
+        generation_args.setdefault("pad_token_id", self.tokenizer.pad_token_id)
+        outputs = generate_for(model, self.prefix_namespace, inputs, streamer=streamer, **generation_args)
+        return [
+            trim_at_stop(self.tokenizer.decode(output[input_length:], skip_special_tokens=True), stops)
+            for output in outputs
+        ]
+
+    def _peft_generation_kwargs(self, generation_args):
+        return dict(
+            max_new_tokens=generation_args.get("max_new_tokens", 512),
+            min_new_tokens=generation_args.get("min_new_tokens", 10),
+            do_sample=generation_args.get("do_sample", True),
+            temperature=generation_args.get("temperature", 0.7),
+            top_k=generation_args.get("top_k", 150),
+            top_p=generation_args.get("top_p", 0.75),
+            pad_token_id=self.tokenizer.eos_token_id,
+            eos_token_id=generation_args.get("eos_token_id", self.tokenizer.eos_token_id),
+            assistant_model=generation_args.get("assistant_model"),
+            stopping_criteria=generation_args.get("stopping_criteria"),
+        )
+
+    def infer_batch(self, prompts, streamer=None, adapter_names=None, **generation_args):
+        """
+        Run several prompts through one padded generate() call.
+        adapter_names optionally gives each prompt its own adapter of the shared base model.
+        """
+        if not generation_args:
+            generation_args = self.default_generation_args
+
+        if getattr(self, "model", None) is not None:
+            # For PeftModel, we need to tokenize the prompts first
+            inputs = self.tokenizer(
+                prompts,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=self.max_input_tokens,
+                add_special_tokens=False,
+            )
+            inputs = bucket_inputs(
+                inputs, self.model, self.tokenizer.pad_token_id, self.max_input_tokens, self.prefix_namespace
+            )
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+            # Inputs are left padded, so generated tokens start at the same offset for every row
+            input_length = inputs["input_ids"].shape[1]
+            generation_args, stops = self._apply_stops(generation_args)
+
+            if self.adapter_name:
+                adapter_names = adapter_names or [self.adapter_name] * len(prompts)
+            with torch.no_grad(), adapters_disabled(self.model, self.disable_adapters):
+                outputs = generate_for(
+                    self.model,
+                    self.prefix_namespace,
+                    inputs,
+                    **self._peft_generation_kwargs(generation_args),
+                    **lora_generate_kwargs(self.model, adapter_names),
+                    streamer=streamer,
+                )
+
+            # Only decode the generated part
+            return [
+                trim_at_stop(self.tokenizer.decode(output[input_length:], skip_special_tokens=True), stops).strip()
+                for output in outputs
+            ]
+        elif input_shapes.enabled:
+            return self._infer_on_model(prompts, streamer, generation_args)
+        else:
+            generation_args, stops = self._apply_stops(generation_args)
+            if streamer is not None:
+                generation_args = dict(generation_args, streamer=streamer)
+            outputs = self.pipe(prompts, batch_size=len(prompts), **generation_args)
+            results = []
+            for prompt, output in zip(prompts, outputs):
+                generated = output[0]["generated_text"]
+                results.append(trim_at_stop(generated[len(prompt):] if generated.startswith(prompt) else generated, stops))
+            return results
+
+    def release(self):
+        """Detach this handler's adapter from the shared base model and drop its cached prefixes"""
+        if self.adapter_name and self.model is not None:
+            unload_lora_adapter(self.model, self.adapter_name)
+        if prefix_cache is not None:
+            prefix_cache.drop(self.prefix_namespace)
+
+class ChatHandler:
+    def __init__(self, base_model_path, device, adapter_path=None, quantization=None):
+        self.tokenizer = prepare_tokenizer_for_batching(AutoTokenizer.from_pretrained(base_model_path))
+        self.adapter_name = None
+        # Set when base-only requests are served by the resident PEFT model of base_model_path
+        self.disable_adapters = False
+        resident = None if adapter_path else resident_lora_model(base_model_path, device, quantization)
+        if adapter_path and PeftModel:
+            # Share the base model with every other adapter of base_model_path
+            self.model, self.adapter_name = load_lora_model(base_model_path, adapter_path, device)
+            self.quantization = adapter_quantization(quantization, base_model_path, adapter_path)
+        elif resident is not None:
+            print(f"Serving {base_model_path} from its resident PEFT model with adapters disabled")
+            self.model, self.quantization, self.disable_adapters = resident, None, True
+        else:
+            self.model, self.quantization = load_quantized_model(
+                AutoModelForCausalLM, base_model_path, device, quantization
+            )
+        self.device = device
+        self.adapter_path = adapter_path
+        self.base_model_path = base_model_path
+        self.prefix_namespace = (base_model_path, adapter_path)
+        self.context_length = context_length(self.tokenizer, self.model)
+        self.max_input_tokens = input_limit(self.tokenizer, self.model)
+        self.template_tokens = template_tokens(self.tokenizer, chat=True)
+        
+    @property
+    def default_generation_args(self):
+        return {
+            "max_new_tokens": 512, 
+        }
+
+    def infer(self, prompt, streamer=None, **generation_args):
+        if not generation_args:
+            generation_args = self.default_generation_args
+        eos_token_id = self.tokenizer.eos_token_id
+        generation_args.setdefault("pad_token_id", eos_token_id)
+        generation_args.setdefault("eos_token_id", eos_token_id)
+        if isinstance(prompt, str):
+            prompt = [{"role": "user", "content": prompt}]
+        inputs = self.tokenizer.apply_chat_template(
+            prompt,
+            return_tensors="pt",
+            return_dict=True,
+            add_generation_prompt=True
+        )
+        generation_args, stops = apply_stops(self.tokenizer, self.base_model_path, generation_args)
+        input_length, outputs = self._generate(inputs, generation_args, streamer=streamer)
+        result = self.tokenizer.decode(
+            outputs[0, input_length:],
+            skip_special_tokens=True
+        )
+        return trim_at_stop(result, stops)
+
+    def _generate(self, inputs, generation_args, streamer=None, adapter_names=None):
+        inputs = bucket_inputs(
+            inputs, self.model, self.tokenizer.pad_token_id, self.max_input_tokens, self.prefix_namespace
+        )
+        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+        if self.adapter_name:
+            adapter_names = adapter_names or [self.adapter_name] * inputs["input_ids"].shape[0]
+        with adapters_disabled(self.model, self.disable_adapters):
+            outputs = generate_for(
+                self.model,
+                self.prefix_namespace,
+                {"input_ids": inputs["input_ids"], "attention_mask": inputs.get("attention_mask")},
+                streamer=streamer,
+                **lora_generate_kwargs(self.model, adapter_names),
+                **generation_args
+            )
+        return inputs["input_ids"].shape[1], outputs
+
+    def infer_batch(self, prompts, streamer=None, adapter_names=None, **generation_args):
+        """
+        Run several conversations through one padded generate() call.
+        adapter_names optionally gives each prompt its own adapter of the shared base model.
+        """
+        if not generation_args:
+            generation_args = self.default_generation_args
+        eos_token_id = self.tokenizer.eos_token_id
+        generation_args.setdefault("pad_token_id", eos_token_id)
+        generation_args.setdefault("eos_token_id", eos_token_id)
+        conversations = [
+            [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+            for prompt in prompts
+        ]
+        inputs = self.tokenizer.apply_chat_template(
+            conversations,
+            return_tensors="pt",
+            return_dict=True,
+            add_generation_prompt=True,
+            padding=True
+        )
+        generation_args, stops = apply_stops(self.tokenizer, self.base_model_path, generation_args)
+        input_length, outputs = self._generate(
+            inputs, generation_args, streamer=streamer, adapter_names=adapter_names
+        )
+        return [
+            trim_at_stop(self.tokenizer.decode(output[input_length:], skip_special_tokens=True), stops)
+            for output in outputs
+        ]
+
+    def release(self):
+        """Detach this handler's adapter from the shared base model and drop its cached prefixes"""
+        if self.adapter_name and self.model is not None:
+            unload_lora_adapter(self.model, self.adapter_name)
+        if prefix_cache is not None:
+            prefix_cache.drop(self.prefix_namespace)
+
+class VisionHandler:
+    def __init__(self, base_model_path, device, quantization=None):
+        self.processor = AutoProcessor.from_pretrained(base_model_path)
+        self.quantization = None
+        if MMAP_WEIGHTS or normalize_mode(quantization):
+            # Weights go to the device tensor by tensor instead of via a full host copy
+            self.model, self.quantization = load_quantized_model(
+                AutoModelForVision2Seq, base_model_path, device, quantization, torch_dtype=None
+            )
+        else:
+            self.model = AutoModelForVision2Seq.from_pretrained(base_model_path).to(device)
+        self.device = device
+        self.base_model_path = base_model_path
+
+    @property
+    def default_generation_args(self):
+        return {
+            "max_new_tokens": 100,
+        }
+
+    def infer(self, prompt, **generation_args):
+        # prompt is the conversation format (list of dicts)
+        inputs = self.processor.apply_chat_template(
+            prompt,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt"
+        ).to(self.device)
+        tokenizer = self.processor.tokenizer
+        generation_args, stops = apply_stops(
+            tokenizer, self.base_model_path, generation_args, model_eos_token_id(self.model)
+        )
+        start_stop_criteria(generation_args.get("stopping_criteria"), inputs["input_ids"].shape[1])
+        output = self.model.generate(**inputs, **generation_args)
+        text = self.processor.decode(output[0], skip_special_tokens=True)
+        # The decoded text starts with the prompt, which may contain stop strings itself
+        prompt_text = self.processor.decode(output[0, :inputs["input_ids"].shape[1]], skip_special_tokens=True)
+        return trim_at_stop(text, stops, start=len(prompt_text))
+
+class DraftHandler:
+    """Small model that proposes tokens for assisted decoding of a larger model of its family"""
+    def __init__(self, draft_model_path, device):
+        self.model = load_model(AutoModelForCausalLM, draft_model_path, device)
+        self.base_model_path = draft_model_path
+        self.device = device
+
+def generation_model(handler):
+    """The module whose forward passes generate() runs for handler"""
+    models = handler_models(handler)
+    if not models:
+        return None
+    # A PeftModel generates through its wrapped model
+    return models[0].get_base_model() if hasattr(models[0], "get_base_model") else models[0]
+
+def count_tokens(handler, text):
+    tokenizer = getattr(handler, "tokenizer", None) or getattr(getattr(handler, "processor", None), "tokenizer", None)
+    if tokenizer is None or not text:
+        return 0
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def build_handler(base_model_path, device, adapter_path=None, quantization=None):
+    """quantization overrides the mode configured for base_model_path; "none" loads unquantized weights"""
+    if quantization is None:
+        quantization = quantization_for(base_model_path)
+    print(f"Loading model: {base_model_path}, adapter: {adapter_path} on {device}, quantization: {quantization}")
+    if is_vision_handler(base_model_path):
+        return VisionHandler(base_model_path, device, quantization)
+    elif needs_chat_handler(base_model_path):
+        return ChatHandler(base_model_path, device, adapter_path, quantization)
+    else:
+        return PipelineHandler(base_model_path, device, adapter_path, quantization)
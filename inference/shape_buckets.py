@@ -0,0 +1,84 @@
+"""
+Input-shape bucketing for graph-compiled backends.
+
+On HPU graphs and torch.compile every new input length can trigger a
+recompile. With bucketing enabled, tokenized prompts are left padded to the
+next power of two (at least ``min_length``, at most the model's maximum), so
+only a handful of shapes ever reach generate(). The padding is masked out in
+the attention mask. Single prompts served through the prefix cache are padded
+in front of their last token instead: left padding would shift a shared
+template by a different amount each time, and the part generate() prefills,
+everything after the cached prefix, is what is bucketed. Every shape passed through ``prepare`` is counted either
+way, so the number of distinct shapes can be compared with bucketing on and off.
+"""
+from collections import Counter
+
+import torch
+
+
+def bucket_length(length, min_length=16, max_length=None):
+    """Smallest power of two >= length (and >= min_length), capped at max_length"""
+    bucket = max(1, int(min_length))
+    while bucket < length:
+        bucket *= 2
+    if max_length:
+        bucket = min(bucket, max_length)
+    return max(bucket, length)
+
+
+def left_pad(inputs, length, pad_token_id, position=0):
+    """
+    Pad input_ids with pad_token_id and attention_mask with zeros up to length,
+    inserting the padding before position (at the start by default)
+    """
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs.get("attention_mask")
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    extra = length - input_ids.shape[1]
+    if extra <= 0:
+        return dict(inputs, attention_mask=attention_mask)
+
+    padded = dict(inputs)
+    padded["input_ids"] = torch.cat(
+        [input_ids[:, :position], input_ids.new_full((input_ids.shape[0], extra), pad_token_id),
+         input_ids[:, position:]], dim=1
+    )
+    padded["attention_mask"] = torch.cat(
+        [attention_mask[:, :position], attention_mask.new_zeros((attention_mask.shape[0], extra)),
+         attention_mask[:, position:]], dim=1
+    )
+    return padded
+
+
+class ShapeBuckets:
+    def __init__(self, enabled=False, min_length=16):
+        self.enabled = enabled
+        self.min_length = min_length
+        self.shapes = Counter()  # (batch size, sequence length) -> calls
+
+    def prepare(self, inputs, pad_token_id, max_length=None, prefix_length=None):
+        """
+        Pad inputs to their bucket when enabled, and record the resulting shape.
+        With prefix_length, the number of leading tokens a prefix cache holds
+        (0 when it holds none), the tokens after it are padded to their bucket
+        in front of the last token.
+        """
+        if self.enabled and prefix_length is None:
+            length = bucket_length(inputs["input_ids"].shape[1], self.min_length, max_length)
+            inputs = left_pad(inputs, length, pad_token_id)
+        elif self.enabled:
+            total = inputs["input_ids"].shape[1]
+            suffix = bucket_length(
+                total - prefix_length, self.min_length, max_length - prefix_length if max_length else None
+            )
+            inputs = left_pad(inputs, prefix_length + suffix, pad_token_id, position=total - 1)
+        self.shapes[tuple(inputs["input_ids"].shape)] += 1
+        return inputs
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "distinct_shapes": len(self.shapes),
+            "calls": sum(self.shapes.values()),
+        }
@@ -0,0 +1,85 @@
+"""
+Assisted (speculative) decoding with a small draft model per model family.
+
+A draft model proposes a few tokens which the target model verifies in a
+single forward pass. In greedy mode the output is identical to plain
+decoding; the saving comes from fewer memory-bound target passes. Draft
+models are configured per family as ``family=draft_model_path`` pairs and
+matched against the base model directory name. The draft must share the
+target's tokenizer.
+"""
+import os
+import time
+
+
+def parse_draft_models(spec):
+    """{family: draft_model_path} from a "family=path,..." string"""
+    mapping = {}
+    for item in (spec or "").split(","):
+        family, _, path = item.partition("=")
+        if family.strip() and path.strip():
+            mapping[family.strip()] = path.strip()
+    return mapping
+
+
+def draft_model_for(base_model_path, draft_models):
+    """Draft model path for base_model_path, using the longest matching family"""
+    name = os.path.basename(os.path.normpath(base_model_path)).lower()
+    matches = [family for family in draft_models if family.lower() in name]
+    if not matches:
+        return None
+    draft_path = draft_models[max(matches, key=len)]
+    if os.path.normpath(draft_path) == os.path.normpath(base_model_path):
+        return None
+    return draft_path
+
+
+class ForwardCounter:
+    """Count forward passes of a module while the context is active"""
+
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+        self._hook = None
+
+    def _count(self, module, args, output):
+        self.calls += 1
+
+    def __enter__(self):
+        self._hook = self.module.register_forward_hook(self._count)
+        return self
+
+    def __exit__(self, *exc):
+        self._hook.remove()
+        return False
+
+
+def _inner_model(model):
+    # A PeftModel runs its wrapped model's forward during generate()
+    return model.get_base_model() if hasattr(model, "get_base_model") else model
+
+
+def speculation_stats(new_tokens, target_forwards, draft_forwards, seconds):
+    """
+    Every target pass yields the draft tokens it accepted plus one of its own,
+    and every draft pass proposes one token.
+    """
+    accepted = max(new_tokens - target_forwards, 0)
+    return {
+        "new_tokens": new_tokens,
+        "target_forwards": target_forwards,
+        "draft_forwards": draft_forwards,
+        "acceptance_rate": accepted / draft_forwards if draft_forwards else 0.0,
+        "tokens_per_target_forward": new_tokens / target_forwards if target_forwards else 0.0,
+        "tokens_per_second": new_tokens / seconds if seconds > 0 else 0.0,
+    }
+
+
+def generate_with_draft(model, draft_model, inputs, **generate_kwargs):
+    """Assisted generate() for a single sequence; returns the outputs and speculation stats"""
+    with ForwardCounter(_inner_model(model)) as target, ForwardCounter(draft_model) as draft:
+        start = time.monotonic()
+        outputs = model.generate(**inputs, assistant_model=draft_model, **generate_kwargs)
+        seconds = time.monotonic() - start
+    new_tokens = outputs.shape[1] - inputs["input_ids"].shape[1]
+    return outputs, speculation_stats(new_tokens, target.calls, draft.calls, seconds)
@@ -0,0 +1,91 @@
+"""
+Startup-time benchmark of the inference consumer.
+
+Every run uses a fresh interpreter, so nothing is served from an already
+populated ``sys.modules``:
+
+- ``import``: cold import of ``inference.generic_inference``
+- ``runtime_import``: the deferred import of ``inference.runtime`` (torch,
+  transformers, peft), paid when the first handler is built
+- ``ready``: from spawning the process until ``main()`` starts consuming,
+  with an in-memory broker (``inference.local_broker``) in place of RabbitMQ
+
+Usage: python -m inference.startup_benchmark [--runs N]
+Prints a JSON report with the per-run seconds and their median.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+READY_SCRIPT = """
+import json
+from unittest.mock import patch
+from inference.local_broker import LocalConnection
+connection = LocalConnection()
+with patch("pika.BlockingConnection", return_value=connection):
+    from inference import generic_inference
+    generic_inference.main()
+print(json.dumps({"ready_at": connection.ready_at}))
+"""
+
+
+def benchmark_env():
+    """Consumer environment without metrics server, preloads or routing"""
+    env = dict(os.environ)
+    env.update(METRICS_PORT="0", PRELOAD_MODELS="", PRELOAD_MANIFEST="", MODEL_ROUTING="0")
+    return env
+
+
+def run_script(script, env):
+    output = subprocess.run(
+        [sys.executable, "-c", script], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    # Only the last line is the report; the rest is the consumer's own logging
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def time_import(module, env):
+    return run_script(IMPORT_SCRIPT.format(module=module), env)["seconds"]
+
+
+def time_to_ready(env):
+    spawned_at = time.time()
+    return run_script(READY_SCRIPT, env)["ready_at"] - spawned_at
+
+
+def summarise(samples):
+    return {"median": statistics.median(samples), "min": min(samples), "runs": samples}
+
+
+def run_benchmark(runs=5, include_runtime=True):
+    env = benchmark_env()
+    report = {
+        "import": summarise([time_import("inference.generic_inference", env) for _ in range(runs)]),
+        "ready": summarise([time_to_ready(env) for _ in range(runs)]),
+    }
+    if include_runtime:
+        report["runtime_import"] = summarise([time_import("inference.runtime", env) for _ in range(runs)])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per measurement")
+    parser.add_argument("--skip-runtime", action="store_true", help="don't time the deferred runtime import")
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.runs, include_runtime=not args.skip_runtime), indent=2))
+
+
+if __name__ == "__main__":
+    main()
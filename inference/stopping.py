@@ -0,0 +1,116 @@
+"""
+Stop sequences: where generation ends, instead of trimming afterwards.
+
+Models keep generating past their answer, into made-up user turns or a new
+``### Instruction:`` block, which the result post-processing then cuts off.
+Stop sequences end a sequence as soon as such a boundary is generated. They
+come from three places: ``DEFAULT_STOP_SEQUENCES`` for every model, per
+model family from ``STOP_SEQUENCES`` (a JSON object mapping a family, matched
+against the base model directory name, to a list of strings), and per
+request from ``generation_args`` ``stop`` (a string or list of strings) and
+``stop_token_ids``.
+
+While decoding (``runtime.StopSequenceCriteria``), each stop string's own
+token sequences are matched on the device after every step. The tokens
+generated since the last check are also decoded every ``STOP_CHECK_TOKENS``
+steps, which catches stop strings tokenized differently in context. The
+result is cut at the first stop string, and streamed text never includes it.
+A string that is one of the model's special tokens also ends the sequence
+like its end-of-sequence token. ``ANSWER_HEADERS`` open an answer
+when the output starts with them (the prompt lacked them), so there they are
+removed rather than ending the answer.
+"""
+import json
+import os
+
+# Turn boundaries the post-processing used to cut at, and common end-of-turn tokens
+DEFAULT_STOP_SEQUENCES = (
+    "<|user|>", "<|assistant|>", "### Instruction:", "### Response:", "<|eot_id|>", "<|im_end|>", "<|end|>",
+)
+# Generated text is decoded to look for stop strings every STOP_CHECK_TOKENS decode steps
+STOP_CHECK_TOKENS = int(os.environ.get("STOP_CHECK_TOKENS", "4"))
+# Headers of the answer turn: stripped at the start of the output, a boundary anywhere else
+ANSWER_HEADERS = ("<|assistant|>", "### Response:")
+
+
+def parse_stop_sequences(spec):
+    """{family: [stop strings]} from a JSON object"""
+    try:
+        mapping = json.loads(spec or "{}")
+    except ValueError as e:
+        print(f"Ignoring invalid STOP_SEQUENCES: {e}")
+        return {}
+    if not isinstance(mapping, dict):
+        print("Ignoring STOP_SEQUENCES, expected a JSON object")
+        return {}
+    return {
+        family: [stop for stop in stops if isinstance(stop, str) and stop]
+        for family, stops in mapping.items() if isinstance(stops, list)
+    }
+
+
+STOP_SEQUENCES = parse_stop_sequences(os.environ.get("STOP_SEQUENCES", ""))
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, (str, int)) else list(value)
+
+
+def stops_for(base_model_path, stop=None, stop_token_ids=None, model_stops=None):
+    """Stop strings and stop token ids for a request to base_model_path"""
+    model_stops = STOP_SEQUENCES if model_stops is None else model_stops
+    name = os.path.basename(os.path.normpath(base_model_path or "")).lower()
+    strings = list(DEFAULT_STOP_SEQUENCES)
+    for family, stops in model_stops.items():
+        if family.lower() in name:
+            strings += stops
+    strings += [s for s in _as_list(stop) if isinstance(s, str) and s]
+    token_ids = [t for t in _as_list(stop_token_ids) if isinstance(t, int) and not isinstance(t, bool)]
+    return list(dict.fromkeys(strings)), list(dict.fromkeys(token_ids))
+
+
+def answer_start(text, start=0):
+    """Offset of the answer in text output from start on, after any leading answer header"""
+    offset = len(text) - len(text[start:].lstrip())
+    for header in ANSWER_HEADERS:
+        if text.startswith(header, offset):
+            return offset + len(header)
+    return start
+
+
+def answer_started(text):
+    """Whether output text has got past any answer header to the answer itself"""
+    if not text[answer_start(text):].strip():
+        return False
+    # The output may still be spelling out a header
+    return not any(header.startswith(text.strip()) for header in ANSWER_HEADERS)
+
+
+def first_stop(text, stop_strings, start=0):
+    """Offset of the first stop string in text from start on, or None"""
+    positions = [text.find(stop, start) for stop in stop_strings]
+    positions = [position for position in positions if position >= 0]
+    return min(positions) if positions else None
+
+
+def stop_prefix_length(text, stop_strings):
+    """Length of the longest end of text that a stop string starts with"""
+    longest = 0
+    for stop in stop_strings:
+        for length in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:length]):
+                longest = length
+                break
+    return longest
+
+
+def trim_at_stop(text, stop_strings, start=0):
+    """
+    text cut at the first stop string found in the output from start on,
+    without an answer header the output starts with
+    """
+    begin = answer_start(text, start)
+    end = first_stop(text, stop_strings, begin)
+    return text[:start] + text[begin:end]
@@ -0,0 +1,98 @@
+"""
+Incremental publishing of generated text.
+
+A ChunkStreamer is handed to ``generate()`` as its ``streamer``. Decoded text
+is buffered and passed to a callback at most every ``min_interval`` seconds
+(the first chunk is emitted as soon as it is decoded). With stop strings,
+streaming ends at the first one and text that may be the start of one is held
+back until it is known not to be, so chunks add up to the trimmed result.
+StreamPublisher turns
+those chunks into numbered output-queue messages for one conversation and
+closes the stream with a ``done`` marker carrying the full result, or, when
+generation fails part way, the text streamed so far and an ``error``.
+
+Once a chunk has reached the client, a chunk the broker does not take no
+longer requeues the request, since a redelivery would stream the answer a
+second time; the ``done`` marker still carries the whole result. A request
+requeued anyway, because its ``done`` marker was not taken, is streamed again
+from a first message marked ``restart``, telling the client to drop the
+chunks it received before.
+"""
+import time
+
+from transformers import TextStreamer
+
+from inference.stopping import answer_start, answer_started, first_stop, stop_prefix_length
+
+
+class ChunkStreamer(TextStreamer):
+    def __init__(self, tokenizer, on_chunk, min_interval=0.1, stop_strings=(), **decode_kwargs):
+        decode_kwargs.setdefault("skip_special_tokens", True)
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.on_chunk = on_chunk
+        self.min_interval = min_interval
+        self.stop_strings = list(stop_strings)
+        self._text = ""
+        self._sent = 0
+        self._stopped = False
+        self._last_emit = None
+
+    def on_finalized_text(self, text, stream_end=False):
+        if self._stopped:
+            return
+        self._text += text
+        end = len(self._text)
+        if self.stop_strings:
+            if not answer_started(self._text) and not stream_end:
+                return
+            self._sent = max(self._sent, answer_start(self._text))
+            stop = first_stop(self._text, self.stop_strings, self._sent)
+            if stop is not None:
+                end, self._stopped = stop, True
+            elif not stream_end:
+                end -= stop_prefix_length(self._text, self.stop_strings)
+        now = time.monotonic()
+        due = self._last_emit is None or now - self._last_emit >= self.min_interval
+        if end > self._sent and (due or stream_end or self._stopped):
+            self.on_chunk(self._text[self._sent:end])
+            self._sent = end
+            self._last_emit = now
+
+
+class StreamPublisher:
+    def __init__(self, publish, conversation_id, restart=False):
+        """
+        publish(message, requeue) is called with each message dict to send to
+        the output queue and returns False if the broker did not take it; with
+        requeue the request is then requeued. restart marks a redelivered
+        request, whose first message tells the client to start over.
+        """
+        self.publish = publish
+        self.conversation_id = conversation_id
+        self.restart = restart
+        self.sequence = 0
+        self.streamed = False
+        # Text of the chunks sent so far
+        self.text = ""
+
+    def _send(self, requeue, **fields):
+        message = {
+            "conversation_id": self.conversation_id,
+            "sequence": self.sequence,
+            **fields,
+        }
+        if self.restart and self.sequence == 0:
+            message["restart"] = True
+        self.sequence += 1
+        return self.publish(message, requeue) is not False
+
+    def chunk(self, text):
+        self.text += text
+        if self._send(not self.streamed, chunk=text, done=False):
+            self.streamed = True
+
+    def done(self, result, error=None):
+        if error:
+            self._send(True, result=result, error=error, done=True)
+        else:
+            self._send(True, result=result, done=True)
@@ -0,0 +1,213 @@
+"""
+Supervisor running one inference worker process per device.
+
+Every worker is a separate ``generic_inference`` process with its own handler
+cache and RabbitMQ consumer on the shared input queue, so messages are spread
+across devices by the broker. Devices are configured with ``INFERENCE_DEVICES``
+as a comma separated list such as ``hpu:0,hpu:1`` or ``cuda:0,cuda:1``; each
+worker only sees its own card. HPU workers are pinned with
+``HABANA_VISIBLE_MODULES``, so ``hpu:N`` names the card with module id N (as
+listed by ``hl-smi -Q module_id``) among the cards the container runtime
+exposes through ``HABANA_VISIBLE_DEVICES``, which is left as it is. Worker i
+serves its metrics on ``METRICS_PORT`` + i; with ``METRICS_TARGETS_FILE`` the
+supervisor writes those endpoints as a Prometheus file based service discovery
+target list. ``cpu`` runs ``INFERENCE_WORKERS`` CPU workers.
+Without ``INFERENCE_DEVICES`` a single worker runs with the inherited
+environment. With ``MODEL_ROUTING`` the supervisor also runs the model
+affinity router in front of the workers. Processes that exit are restarted
+with exponential backoff.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+INFERENCE_DEVICES = os.environ.get("INFERENCE_DEVICES", "")
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "0").lower() in ("1", "true", "yes")
+WORKER_COMMAND = [sys.executable, "-u", "-m", "inference.generic_inference"]
+ROUTER_COMMAND = [sys.executable, "-u", "-m", "inference.router"]
+RESTART_BACKOFF_S = float(os.environ.get("WORKER_RESTART_BACKOFF_S", "1"))
+RESTART_BACKOFF_MAX_S = float(os.environ.get("WORKER_RESTART_BACKOFF_MAX_S", "60"))
+# A worker that stayed up this long has its backoff reset after a crash
+WORKER_STABLE_S = float(os.environ.get("WORKER_STABLE_S", "300"))
+SHUTDOWN_GRACE_S = float(os.environ.get("WORKER_SHUTDOWN_GRACE_S", "30"))
+# Prometheus file_sd target list of the workers' metrics endpoints
+METRICS_TARGETS_FILE = os.environ.get("METRICS_TARGETS_FILE", "")
+METRICS_TARGETS_HOST = os.environ.get("METRICS_TARGETS_HOST", "localhost")
+
+# Per-process card selection; the habana runtime already restricted the container by HABANA_VISIBLE_DEVICES
+VISIBLE_DEVICES_VARS = {
+    "hpu": "HABANA_VISIBLE_MODULES",
+    "cuda": "CUDA_VISIBLE_DEVICES",
+}
+
+
+def parse_devices(spec, cpu_workers=1):
+    """Device strings from "hpu:0,hpu:1"; a lone "cpu" expands to cpu_workers entries"""
+    devices = [d.strip() for d in (spec or "").split(",") if d.strip()]
+    if devices == ["cpu"]:
+        return ["cpu"] * max(1, cpu_workers)
+    return devices
+
+
+def worker_env(device, index, base_env=None, cpu_threads=None):
+    """
+    Environment of the worker for device, restricted to that single card.
+    CPU workers get cpu_threads threads each unless OMP_NUM_THREADS is set.
+    """
+    env = dict(os.environ if base_env is None else base_env)
+    env["WORKER_ID"] = str(index)
+    if device is None:
+        return env
+    kind, _, card = device.partition(":")
+    env["INFERENCE_DEVICE"] = kind
+    if card and kind in VISIBLE_DEVICES_VARS:
+        env[VISIBLE_DEVICES_VARS[kind]] = card
+    if kind == "cpu" and cpu_threads and "OMP_NUM_THREADS" not in env:
+        env["OMP_NUM_THREADS"] = str(cpu_threads)
+    # Every worker serves its metrics on its own port
+    metrics_port = int(env.get("METRICS_PORT", "0") or 0)
+    if metrics_port:
+        env["METRICS_PORT"] = str(metrics_port + index)
+    return env
+
+
+def metrics_targets(workers, host=METRICS_TARGETS_HOST):
+    """Prometheus file_sd entries for the workers that serve metrics"""
+    targets = []
+    for worker in workers:
+        port = worker.env.get("METRICS_PORT")
+        if worker.command is None and port and port != "0":
+            targets.append({
+                "targets": [f"{host}:{port}"],
+                "labels": {"worker": str(worker.index), "device": worker.device or "default"},
+            })
+    return targets
+
+
+def write_metrics_targets(path, workers, host=METRICS_TARGETS_HOST):
+    """Replace the target list at path atomically, so Prometheus never reads a partial file"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(metrics_targets(workers, host), f, indent=2)
+    os.replace(tmp, path)
+
+
+@dataclass
+class Worker:
+    index: int
+    device: Optional[str]
+    env: Dict[str, str]
+    process: Optional[subprocess.Popen] = None
+    started_at: float = 0.0
+    restarts: int = 0
+    backoff: float = 0.0
+    next_start: float = 0.0
+    # Overrides the supervisor's worker command, e.g. for the router
+    command: Optional[List[str]] = None
+
+    @property
+    def name(self):
+        if self.command is not None:
+            return os.path.basename(self.command[-1])
+        return f"worker {self.index} on {self.device or 'default device'}"
+
+
+class WorkerSupervisor:
+    def __init__(self, devices, command=None, base_env=None, backoff=RESTART_BACKOFF_S,
+                 max_backoff=RESTART_BACKOFF_MAX_S, stable_after=WORKER_STABLE_S, router_command=None):
+        """
+        devices is a list of device strings, or [None] for one worker with the
+        inherited environment. router_command adds a supervised router process.
+        """
+        self.command = command or WORKER_COMMAND
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        # CPU workers split the cores between them instead of all using every core
+        cpu_workers = sum(1 for device in devices if device == "cpu")
+        cpu_threads = max(1, (os.cpu_count() or 1) // cpu_workers) if cpu_workers else None
+        self.workers: List[Worker] = [
+            Worker(index, device, worker_env(device, index, base_env, cpu_threads))
+            for index, device in enumerate(devices)
+        ]
+        if router_command:
+            env = dict(os.environ if base_env is None else base_env)
+            self.workers.append(Worker(len(self.workers), None, env, command=router_command))
+        self.stopping = False
+
+    def _start(self, worker):
+        worker.process = subprocess.Popen(worker.command or self.command, env=worker.env)
+        worker.started_at = time.monotonic()
+        print(f"Started {worker.name} (pid {worker.process.pid})")
+
+    def poll(self):
+        """Start workers that are due and schedule restarts of the ones that exited"""
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process is None:
+                if not self.stopping and now >= worker.next_start:
+                    self._start(worker)
+                continue
+            code = worker.process.poll()
+            if code is None or self.stopping:
+                continue
+            uptime = now - worker.started_at
+            if uptime >= self.stable_after:
+                worker.backoff = 0.0
+            worker.backoff = min(self.max_backoff, worker.backoff * 2 or self.initial_backoff)
+            worker.next_start = now + worker.backoff
+            worker.restarts += 1
+            worker.process = None
+            print(
+                f"{worker.name.capitalize()} exited with code {code} "
+                f"after {uptime:.0f}s, restarting in {worker.backoff:.0f}s"
+            )
+
+    def stop(self, grace=SHUTDOWN_GRACE_S):
+        """Terminate all workers, killing those still running after grace seconds"""
+        self.stopping = True
+        running = [w.process for w in self.workers if w.process is not None and w.process.poll() is None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + grace
+        for process in running:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def run(self, interval=1.0):
+        def on_signal(signum, frame):
+            print(f"Received signal {signum}, stopping workers")
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+        try:
+            while not self.stopping:
+                self.poll()
+                time.sleep(interval)
+        finally:
+            self.stop()
+
+
+def main():
+    devices = parse_devices(INFERENCE_DEVICES, INFERENCE_WORKERS) or [None]
+    print(f"Supervising {len(devices)} inference worker(s): {', '.join(d or 'default device' for d in devices)}")
+    supervisor = WorkerSupervisor(devices, router_command=ROUTER_COMMAND if MODEL_ROUTING else None)
+    if METRICS_TARGETS_FILE:
+        write_metrics_targets(METRICS_TARGETS_FILE, supervisor.workers)
+        print(f"Wrote metrics targets of the workers to {METRICS_TARGETS_FILE}")
+    supervisor.run()
+
+
+if __name__ == "__main__":
+    main()
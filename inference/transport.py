@@ -0,0 +1,191 @@
+"""
+RabbitMQ publishing and acknowledgement for the consumers.
+
+Results are published with publisher confirms, so a result the broker did not
+take is noticed instead of lost: the request it answers is then rejected and
+requeued rather than acknowledged. Acknowledgements of completed requests are
+coalesced into one ``basic_ack(multiple=True)`` covering every delivery tag up
+to the highest one whose request, and all requests delivered before it, have
+completed. Acks are deferred while other requests of the channel are in
+progress (for a sequential consumer, while more may follow) and flushed once
+``ack_batch`` requests are waiting, once the prefetch window is full, or
+``ack_interval`` seconds after the first waiting one, whichever comes first.
+
+Results are published as mandatory, so one the broker cannot route to any
+queue (its queue was deleted or never declared) fails like a rejected one
+instead of being dropped; pika only reports unroutable messages for mandatory
+publishes. On a ``BlockingConnection`` a confirmed publish waits for the broker's
+confirm, so its duration is the broker round trip; those round trips are
+recorded and reported by ``stats()``.
+"""
+import bisect
+import os
+import time
+from collections import deque
+
+from pika.exceptions import NackError, UnroutableError
+
+PUBLISHER_CONFIRMS = os.environ.get("PUBLISHER_CONFIRMS", "1").lower() in ("1", "true", "yes")
+ACK_BATCH_SIZE = int(os.environ.get("ACK_BATCH_SIZE", "16"))
+ACK_FLUSH_MS = float(os.environ.get("ACK_FLUSH_MS", "20"))
+# Round trips kept for the latency percentiles in stats()
+ROUND_TRIP_WINDOW = 1024
+
+
+class ChannelAcks:
+    """Delivery tags of one channel that are in progress or completed but not yet acknowledged"""
+    def __init__(self, channel):
+        self.channel = channel
+        self.in_progress = []
+        self.completed = []
+        self.unconfirmed = set()
+
+
+class Transport:
+    def __init__(self, connection=None, confirms=PUBLISHER_CONFIRMS, ack_batch=ACK_BATCH_SIZE,
+                 ack_interval=ACK_FLUSH_MS / 1000.0, prefetch_count=0, sequential=False, on_round_trip=None):
+        """
+        connection provides call_later for delayed ack flushes; without one
+        acks are flushed as soon as requests complete. A sequential consumer
+        finishes each message before the next is delivered, so its acks are
+        deferred even when no other request is in progress. on_round_trip(seconds)
+        is called with every measured broker round trip.
+        """
+        self.connection = connection
+        self.confirms = confirms
+        self.ack_batch = max(1, ack_batch)
+        self.ack_interval = ack_interval
+        self.prefetch_count = prefetch_count
+        self.sequential = sequential
+        self.on_round_trip = on_round_trip
+        self.channels = {}
+        self.round_trips = deque(maxlen=ROUND_TRIP_WINDOW)
+        self.published = 0
+        self.publish_failures = 0
+        self.acked = 0
+        self.ack_frames = 0
+        self.requeued = 0
+        self._flush_timer = None
+
+    def _acks(self, channel):
+        acks = self.channels.get(id(channel))
+        if acks is None:
+            acks = self.channels[id(channel)] = ChannelAcks(channel)
+            if self.confirms:
+                channel.confirm_delivery()
+        return acks
+
+    def open(self, channel):
+        """Prepare channel for publishing, enabling publisher confirms on it"""
+        self._acks(channel)
+        return channel
+
+    def delivered(self, channel, delivery_tag):
+        """Register a request received on channel, to be settled once it has been answered"""
+        bisect.insort(self._acks(channel).in_progress, delivery_tag)
+
+    def publish(self, channel, routing_key, body, exchange="", delivery_tag=None, properties=None, mandatory=True):
+        """
+        Publish body. Returns False if the broker rejected it or, when mandatory,
+        could not route it; the request delivery_tag answers is then requeued
+        instead of acknowledged. Broadcasts that may have no listener, such as
+        status updates, are published with mandatory=False.
+        """
+        start = time.monotonic()
+        try:
+            channel.basic_publish(
+                exchange=exchange, routing_key=routing_key, body=body, properties=properties, mandatory=mandatory
+            )
+        except (NackError, UnroutableError) as e:
+            self.publish_failures += 1
+            print(f"Broker did not confirm publish to {routing_key or exchange}: {e}")
+            if delivery_tag is not None:
+                self._acks(channel).unconfirmed.add(delivery_tag)
+            return False
+        self.published += 1
+        if self.confirms:
+            seconds = time.monotonic() - start
+            self.round_trips.append(seconds)
+            if self.on_round_trip is not None:
+                self.on_round_trip(seconds)
+        return True
+
+    def settle(self, channel, delivery_tags):
+        """Mark requests as done; their acks are sent now or with a later batch"""
+        acks = self._acks(channel)
+        for tag in delivery_tags:
+            if tag in acks.in_progress:
+                acks.in_progress.remove(tag)
+            if tag in acks.unconfirmed:
+                acks.unconfirmed.discard(tag)
+                channel.basic_nack(delivery_tag=tag, requeue=True)
+                self.requeued += 1
+            else:
+                bisect.insort(acks.completed, tag)
+        self._maybe_flush(acks)
+
+    def _maybe_flush(self, acks):
+        waiting = len(acks.completed)
+        if not waiting:
+            return
+        # Deferring only pays off while other requests may complete shortly
+        idle = not acks.in_progress and not self.sequential
+        window_full = self.prefetch_count and waiting + len(acks.in_progress) >= self.prefetch_count
+        if idle or waiting >= self.ack_batch or window_full or self.connection is None or not self.ack_interval:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = self.connection.call_later(self.ack_interval, self._on_flush_timer)
+
+    def _on_flush_timer(self):
+        self._flush_timer = None
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        """
+        Acknowledge completed requests. With multiple=True a tag also covers
+        every earlier tag, so one ack spans completed tags below the oldest
+        request still in progress; the others are acked one by one when forced.
+        """
+        for acks in self.channels.values():
+            if not acks.completed:
+                continue
+            oldest = acks.in_progress[0] if acks.in_progress else None
+            covered = bisect.bisect_left(acks.completed, oldest) if oldest is not None else len(acks.completed)
+            if covered == 1:
+                acks.channel.basic_ack(delivery_tag=acks.completed[0])
+            elif covered > 1:
+                acks.channel.basic_ack(delivery_tag=acks.completed[covered - 1], multiple=True)
+            if covered:
+                self.ack_frames += 1
+                self.acked += covered
+            rest = acks.completed[covered:]
+            if force:
+                for tag in rest:
+                    acks.channel.basic_ack(delivery_tag=tag)
+                self.ack_frames += len(rest)
+                self.acked += len(rest)
+                rest = []
+            acks.completed = rest
+            if rest and self.connection is not None and self._flush_timer is None:
+                self._flush_timer = self.connection.call_later(self.ack_interval, self._on_flush_timer)
+
+    def stats(self):
+        round_trips = sorted(self.round_trips)
+
+        def percentile(p):
+            return round_trips[min(len(round_trips) - 1, int(p / 100 * len(round_trips)))] * 1000
+
+        stats = {
+            "published": self.published,
+            "publish_failures": self.publish_failures,
+            "acked": self.acked,
+            "ack_frames": self.ack_frames,
+            "requeued": self.requeued,
+        }
+        if round_trips:
+            stats.update(
+                round_trip_ms_p50=round(percentile(50), 3),
+                round_trip_ms_p99=round(percentile(99), 3),
+                round_trip_ms_mean=round(sum(round_trips) / len(round_trips) * 1000, 3),
+            )
+        return stats
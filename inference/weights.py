@@ -0,0 +1,106 @@
+"""
+Memory-mapped loading of safetensors checkpoints.
+
+Each shard is mapped copy-on-write and its tensors are views of the mapping,
+so reading a checkpoint fills the OS page cache rather than private process
+memory. Processes loading the same model (inference workers on one host, the
+fine-tune service) share those pages instead of each holding a copy. On CPU,
+tensors already in the target dtype are used in place; otherwise each tensor
+is converted or moved to the device on its own, so at most one tensor is
+copied through host memory at a time.
+"""
+import json
+import mmap
+import os
+
+import torch
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+for _name, _dtype in (("F8_E4M3", "float8_e4m3fn"), ("F8_E5M2", "float8_e5m2")):
+    if hasattr(torch, _dtype):
+        SAFETENSORS_DTYPES[_name] = getattr(torch, _dtype)
+
+
+def safetensors_shards(model_dir):
+    """Shard files of a safetensors checkpoint directory, [] when it has none"""
+    index_path = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    single = os.path.join(model_dir, "model.safetensors")
+    return [single] if os.path.isfile(single) else []
+
+
+def mmap_safetensors(path):
+    """
+    Tensors of one safetensors file as views of a copy-on-write mapping.
+    The mapping stays open for as long as any of the tensors is alive.
+    """
+    with open(path, "rb") as f:
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) if os.fstat(f.fileno()).st_size else None
+    data_start = 8 + header_length
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise ValueError(f"Unsupported safetensors dtype {info['dtype']} for {name} in {path}")
+        begin, end = info["data_offsets"]
+        shape = info["shape"]
+        if end == begin:
+            tensors[name] = torch.empty(shape, dtype=dtype)
+            continue
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + begin).view(shape)
+    return tensors
+
+
+def mmap_state_dict(model_dir, dtype=None, device="cpu"):
+    """
+    State dict of a checkpoint directory backed by the page cache. Tensors are
+    moved to device and floating point tensors cast to dtype one at a time;
+    CPU tensors already in dtype are not copied at all.
+    """
+    state_dict = {}
+    for shard in safetensors_shards(model_dir):
+        for name, tensor in mmap_safetensors(shard).items():
+            target_dtype = dtype if dtype is not None and tensor.is_floating_point() else tensor.dtype
+            state_dict[name] = tensor.to(device=device, dtype=target_dtype)
+    return state_dict
+
+
+def load_pretrained_mmap(model_class, model_dir, torch_dtype=torch.bfloat16, device_map=None, **kwargs):
+    """
+    model_class.from_pretrained(model_dir) with its weights read through
+    mmap_state_dict. Directories without safetensors shards load as usual.
+    """
+    if not safetensors_shards(model_dir):
+        print(f"No safetensors shards in {model_dir}, loading without memory mapping")
+        return model_class.from_pretrained(model_dir, torch_dtype=torch_dtype, device_map=device_map, **kwargs)
+    from transformers import AutoConfig
+
+    device = device_map if isinstance(device_map, str) else "cpu"
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=kwargs.get("trust_remote_code", False))
+    return model_class.from_pretrained(
+        None,
+        config=config,
+        state_dict=mmap_state_dict(model_dir, dtype=torch_dtype, device=device),
+        torch_dtype=torch_dtype,
+        device_map=device_map,
+        **dict(kwargs, low_cpu_mem_usage=True),
+    )
@@ -2,6 +2,9 @@ from typing import List, Dict, Optional
 from transformers import pipeline
 import pika
 import json
+import time
+from inference.batching import PRIORITY_CLASSES, class_queue, priority_of
+from inference.transport import ACK_BATCH_SIZE, Transport
 
 ### some code here to load the user input and model they selected
 
@@ -69,6 +72,8 @@ def main():
     rabbitmq_pass = "guest"
     input_queue = "user_prompts"
     output_queue = 'engineered_prompt'
+    # Each priority class has its own queue; bulk jobs are consumed after interactive traffic
+    output_queues = [class_queue(output_queue, priority) for priority in PRIORITY_CLASSES]
     rag_queue = 'rag_prompt'
     credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
     connection = pika.BlockingConnection(
@@ -80,10 +85,17 @@ def main():
     )
     channel = connection.channel()
     channel.queue_declare(queue=input_queue, durable=True)
-    channel.queue_declare(queue=output_queue, durable=True)
+    for queue in output_queues:
+        channel.queue_declare(queue=queue, durable=True)
     channel.queue_declare(queue=rag_queue, durable=True)
+    # Messages are handled one at a time; prefetching beyond one ack batch lets acks be coalesced
+    prefetch_count = 2 * ACK_BATCH_SIZE
+    channel.basic_qos(prefetch_count=prefetch_count)
+    transport = Transport(connection, prefetch_count=prefetch_count, sequential=True)
+    transport.open(channel)
 
     def on_message(ch, method, properties, body):
+        transport.delivered(ch, method.delivery_tag)
         try:
             msg = json.loads(body)
 
@@ -105,7 +117,6 @@ def main():
 
             if not orig_prompt:
                 print("No user prompt found.")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
                 return
 
             # Apply prompt engineering
@@ -131,24 +142,21 @@ def main():
                     break
 
 
+            # Lets the inference service measure time spent queued
+            msg.setdefault("enqueued_at", time.time())
+
             # Send updated message to output queue
             if rag:
-                ch.basic_publish(
-                        exchange='',
-                        routing_key=rag_queue,
-                        body=json.dumps(msg)
-                        )
+                routing_key = rag_queue
             else:
-                ch.basic_publish(
-                        exchange='',
-                        routing_key=output_queue,
-                        body=json.dumps(msg)
-                        )
-            print(f"✅ Processed and published for conversation_id={msg.get('conversation_id')}")
+                routing_key = class_queue(output_queue, priority_of(msg))
+            if transport.publish(ch, routing_key, json.dumps(msg), delivery_tag=method.delivery_tag):
+                print(f"✅ Processed and published for conversation_id={msg.get('conversation_id')}")
         except Exception as e:
             print("❌ Error processing message:", e)
         finally:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            # Acked with later messages, or requeued if the broker rejected the publish
+            transport.settle(ch, [method.delivery_tag])
 
 
     channel.basic_consume(
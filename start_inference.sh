@@ -1,3 +1,3 @@
 #!/bin/bash
 set -euo pipefail
-exec python -u inference/generic_inference.py
+exec python -u -m inference.supervisor
@@ -1,2 +1,5 @@
 #!/bin/bash
-python prompt-eng/cot_1.py
\ No newline at end of file
+set -euo pipefail
+# cot_1.py publishes through the shared inference.transport module
+export PYTHONPATH="$(pwd)${PYTHONPATH:+:$PYTHONPATH}"
+exec python -u prompt-eng/cot_1.py
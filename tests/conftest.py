@@ -2,4 +2,75 @@
 import os
 # Ensure consumer loops don't start during unit tests
 os.environ.setdefault("DISABLE_MQ", "1")
+# No metrics HTTP server for consumers started in tests
+os.environ.setdefault("METRICS_PORT", "0")
 
+import pytest
+
+TINY_VOCAB = ["<pad>", "<unk>", "<s>", "</s>"] + [f"w{i}" for i in range(60)] + [
+    "hello", "world", "patient", "summary", "the", "a", "is", "and", "user", "assistant", ":",
+]
+TINY_CHAT_TEMPLATE = (
+    "{% for m in messages %}{{ m['role'] }} : {{ m['content'] }} {% endfor %}"
+    "{% if add_generation_prompt %}assistant : {% endif %}"
+)
+
+
+def build_tiny_tokenizer():
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {tok: i for i, tok in enumerate(TINY_VOCAB)}
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>", eos_token="</s>", unk_token="<unk>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    tokenizer.chat_template = TINY_CHAT_TEMPLATE
+    return tokenizer
+
+
+def build_tiny_model(seed=0):
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(TINY_VOCAB), hidden_size=32, intermediate_size=64,
+        num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4,
+        max_position_embeddings=256, bos_token_id=2, eos_token_id=3, pad_token_id=0,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture
+def tiny_tokenizer():
+    """Word-level tokenizer with a minimal chat template, built offline."""
+    return build_tiny_tokenizer()
+
+
+@pytest.fixture
+def tiny_loading():
+    """
+    Route the inference handlers' from_pretrained/pipeline calls to the tiny
+    model and tokenizer. Yields the list of model paths that were loaded.
+    """
+    from unittest.mock import patch
+    from transformers import pipeline
+
+    loads = []
+
+    def load_model(path, **kwargs):
+        loads.append(path)
+        return build_tiny_model()
+
+    def load_pipeline(task, model=None, **kwargs):
+        loads.append(model)
+        return pipeline(task, model=build_tiny_model(), tokenizer=build_tiny_tokenizer(), device="cpu")
+
+    with patch("inference.runtime.AutoModelForCausalLM.from_pretrained", side_effect=load_model), \
+         patch("inference.runtime.AutoTokenizer.from_pretrained", side_effect=lambda *a, **k: build_tiny_tokenizer()), \
+         patch("inference.runtime.hf_pipeline", side_effect=load_pipeline):
+        yield loads
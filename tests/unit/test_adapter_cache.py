@@ -0,0 +1,82 @@
+import os
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from inference import adapter_cache
+from inference.adapter_cache import prepare_adapter
+from tests.unit.test_multi_lora import save_adapter
+
+
+def compiled_adapter(path, seed=1):
+    """Adapter saved the way torch.compile'd training writes it"""
+    save_adapter(path, seed)
+    weights_path = os.path.join(path, "adapter_model.safetensors")
+    weights = load_file(weights_path)
+    save_file({k.replace("base_model.model.", "base_model.model._orig_mod.", 1): v for k, v in weights.items()}, weights_path)
+    return str(path), weights
+
+
+def test_native_adapter_is_used_as_is(tmp_path):
+    path = save_adapter(tmp_path / "native", 1)
+    assert prepare_adapter(path) == path
+    assert not (tmp_path / "native" / "peft_native").exists()
+
+
+def test_compiled_adapter_is_converted_once(tmp_path):
+    path, original = compiled_adapter(tmp_path / "compiled")
+    converted = prepare_adapter(path)
+    assert converted == os.path.join(path, "peft_native")
+
+    converted_file = os.path.join(converted, "adapter_model.safetensors")
+    weights = load_file(converted_file)
+    assert weights.keys() == original.keys()
+    assert all(torch.equal(weights[k], original[k]) for k in original)
+    with safe_open(converted_file, framework="pt") as f:
+        assert f.metadata()["source_sha256"] == adapter_cache.file_sha256(os.path.join(path, "adapter_model.safetensors"))
+
+    mtime = os.stat(converted_file).st_mtime_ns
+    assert prepare_adapter(path) == converted
+    assert os.stat(converted_file).st_mtime_ns == mtime
+
+
+def test_changed_source_is_reconverted(tmp_path):
+    path, _ = compiled_adapter(tmp_path / "compiled", seed=1)
+    prepare_adapter(path)
+    _, updated = compiled_adapter(tmp_path / "compiled", seed=2)
+    converted = prepare_adapter(path)
+    weights = load_file(os.path.join(converted, "adapter_model.safetensors"))
+    assert all(torch.equal(weights[k], updated[k]) for k in updated)
+
+
+def test_conversion_missing_its_config_is_redone(tmp_path):
+    path, _ = compiled_adapter(tmp_path / "compiled")
+    converted = prepare_adapter(path)
+    # A conversion interrupted before its config was in place
+    os.remove(os.path.join(converted, "adapter_config.json"))
+    assert prepare_adapter(path) == converted
+    with open(os.path.join(converted, "adapter_config.json")) as f, open(os.path.join(path, "adapter_config.json")) as g:
+        assert f.read() == g.read()
+    assert not [name for name in os.listdir(converted) if name.endswith(".tmp")]
+
+
+def test_changed_source_config_is_reconverted(tmp_path):
+    path, _ = compiled_adapter(tmp_path / "compiled")
+    converted = prepare_adapter(path)
+    with open(os.path.join(path, "adapter_config.json"), "a") as f:
+        f.write("\n")
+    prepare_adapter(path)
+    with open(os.path.join(converted, "adapter_config.json")) as f:
+        assert f.read().endswith("\n")
+
+
+def test_converted_adapter_loads_without_remapping(tmp_path, tiny_loading):
+    from inference.generic_inference import PipelineHandler
+
+    path, original = compiled_adapter(tmp_path / "compiled")
+    handler = PipelineHandler("tiny-base", "cpu", path)
+    state = handler.model.state_dict()
+    for key, value in original.items():
+        model_key = key.replace(".weight", f".{handler.adapter_name}.weight")
+        assert torch.equal(state[model_key], value)
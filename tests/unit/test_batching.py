@@ -0,0 +1,78 @@
+import types
+from unittest.mock import MagicMock
+
+from inference.batching import BatchScheduler, batch_key
+
+
+def msg(model="m", adapter=None, args=None, cid="c"):
+    m = {"conversation_id": cid, "base_model_path": model, "input": [{"role": "user", "content": "hi"}]}
+    if adapter:
+        m["adapter_path"] = adapter
+    if args is not None:
+        m["generation_args"] = args
+    return m
+
+
+def method(tag):
+    return types.SimpleNamespace(delivery_tag=tag)
+
+
+def test_batch_key_ignores_argument_order():
+    a = msg(args={"max_new_tokens": 8, "do_sample": False})
+    b = msg(args={"do_sample": False, "max_new_tokens": 8})
+    assert batch_key(a) == batch_key(b)
+    assert batch_key(a) != batch_key(msg(adapter="/models/x", args={"max_new_tokens": 8, "do_sample": False}))
+
+
+def test_flushes_when_batch_is_full():
+    groups = []
+    conn = MagicMock()
+    s = BatchScheduler(groups.append, max_batch_size=3, max_wait=1.0, connection=conn)
+    s.submit("ch", method(1), None, msg(cid="1"))
+    s.submit("ch", method(2), None, msg(cid="2"))
+    assert groups == []
+    conn.call_later.assert_called_once()
+    s.submit("ch", method(3), None, msg(cid="3"))
+    assert [[p.message["conversation_id"] for p in g] for g in groups] == [["1", "2", "3"]]
+    conn.remove_timeout.assert_called_once()
+
+
+def test_timer_flushes_partial_batch_grouped_by_model():
+    groups = []
+    conn = MagicMock()
+    s = BatchScheduler(groups.append, max_batch_size=8, max_wait=0.05, connection=conn)
+    s.submit("ch", method(1), None, msg(model="a", cid="1"))
+    s.submit("ch", method(2), None, msg(model="b", cid="2"))
+    s.submit("ch", method(3), None, msg(model="a", cid="3"))
+    wait, callback = conn.call_later.call_args[0]
+    assert wait == 0.05
+    callback()
+    assert sorted([p.message["conversation_id"] for p in g] for g in groups) == [["1", "3"], ["2"]]
+    assert s.pending == []
+
+
+def test_without_connection_every_message_is_processed_immediately():
+    groups = []
+    s = BatchScheduler(groups.append, max_batch_size=4)
+    s.submit("ch", method(1), None, msg())
+    assert len(groups) == 1
+
+
+def test_pipeline_handler_batch_matches_single(tiny_loading):
+    from inference.generic_inference import PipelineHandler
+
+    ph = PipelineHandler("tiny", "cpu")
+    args = {"max_new_tokens": 5, "min_new_tokens": 5, "do_sample": False}
+    prompts = ["hello world", "the patient is w1 w2 w3 and w4"]
+    batched = ph.infer_batch(prompts, **args)
+    assert batched == [ph.infer(p, **args) for p in prompts]
+
+
+def test_chat_handler_batch_matches_single(tiny_loading):
+    from inference.generic_inference import ChatHandler
+
+    ch = ChatHandler("tiny-instruct", "cpu")
+    args = {"max_new_tokens": 4, "min_new_tokens": 4, "do_sample": False}
+    prompts = ["hello", "patient summary w5 w6 w7"]
+    batched = ch.infer_batch(prompts, **args)
+    assert batched == [ch.infer(p, **dict(args)) for p in prompts]
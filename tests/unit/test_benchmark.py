@@ -0,0 +1,31 @@
+import pytest
+
+from inference.benchmark import percentiles, run_benchmark
+
+WORKLOAD = {
+    "requests": 12,
+    "models": [{"name": "tiny-instruct", "weight": 1, "hidden_size": 32}, {"name": "tiny-base", "weight": 1, "hidden_size": 32}],
+    "prompt_words": [{"words": 4}, {"words": 24}],
+    "attachment_ratio": 0.5,
+    "attachment_words": 50,
+    "max_new_tokens": 4,
+    "max_batch_size": 4,
+}
+
+
+def test_percentiles_nearest_rank():
+    stats = percentiles([float(n) for n in range(1, 101)])
+    assert (stats["p50"], stats["p95"], stats["p99"], stats["max"]) == (50.0, 95.0, 99.0, 100.0)
+    assert percentiles([]) == {}
+
+
+@pytest.mark.parametrize("rate", [0, 200])
+def test_benchmark_serves_whole_workload(tmp_path, rate):
+    report = run_benchmark(dict(WORKLOAD, rate=rate), model_dir=str(tmp_path))
+
+    assert report["completed"] == WORKLOAD["requests"] and report["errors"] == 0
+    assert 0 < report["latency_seconds"]["p50"] <= report["latency_seconds"]["p99"] <= report["wall_seconds"]
+    assert set(report["latency_seconds_by_model"]) == {"tiny-instruct", "tiny-base"}
+    assert report["tokens_per_second"] > 0
+    # Every model is loaded once and then served from the handler cache
+    assert report["handler_loads"] == {"tiny-instruct": 1, "tiny-base": 1}
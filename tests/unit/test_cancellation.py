@@ -0,0 +1,117 @@
+import json
+import time
+from unittest.mock import MagicMock, patch
+
+from prometheus_client import CollectorRegistry
+
+from inference import generic_inference
+from inference.cancellation import CancellationRegistry, CancelListener, parse_cancellation
+from inference.metrics import InferenceMetrics
+
+ARGS = {"max_new_tokens": 12, "min_new_tokens": 12, "do_sample": False}
+
+
+def sample(registry, name, **labels):
+    return registry.get_sample_value(name, labels)
+
+
+def test_only_earlier_requests_are_cancelled():
+    registry = CancellationRegistry(ttl=60)
+    now = time.time()
+    registry.cancel("c1", cancelled_at=now)
+    assert registry.cancelled("c1", now - 1)
+    assert not registry.cancelled("c1", now + 1)
+    assert not registry.cancelled("c2", now - 1)
+
+    registry.cancel("old", cancelled_at=now - 120)
+    registry.cancel("c3")
+    assert "old" not in registry._cancelled
+
+
+def test_parse_cancellation():
+    assert parse_cancellation(b'{"conversation_id": "c1", "cancelled_at": 5}') == ("c1", 5)
+    assert parse_cancellation(b'{"conversation_id": 7}') == (7, None)
+    assert parse_cancellation(b"[]") is None and parse_cancellation(b"nope") is None
+
+
+def test_listener_records_cancellations():
+    registry = CancellationRegistry()
+    listener = CancelListener(registry, connect=MagicMock(), exchange="cancel")
+    listener.on_cancel(None, None, None, b'{"conversation_id": "c1"}')
+    listener.on_cancel(None, None, None, b"{}")
+    assert len(registry) == 1 and registry.cancelled("c1", time.time() - 1)
+
+
+def test_cancelled_row_stops_early(tiny_loading):
+    from inference.runtime import ChatHandler, cancellation_criteria
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    calls = []
+
+    def cancel_after_two_steps():
+        calls.append(1)
+        return len(calls) > 2
+
+    criteria = cancellation_criteria([cancel_after_two_steps, lambda: False])
+    results = handler.infer_batch(["hello world", "the patient"], stopping_criteria=criteria, **ARGS)
+    lengths = [len(handler.tokenizer(r, add_special_tokens=False)["input_ids"]) for r in results]
+    assert lengths[0] < lengths[1] == ARGS["max_new_tokens"]
+
+    # Once every request is cancelled generation ends
+    criteria = cancellation_criteria([lambda: True])
+    result = handler.infer("hello world", stopping_criteria=criteria, **ARGS)
+    assert len(handler.tokenizer(result, add_special_tokens=False)["input_ids"]) == 1
+
+
+class CancelOnceGenerating(CancellationRegistry):
+    """Cancels conversation "mid" on its fifth check, the third one made between decode steps"""
+    def __init__(self):
+        super().__init__()
+        self.checks = 0
+
+    def cancelled(self, conversation_id, requested_at):
+        if conversation_id == "mid":
+            self.checks += 1
+            return self.checks >= 5
+        return super().cancelled(conversation_id, requested_at)
+
+
+def test_consumer_drops_queued_and_stops_generating_cancelled_requests(tiny_loading):
+    metrics_registry = CollectorRegistry()
+    cancellations = CancelOnceGenerating()
+    connection = MagicMock()
+    channel = MagicMock()
+
+    def message(conversation_id, **fields):
+        body = {
+            "conversation_id": conversation_id,
+            "base_model_path": "/models/tiny",
+            "input": [{"role": "user", "content": "hello world"}],
+            "generation_args": ARGS,
+            "enqueued_at": time.time(),
+            **fields,
+        }
+        return json.dumps(body).encode()
+
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+         patch.object(generic_inference, "CANCEL_EXCHANGE", "inference_cancel"), \
+         patch.object(generic_inference, "CANCEL_CHECK_TOKENS", 1), \
+         patch.object(generic_inference, "CancelListener") as listener, \
+         patch.object(generic_inference, "CancellationRegistry", return_value=cancellations), \
+         patch.object(generic_inference, "InferenceMetrics", lambda cache: InferenceMetrics(cache, registry=metrics_registry)):
+        generic_inference.main()
+        on_message = connection.channel.return_value.basic_consume.call_args.kwargs["on_message_callback"]
+        cancellations.cancel("queued")
+        on_message(channel, MagicMock(delivery_tag=1), None, message("queued", enqueued_at=time.time() - 1))
+        assert tiny_loading == []
+        on_message(channel, MagicMock(delivery_tag=2), None, message("mid"))
+
+    listener.return_value.start.assert_called_once()
+    responses = [json.loads(c.kwargs["body"]) for c in channel.basic_publish.call_args_list]
+    assert [(r["conversation_id"], r.get("error")) for r in responses] == [("queued", "cancelled"), ("mid", "cancelled")]
+    labels = {"model": "/models/tiny", "adapter": ""}
+    assert sample(metrics_registry, "llmedic_cancelled_requests_total", stage="queued", **labels) == 1
+    assert sample(metrics_registry, "llmedic_cancelled_requests_total", stage="generating", **labels) == 1
+    assert 0 < sample(metrics_registry, "llmedic_cancelled_wasted_tokens_total", **labels) < ARGS["max_new_tokens"]
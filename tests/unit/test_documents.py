@@ -0,0 +1,268 @@
+import hashlib
+import os
+import threading
+import time
+import types
+from unittest.mock import patch
+
+from inference.batching import BatchScheduler
+from inference.documents import DocumentPrefetcher, DocumentTextCache, extract_text_from_pdf, read_document
+from inference.generic_inference import fit_document, parse_input
+
+
+def test_read_local_text(tmp_path):
+    p = tmp_path / "notes.txt"
+    p.write_text("BP 120/80")
+    text, timings = read_document(str(p))
+    assert text == "BP 120/80"
+    assert set(timings) == {"fetch", "extract"}
+
+
+@patch("inference.documents.requests.get")
+def test_url_fetch_uses_timeout(mock_get):
+    mock_get.return_value = types.SimpleNamespace(
+        raise_for_status=lambda: None, headers={"Content-Type": "text/plain"},
+        iter_content=lambda chunk_size: iter([b"lab ", b"report"]), close=lambda: None,
+    )
+    text, _ = read_document("http://files/report.txt", fetch_timeout=3)
+    assert text == "lab report"
+    assert mock_get.call_args.kwargs["timeout"] == 3
+
+
+def test_prefetch_runs_in_background(tmp_path):
+    p = tmp_path / "a.txt"
+    p.write_text("referral")
+    prefetcher = DocumentPrefetcher(max_workers=2)
+    future = prefetcher.submit(str(p))
+    text, timings = prefetcher.result(future)
+    assert text == "referral"
+    assert "wait" in timings
+    assert prefetcher.submit(None) is None
+
+
+def test_slow_document_times_out():
+    release = threading.Event()
+    prefetcher = DocumentPrefetcher(max_workers=1, fetch_timeout=0.05, extract_timeout=0.05)
+    future = prefetcher._pool.submit(lambda: release.wait(5) or ("late", {}))
+    start = time.monotonic()
+    text, _ = prefetcher.result(future)
+    release.set()
+    assert text == ""
+    assert time.monotonic() - start < 1
+
+
+def slow_response(chunks, delay):
+    def iter_content(chunk_size):
+        for chunk in chunks:
+            time.sleep(delay)
+            yield chunk
+
+    return types.SimpleNamespace(
+        status_code=200, iter_content=iter_content, close=lambda: None, encoding="utf-8",
+        headers={"Content-Type": "text/plain"}, raise_for_status=lambda: None,
+    )
+
+
+def test_slow_download_frees_its_worker():
+    # A server dripping bytes within the per-read timeout is cut off at the total time limit
+    with patch("inference.documents.requests.get", return_value=slow_response([b"x"] * 1000, 0.01)) as get:
+        start = time.monotonic()
+        text, _ = read_document("http://files/slow.txt", fetch_timeout=0.1)
+    assert text == "" and time.monotonic() - start < 1
+    assert get.call_args.kwargs["stream"] is True
+
+
+def test_oversized_download_is_abandoned():
+    with patch("inference.documents.requests.get", return_value=slow_response([b"x" * 600] * 10, 0)):
+        assert read_document("http://files/big.txt", max_bytes=1000)[0] == ""
+        assert read_document("http://files/big.txt", max_bytes=10000)[0] == "x" * 6000
+
+
+def test_pdf_extraction_stops_at_its_time_limit():
+    pages_read = []
+
+    def pages(_):
+        for i in range(50):
+            pages_read.append(i)
+            time.sleep(0.01)
+            yield "page text"
+
+    cache = DocumentTextCache()
+    with patch("inference.documents.PdfReader", object), patch("inference.documents.iter_pdf_pages", pages), \
+         patch("inference.documents.requests.get", return_value=fake_response()):
+        text, _ = read_document("http://files/long.pdf", cache=cache, extract_timeout=0.05)
+    assert text == "" and len(pages_read) < 20
+    # Nothing partial is cached
+    assert cache.stats()["entries"] == 0
+
+
+def test_parse_input_uses_prefetched_text():
+    msg = {"input": [{"role": "user", "content": "Summarise"}], "file_url": "http://unreachable/doc.pdf"}
+    with patch("inference.documents.requests.get", side_effect=AssertionError("must not fetch")):
+        assert parse_input(msg, file_text="page one") == "Summarise\npage one"
+
+
+def test_scheduler_prepares_messages_on_arrival():
+    groups = []
+    seen = []
+    s = BatchScheduler(groups.append, max_batch_size=1, prepare=lambda m: seen.append(m) or "doc")
+    s.submit("ch", types.SimpleNamespace(delivery_tag=1), None, {"base_model_path": "m"})
+    assert seen and groups[0][0].document == "doc"
+
+
+def fake_response(status=200, content=b"%PDF", etag='"v1"'):
+    return types.SimpleNamespace(
+        status_code=status, iter_content=lambda chunk_size: iter([content]), close=lambda: None, encoding="utf-8",
+        headers={"Content-Type": "application/pdf", "ETag": etag},
+        raise_for_status=lambda: None,
+    )
+
+
+@patch("inference.documents.extract_text_from_pdf", return_value="referral text")
+@patch("inference.documents.requests.get")
+def test_unchanged_url_is_not_downloaded_or_extracted_again(mock_get, mock_extract):
+    cache = DocumentTextCache()
+    mock_get.return_value = fake_response()
+    assert read_document("http://files/ref.pdf", cache=cache)[0] == "referral text"
+
+    mock_get.return_value = fake_response(status=304, content=b"")
+    assert read_document("http://files/ref.pdf", cache=cache)[0] == "referral text"
+    assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    assert mock_extract.call_count == 1
+
+
+@patch("inference.documents.extract_text_from_pdf", return_value="same text")
+@patch("inference.documents.requests.get")
+def test_identical_content_at_new_url_skips_extraction(mock_get, mock_extract):
+    cache = DocumentTextCache()
+    mock_get.return_value = fake_response(etag=None)
+    read_document("http://files/a.pdf", cache=cache)
+    read_document("http://files/copy-of-a.pdf", cache=cache)
+    assert mock_extract.call_count == 1
+
+
+def test_local_files_cached_by_content(tmp_path):
+    cache = DocumentTextCache(max_entries=4, disk_dir=str(tmp_path / "cache"))
+    p = tmp_path / "a.txt"
+    p.write_text("v1")
+    assert read_document(str(p), cache=cache)[0] == "v1"
+    p.write_text("v2")
+    assert read_document(str(p), cache=cache)[0] == "v2"
+    # A fresh process finds the text on disk
+    fresh = DocumentTextCache(disk_dir=str(tmp_path / "cache"))
+    assert fresh.get_text(hashlib.sha256(b"v1").hexdigest()) == "v1"
+
+
+def test_disk_store_is_size_bounded(tmp_path):
+    cache = DocumentTextCache(disk_dir=str(tmp_path), max_disk_bytes=10)
+    cache.put_text("a" * 64, "123456")
+    cache.put_text("b" * 64, "789012")
+    stored = list((tmp_path / "text").rglob("*.txt"))
+    assert len(stored) == 1
+
+
+def test_disk_store_is_not_rescanned_below_its_limit(tmp_path):
+    cache = DocumentTextCache(disk_dir=str(tmp_path), max_disk_bytes=100)
+    with patch("inference.documents.os.walk", wraps=os.walk) as walk:
+        for n in range(5):
+            cache.put_text(f"{n:064x}", "0123456789")
+        # One scan counts what is already on disk; later writes are added to the count
+        assert walk.call_count == 1
+        cache.put_text("f" * 64, "x" * 60)
+    assert cache._disk_bytes <= 90
+    assert sum(p.stat().st_size for p in (tmp_path / "text").rglob("*.txt")) == cache._disk_bytes
+
+
+def test_pdf_extraction_stops_at_budget():
+    pages_read = []
+
+    def pages(_):
+        for i in range(50):
+            pages_read.append(i)
+            yield "page text " * 10
+
+    with patch("inference.documents.PdfReader", object), patch("inference.documents.iter_pdf_pages", pages):
+        text = extract_text_from_pdf(None, max_chars=250)
+    assert len(text) == 250
+    assert len(pages_read) == 3
+
+
+def test_document_trimmed_to_token_budget(tiny_tokenizer):
+    prompt = "hello world"
+    document = " ".join(["a"] * 100)
+    text = fit_document(prompt, document, tiny_tokenizer, max_tokens=12)
+    assert text.startswith(prompt + "\n")
+    assert len(tiny_tokenizer(text, add_special_tokens=False)["input_ids"]) <= 12
+    assert "a" in text
+
+
+def test_budget_follows_the_model_context(tiny_loading, monkeypatch):
+    from inference import runtime
+
+    monkeypatch.setattr(runtime, "MAX_INPUT_TOKENS", 2048)
+    handler = runtime.ChatHandler("tiny-instruct", "cpu")
+    # The tiny model attends to 256 positions; "user : " and "assistant : " take 4 tokens
+    assert handler.context_length == 256 and handler.max_input_tokens == 256
+    assert handler.template_tokens == 4
+    assert runtime.input_budget(handler, {"max_new_tokens": 200}) == 52
+
+    message = {"input": [{"role": "user", "content": "hello world"}], "file_url": "/notes.txt"}
+    text = parse_input(message, file_text=" ".join(["a"] * 500), tokenizer=handler.tokenizer,
+                       max_tokens=runtime.input_budget(handler, {"max_new_tokens": 200}))
+    inputs = handler.tokenizer.apply_chat_template(
+        [{"role": "user", "content": text}], add_generation_prompt=True, tokenize=True
+    )
+    # The attachment fills what the template and the generated tokens leave of the context
+    assert "a" in text and len(inputs) + 200 == 256
+
+    monkeypatch.setattr(runtime, "MAX_INPUT_TOKENS", 64)
+    limited = runtime.PipelineHandler("tiny", "cpu")
+    # The pipeline's tokenizer adds no special tokens here
+    assert limited.max_input_tokens == 64 and runtime.input_budget(limited, {"max_new_tokens": 8}) == 64
+
+
+def test_budget_defaults_to_the_model_context(tiny_loading):
+    from inference import messages, runtime
+
+    assert messages.MAX_INPUT_TOKENS == 0 and messages.DOCUMENT_MAX_CHARS is None
+    handler = runtime.ChatHandler("tiny-instruct", "cpu")
+    assert handler.max_input_tokens == 256
+    assert messages.document_max_chars(runtime.input_budget(handler, {"max_new_tokens": 100})) == 152 * 6
+
+
+def test_prefetch_is_capped_by_the_resident_handler(tiny_loading, tmp_path):
+    import json
+    from unittest.mock import MagicMock
+
+    from inference import generic_inference
+
+    document = tmp_path / "notes.txt"
+    document.write_text(" ".join(["a"] * 2000))
+    body = json.dumps({
+        "conversation_id": "d1",
+        "base_model_path": "/models/tiny-instruct",
+        "input": [{"role": "user", "content": "hello world"}],
+        "file_url": str(document),
+        "generation_args": {"max_new_tokens": 100, "do_sample": False},
+    }).encode()
+    connection = MagicMock()
+    channel = connection.channel.return_value
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+         patch.object(DocumentPrefetcher, "submit", autospec=True, side_effect=DocumentPrefetcher.submit) as submit:
+        generic_inference.main()
+        on_message = channel.basic_consume.call_args.kwargs["on_message_callback"]
+        for tag in (1, 2):
+            on_message(channel, MagicMock(delivery_tag=tag), None, body)
+
+    # Nothing is known of the model before its first load; then its budget caps extraction
+    assert [c.args[2] for c in submit.call_args_list] == [None, 152 * 6]
+    responses = [json.loads(c.kwargs["body"]) for c in channel.basic_publish.call_args_list]
+    assert [r.get("error") for r in responses] == [None, None]
+
+
+def test_prompt_never_trimmed(tiny_tokenizer):
+    prompt = " ".join(["hello"] * 20)
+    text = fit_document(prompt, "a a a", tiny_tokenizer, max_tokens=5)
+    assert text == prompt + "\n"
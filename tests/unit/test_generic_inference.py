@@ -43,7 +43,7 @@ def test_parse_input_vision_requires_image():
     with pytest.raises(ValueError):
         parse_input({"input": [{"role": "user", "content": "Hi"}]}, is_vision_model=True)
 
-@patch("inference.generic_inference.mimetypes.guess_type", return_value=("application/pdf", None))
+@patch("inference.messages.mimetypes.guess_type", return_value=("application/pdf", None))
 def test_parse_input_pdf_local(mock_guess, tmp_path):
     p = tmp_path / "a.pdf"
     p.write_bytes(b"%PDF-1.4\n%EOF")
@@ -51,7 +51,7 @@ def test_parse_input_pdf_local(mock_guess, tmp_path):
     out = parse_input(msg, is_vision_model=False)
     assert "Summarise" in out  # prompt still included
 
-@patch("inference.generic_inference.hf_pipeline")
+@patch("inference.runtime.hf_pipeline")
 def test_handler_selection_pipeline(mock_pipe, monkeypatch):
     # Avoid loading real models: replace PipelineHandler.__init__
     from inference.generic_inference import PipelineHandler
@@ -73,8 +73,8 @@ def test_handler_selection_pipeline(mock_pipe, monkeypatch):
     out = ph.infer("Hello")
     assert out.endswith("::ANSWER")
 
-@patch("inference.generic_inference.AutoModelForCausalLM.from_pretrained")   # 2nd arg
-@patch("inference.generic_inference.AutoTokenizer.from_pretrained")         # 1st arg
+@patch("inference.runtime.AutoModelForCausalLM.from_pretrained")   # 2nd arg
+@patch("inference.runtime.AutoTokenizer.from_pretrained")         # 1st arg
 def test_chat_handler(mock_tok, mock_model, monkeypatch):
     from inference.generic_inference import ChatHandler
 
@@ -92,8 +92,8 @@ def test_chat_handler(mock_tok, mock_model, monkeypatch):
     out = ch.infer([{"role": "user", "content": "Hi"}])
     assert out == "RESPONSE"
 
-@patch("inference.generic_inference.AutoTokenizer.from_pretrained")
-@patch("inference.generic_inference.AutoModelForCausalLM.from_pretrained")
+@patch("inference.runtime.AutoTokenizer.from_pretrained")
+@patch("inference.runtime.AutoModelForCausalLM.from_pretrained")
 @patch("inference.generic_inference.pika.BlockingConnection")
 def test_on_message_flow(mock_conn, mock_model, mock_tok, monkeypatch):
     """
@@ -0,0 +1,91 @@
+import pytest
+import torch
+
+from inference.handler_cache import HandlerCache, estimate_handler_bytes, is_out_of_memory
+
+
+class FakeHandler:
+    def __init__(self, n):
+        self.model = torch.nn.Linear(n, 1, bias=False)
+
+
+def test_estimate_counts_parameter_bytes():
+    h = FakeHandler(10)
+    assert estimate_handler_bytes(h) == 10 * 4
+
+
+def test_hits_and_misses():
+    cache = HandlerCache(max_bytes=0)
+    built = []
+    factory = lambda: built.append(1) or FakeHandler(4)
+    a = cache.get("a", factory)
+    assert cache.get("a", factory) is a
+    assert len(built) == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used_over_budget():
+    cache = HandlerCache(max_bytes=100)  # fits two 40-byte handlers
+    cache.get("a", lambda: FakeHandler(10))
+    cache.get("b", lambda: FakeHandler(10))
+    cache.get("a", lambda: FakeHandler(10))  # a is now most recent
+    cache.get("c", lambda: FakeHandler(10))
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.evictions == 1
+    assert cache.total_bytes <= 100
+
+
+def test_oversized_handler_is_kept_alone():
+    cache = HandlerCache(max_bytes=50)
+    cache.get("a", lambda: FakeHandler(10))
+    cache.get("big", lambda: FakeHandler(100))
+    assert len(cache) == 1 and "big" in cache
+
+
+def test_out_of_memory_clears_cache_and_retries():
+    cache = HandlerCache(max_bytes=0)
+    cache.get("a", lambda: FakeHandler(10))
+    calls = []
+
+    def factory():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("HPU out of memory")
+        return FakeHandler(10)
+
+    cache.get("b", factory)
+    assert len(calls) == 2
+    assert "a" not in cache and "b" in cache
+
+
+def test_other_errors_propagate():
+    cache = HandlerCache()
+    cache.get("a", lambda: FakeHandler(1))
+    with pytest.raises(ValueError):
+        cache.get("b", lambda: (_ for _ in ()).throw(ValueError("bad path")))
+    assert "a" in cache
+
+
+def test_only_allocation_failures_count_as_out_of_memory():
+    assert is_out_of_memory(MemoryError())
+    assert is_out_of_memory(torch.cuda.OutOfMemoryError("CUDA out of memory"))
+    assert is_out_of_memory(RuntimeError("[Rank:0] FATAL: Device out of memory"))
+    assert not is_out_of_memory(ValueError("Unrecognized configuration for bloom"))
+
+    cache = HandlerCache()
+    cache.get("a", lambda: FakeHandler(1))
+    with pytest.raises(OSError):
+        cache.get("b", lambda: (_ for _ in ()).throw(OSError("no file /models/bloomz-7b1/config.json")))
+    assert "a" in cache and cache.evictions == 0
+
+
+def test_pinned_handlers_are_not_evicted_until_released():
+    cache = HandlerCache(max_bytes=50)  # one 40-byte handler
+    cache.get("old", lambda: FakeHandler(10))
+    with cache.pin(["a", "b"]):
+        a = cache.get("a", lambda: FakeHandler(10))
+        cache.get("b", lambda: FakeHandler(10))
+        assert "a" in cache and "b" in cache and "old" not in cache
+        assert cache.get("a", lambda: FakeHandler(10)) is a
+    assert len(cache) == 1 and cache.total_bytes <= 50
@@ -0,0 +1,97 @@
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+import torch
+
+pytest.importorskip("prometheus_client")
+from prometheus_client import CollectorRegistry, generate_latest
+
+from inference import generic_inference
+from inference.handler_cache import HandlerCache
+from inference.metrics import GenerationTimer, InferenceMetrics
+from inference.prefix_cache import PrefixCache
+
+
+def sample(registry, name, **labels):
+    return registry.get_sample_value(name, labels)
+
+
+def test_generation_timer_splits_tokenization_and_first_token(tiny_tokenizer):
+    from tests.conftest import build_tiny_model
+
+    model = build_tiny_model()
+    with GenerationTimer(model) as timer:
+        inputs = tiny_tokenizer("hello world", return_tensors="pt")
+        model.generate(**inputs, max_new_tokens=3, do_sample=False, pad_token_id=0)
+    assert 0 <= timer.tokenization <= timer.first_forward_end - timer.start <= timer.generation
+    # Hooks are removed afterwards
+    assert not model._forward_hooks and not model._forward_pre_hooks
+
+
+def test_handler_gauges_follow_cache():
+    cache = HandlerCache()
+    registry = CollectorRegistry()
+    InferenceMetrics(cache, registry=registry)
+    handler = MagicMock(model=torch.nn.Linear(4, 1, bias=False), base_model_path="/models/a", adapter_path="/adapters/x")
+    cache.get(("/models/a", "/adapters/x", "cpu"), lambda: handler)
+
+    assert sample(registry, "llmedic_loaded_handlers", model="/models/a", adapter="/adapters/x") == 1
+    assert sample(registry, "llmedic_handler_memory_bytes", model="/models/a", adapter="/adapters/x") == 16
+    cache.clear()
+
+
+def test_cache_counters_are_exported():
+    cache = HandlerCache()
+    registry = CollectorRegistry()
+    InferenceMetrics(cache, registry=registry)
+    cache.get(("/models/a", None, "cpu"), MagicMock)
+    cache.get(("/models/a", None, "cpu"), MagicMock)
+    cache.evict(("/models/a", None, "cpu"))
+    assert sample(registry, "llmedic_handler_cache_lookups_total", result="hit") == 1
+    assert sample(registry, "llmedic_handler_cache_lookups_total", result="miss") == 1
+    assert sample(registry, "llmedic_handler_cache_evictions_total") == 1
+
+    prefix_cache = PrefixCache(2**20, min_prefix_tokens=2)
+    prefix_cache.lookups, prefix_cache.hits, prefix_cache.prompt_tokens, prefix_cache.reused_tokens = 4, 3, 100, 60
+    with patch("inference.runtime.prefix_cache", prefix_cache):
+        assert sample(registry, "llmedic_prefix_cache_lookups_total", result="hit") == 3
+        assert sample(registry, "llmedic_prefix_cache_lookups_total", result="miss") == 1
+        assert sample(registry, "llmedic_prefix_cache_reused_tokens_total") == 60
+        assert sample(registry, "llmedic_prefix_cache_entries") == 0
+    assert sample(registry, "llmedic_loaded_handlers", model="/models/a", adapter="/adapters/x") is None
+
+
+def test_consumer_records_request_metrics(tiny_loading):
+    registry = CollectorRegistry()
+    connection = MagicMock()
+
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+         patch.object(generic_inference, "InferenceMetrics", lambda cache: InferenceMetrics(cache, registry=registry)):
+        generic_inference.main()
+        on_message = connection.channel.return_value.basic_consume.call_args.kwargs["on_message_callback"]
+        channel, method = MagicMock(), MagicMock()
+        message = {
+            "conversation_id": 1,
+            "base_model_path": "/models/tiny",
+            "input": [{"role": "user", "content": "hello world"}],
+            "generation_args": {"max_new_tokens": 4, "do_sample": False},
+        }
+        on_message(channel, method, None, json.dumps(message).encode())
+        on_message(channel, method, None, b"not json")
+
+    labels = {"model": "/models/tiny", "adapter": ""}
+    assert sample(registry, "llmedic_queue_wait_seconds_count", priority="interactive", **labels) == 1
+    for name in (
+        "llmedic_tokenization_seconds_count",
+        "llmedic_time_to_first_token_seconds_count",
+        "llmedic_generation_seconds_count",
+        "llmedic_generation_tokens_per_second_count",
+    ):
+        assert sample(registry, name, **labels) == 1, name
+    assert sample(registry, "llmedic_input_preparation_seconds_count", stage="parse", **labels) == 1
+    assert sample(registry, "llmedic_model_load_seconds_count", **labels) == 1
+    assert sample(registry, "llmedic_errors_total", model="", adapter="", type="invalid_json") == 1
+    assert b'llmedic_loaded_handlers{adapter="",model="/models/tiny"} 1.0' in generate_latest(registry)
@@ -0,0 +1,123 @@
+import pytest
+import torch
+
+from tests.conftest import build_tiny_model
+
+
+def save_adapter(path, seed):
+    from peft import LoraConfig, get_peft_model
+
+    base = build_tiny_model()
+    torch.manual_seed(seed)
+    model = get_peft_model(
+        base,
+        LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj"], init_lora_weights=False),
+    )
+    model.save_pretrained(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def adapters(tmp_path):
+    return save_adapter(tmp_path / "dept_a", 1), save_adapter(tmp_path / "dept_b", 2)
+
+
+ARGS = {"max_new_tokens": 4, "min_new_tokens": 4, "do_sample": False}
+
+
+def test_adapters_share_one_base_model(adapters, tiny_loading):
+    from inference.generic_inference import PipelineHandler
+
+    a = PipelineHandler("tiny-base", "cpu", adapters[0])
+    b = PipelineHandler("tiny-base", "cpu", adapters[1])
+    assert a.model is b.model
+    assert tiny_loading == ["tiny-base"]
+    assert {a.adapter_name, b.adapter_name} <= set(a.model.peft_config)
+    assert a.infer("hello world", **ARGS) != b.infer("hello world", **ARGS)
+
+
+def test_mixed_adapter_batch_matches_individual_runs(adapters, tiny_loading):
+    from inference.generic_inference import PipelineHandler
+
+    a = PipelineHandler("tiny-base", "cpu", adapters[0])
+    b = PipelineHandler("tiny-base", "cpu", adapters[1])
+    prompts = ["hello world", "the patient is w3"]
+    expected = [a.infer(prompts[0], **ARGS), b.infer(prompts[1], **ARGS)]
+    mixed = a.infer_batch(prompts, adapter_names=[a.adapter_name, b.adapter_name], **ARGS)
+    assert mixed == expected
+
+
+def test_release_detaches_adapter_but_keeps_base(adapters, tiny_loading):
+    from inference.generic_inference import ChatHandler
+
+    a = ChatHandler("tiny-base-instruct", "cpu", adapters[0])
+    b = ChatHandler("tiny-base-instruct", "cpu", adapters[1])
+    b.release()
+    assert b.adapter_name not in a.model.peft_config
+    assert a.adapter_name in a.model.peft_config
+    assert a.infer("hello", **dict(ARGS))
+
+
+@pytest.mark.parametrize("handler_class, base", [("ChatHandler", "tiny-base-instruct"), ("PipelineHandler", "tiny-base")])
+def test_base_requests_use_the_resident_adapter_model(adapters, tiny_loading, handler_class, base):
+    from inference import runtime
+
+    handler_type = getattr(runtime, handler_class)
+    # The adapter path strips its results, the plain pipeline does not
+    expected = handler_type("tiny-other", "cpu").infer("hello world", **dict(ARGS)).strip()
+    adapter_handler = handler_type(base, "cpu", adapters[0])
+    adapted = adapter_handler.infer("hello world", **dict(ARGS))
+    loads = len(tiny_loading)
+
+    base_handler = handler_type(base, "cpu")
+    # No second copy of the base model: its adapters are disabled instead
+    assert len(tiny_loading) == loads and base_handler.model is adapter_handler.model
+    assert base_handler.infer("hello world", **dict(ARGS)).strip() == expected != adapted
+    assert adapter_handler.infer("hello world", **dict(ARGS)) == adapted
+    base_handler.release()
+    assert adapter_handler.adapter_name in adapter_handler.model.peft_config
+
+    # Quantized base models are loaded on their own
+    assert handler_type(base, "cpu", quantization="int8").model is not adapter_handler.model
+
+
+def test_shared_weights_counted_once(adapters, tiny_loading):
+    from inference.generic_inference import PipelineHandler
+    from inference.handler_cache import estimate_handler_bytes, estimate_handlers_bytes
+
+    a = PipelineHandler("tiny-base", "cpu", adapters[0])
+    b = PipelineHandler("tiny-base", "cpu", adapters[1])
+    assert estimate_handlers_bytes([a, b]) == estimate_handler_bytes(a)
+
+
+def test_batch_keeps_its_adapters_loaded_beyond_cache_budget(adapters, tiny_loading):
+    import json
+    from unittest.mock import MagicMock, patch
+
+    from inference import generic_inference
+
+    connection = MagicMock()
+    channel = MagicMock()
+
+    def message(conversation_id, adapter_path):
+        return json.dumps({
+            "conversation_id": conversation_id,
+            "base_model_path": "/models/tiny",
+            "adapter_path": adapter_path,
+            "input": [{"role": "user", "content": "hello world"}],
+            "generation_args": ARGS,
+        }).encode()
+
+    # No two handlers fit in the budget, yet the batch needs both adapters
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 2), \
+         patch.object(generic_inference, "HANDLER_CACHE_MAX_GB", 1e-9):
+        generic_inference.main()
+        on_message = connection.channel.return_value.basic_consume.call_args.kwargs["on_message_callback"]
+        on_message(channel, MagicMock(delivery_tag=1), None, message("a", adapters[0]))
+        on_message(channel, MagicMock(delivery_tag=2), None, message("b", adapters[1]))
+
+    responses = [json.loads(c.kwargs["body"]) for c in channel.basic_publish.call_args_list]
+    assert [(r["conversation_id"], r.get("error")) for r in responses] == [("a", None), ("b", None)]
+    assert responses[0]["result"] != responses[1]["result"]
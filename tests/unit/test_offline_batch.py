@@ -0,0 +1,78 @@
+import io
+import json
+
+from inference import offline_batch
+from inference.offline_batch import completed_indices, iter_records, record_message, sorted_batches
+
+PROMPTS = ["hello world", "the patient is", "a", "summary of the patient and the user", "hello"]
+
+
+def read_lines(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def run(tmp_path, input_path, *extra):
+    output = tmp_path / "results.jsonl"
+    report = offline_batch.main([
+        str(input_path), "--model", "/models/tiny", "--device", "cpu", "--output", str(output),
+        "--batch-size", "2", "--nice", "0", "--generation-args", '{"max_new_tokens": 3, "do_sample": false}',
+        *extra,
+    ])
+    return output, report
+
+
+def test_reads_jsonl_arrays_and_concatenated_objects():
+    expected = [{"input": "a"}, {"input": "b"}]
+    for text in ('{"input": "a"}\n\n{"input": "b"}\n', '[{"input": "a"},\n {"input": "b"}]', '{\n "input": "a"\n}\n{"input": "b"}'):
+        assert list(iter_records(io.StringIO(text), chunk_size=4)) == expected
+
+
+def test_record_formats():
+    turns = [{"role": "user", "content": "hi"}]
+    assert record_message({"input": turns, "file_url": "x"})["file_url"] == "x"
+    assert record_message({"text": "hi"})["input"] == turns
+    assert record_message({"input": "hi", "output": "ref"})["input"] == turns
+
+
+def test_batches_sorted_within_window():
+    batches = list(sorted_batches([5, 1, 4, 2, 3, 0], batch_size=2, window=4, length=lambda n: n))
+    assert batches == [[1, 2], [4, 5], [0, 3]]
+
+
+def test_runs_file_and_reports_throughput(tmp_path, tiny_loading):
+    source = tmp_path / "prompts.jsonl"
+    source.write_text("\n".join(json.dumps({"input": p, "output": f"ref{i}"}) for i, p in enumerate(PROMPTS)))
+    output, report = run(tmp_path, source)
+
+    lines = read_lines(output)
+    assert sorted(line["index"] for line in lines) == list(range(len(PROMPTS)))
+    assert all(isinstance(line["result"], str) for line in lines)
+    assert {line["index"]: line["reference"] for line in lines}[3] == "ref3"
+    assert report["records"] == len(PROMPTS) and report["batches"] == 3
+    assert report["generated_tokens"] > 0
+    assert tiny_loading == ["/models/tiny"]
+
+
+def test_resume_skips_written_records(tmp_path, tiny_loading):
+    source = tmp_path / "prompts.json"
+    source.write_text(json.dumps([{"prompt": p} for p in PROMPTS]))
+    output, _ = run(tmp_path, source)
+    lines = output.read_text().splitlines()
+    # An interrupted run leaves the last line half written
+    output.write_text("\n".join(lines[:2]) + "\n" + lines[2][:10])
+    done = completed_indices(str(output))
+    assert len(done) == 2
+
+    _, report = run(tmp_path, source, "--resume")
+    assert report["records"] == len(PROMPTS) - 2
+    assert sorted(line["index"] for line in read_lines(output)) == list(range(len(PROMPTS)))
+
+
+def test_offset_and_invalid_records(tmp_path, tiny_loading):
+    source = tmp_path / "prompts.jsonl"
+    source.write_text('{"input": "hello"}\n{"input": "a"}\n{"nothing": 1}\n')
+    output, report = run(tmp_path, source, "--offset", "1")
+    lines = {line["index"]: line for line in read_lines(output)}
+    assert set(lines) == {1, 2}
+    assert "error" in lines[2]
+    assert report["errors"] == 1
@@ -0,0 +1,144 @@
+import pytest
+import torch
+
+from inference.prefix_cache import PrefixCache, common_prefix_length
+
+PREAMBLE = " ".join(f"w{i % 50}" for i in range(40))
+ARGS = {"max_new_tokens": 5, "min_new_tokens": 5, "do_sample": False}
+
+
+@pytest.fixture
+def enabled_cache(monkeypatch):
+    import inference.runtime as gi
+
+    cache = PrefixCache(max_bytes=64 * 2**20, min_prefix_tokens=8)
+    monkeypatch.setattr(gi, "prefix_cache", cache)
+    return cache
+
+
+def record_prefill_lengths(model):
+    lengths = []
+    original = model.forward
+
+    def forward(*args, **kwargs):
+        lengths.append(kwargs["input_ids"].shape[1])
+        return original(*args, **kwargs)
+
+    model.forward = forward
+    return lengths
+
+
+def test_common_prefix_length():
+    a = torch.tensor([1, 2, 3, 4])
+    assert common_prefix_length(a, torch.tensor([1, 2, 9])) == 2
+    assert common_prefix_length(a, torch.tensor([1, 2])) == 2
+    assert common_prefix_length(a, torch.tensor([7])) == 0
+
+
+def test_chat_reuses_shared_preamble(tiny_loading, enabled_cache):
+    from inference.generic_inference import ChatHandler
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    first, second = PREAMBLE + " hello", PREAMBLE + " patient summary"
+
+    import inference.runtime as gi
+    gi.prefix_cache = None
+    expected = [handler.infer(p, **dict(ARGS)) for p in (first, second)]
+    gi.prefix_cache = enabled_cache
+
+    prefill = record_prefill_lengths(handler.model)
+    assert handler.infer(first, **dict(ARGS)) == expected[0]
+    full_length = prefill[0]
+    prefill.clear()
+    assert handler.infer(second, **dict(ARGS)) == expected[1]
+    # Only the differing suffix is prefilled the second time
+    assert prefill[0] < full_length - 30
+    stats = enabled_cache.stats()
+    assert stats["hit_rate"] == 0.5
+    assert stats["reused_token_ratio"] > 0.4
+
+
+def test_pipeline_path_uses_cache(tiny_loading, enabled_cache):
+    from inference.generic_inference import PipelineHandler
+
+    handler = PipelineHandler("tiny", "cpu")
+    handler.infer(PREAMBLE + " hello", **ARGS)
+    handler.infer(PREAMBLE + " world", **ARGS)
+    assert enabled_cache.hits == 1
+
+
+def test_caches_are_separate_per_namespace(tiny_loading, enabled_cache):
+    from inference.generic_inference import ChatHandler
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    handler.infer(PREAMBLE, **dict(ARGS))
+    handler.prefix_namespace = ("tiny-instruct", "/models/other-adapter")
+    handler.infer(PREAMBLE + " hello", **dict(ARGS))
+    assert enabled_cache.hits == 0
+
+
+def test_memory_bound_evicts_oldest():
+    from transformers import DynamicCache
+    from inference.prefix_cache import cache_bytes
+    from tests.conftest import build_tiny_model
+
+    model = build_tiny_model()
+    cache = PrefixCache(max_bytes=1, min_prefix_tokens=4)
+    entries = []
+    for start in range(3):
+        ids = torch.arange(10 + start, 30 + start)
+        kv = DynamicCache()
+        with torch.no_grad():
+            model(input_ids=ids[None], past_key_values=kv, use_cache=True)
+        entries.append((ids, kv))
+    cache.max_bytes = 2 * cache_bytes(entries[0][1])
+    for ids, kv in entries:
+        cache.store("ns", ids, kv)
+    assert len(cache) == 2
+    assert cache.lookup("ns", entries[0][0])[0] is None
+    assert cache.lookup("ns", entries[2][0])[1] == len(entries[2][0]) - 1
+
+
+def test_padding_does_not_count_as_a_match():
+    from transformers import DynamicCache
+    from tests.conftest import build_tiny_model
+
+    model = build_tiny_model()
+    cache = PrefixCache(max_bytes=64 * 2**20, min_prefix_tokens=4)
+    ids = torch.cat([torch.zeros(10, dtype=torch.long), torch.arange(10, 16)])
+    mask = (ids != 0).long()
+    kv = DynamicCache()
+    with torch.no_grad():
+        model(input_ids=ids[None], attention_mask=mask[None], past_key_values=kv, use_cache=True)
+    cache.store("ns", ids, kv, mask)
+
+    # Same padding, different prompt: only pad tokens are shared
+    other = torch.cat([torch.zeros(10, dtype=torch.long), torch.arange(30, 36)])
+    assert cache.lookup("ns", other, (other != 0).long()) == (None, 0)
+    # Same padding and a shared prefix: the padding is reused but not counted
+    shared = torch.cat([ids[:15], torch.tensor([40])])
+    kv, length = cache.lookup("ns", shared, (shared != 0).long())
+    assert length == 15 and cache.reused_tokens == 5
+    assert cache.prompt_tokens == 12
+
+
+def test_cached_prompts_are_bucketed_after_their_prefix(tiny_loading):
+    from unittest.mock import patch
+    from inference import runtime
+    from inference.shape_buckets import ShapeBuckets
+
+    prompts = [PREAMBLE + " hello", PREAMBLE + " patient summary", PREAMBLE + " the patient is stable today"]
+    results = {}
+    for enabled in (False, True):
+        shapes = ShapeBuckets(enabled=enabled, min_length=8)
+        with patch.object(runtime, "input_shapes", shapes), \
+             patch.object(runtime, "prefix_cache", PrefixCache(64 * 2**20, min_prefix_tokens=8)) as cache:
+            handler = runtime.ChatHandler("tiny-instruct", "cpu")
+            prefills = record_prefill_lengths(handler.model)
+            results[enabled] = [handler.infer(prompt, **dict(ARGS)) for prompt in prompts]
+        if enabled:
+            # The first prompt is bucketed whole; later ones reuse the preamble and prefill a bucketed suffix
+            assert cache.hits == 2 and cache.reused_tokens > 60
+            assert all(length in (8, 16, 32, 64, 128) for length in prefills[::ARGS["max_new_tokens"]])
+    # Padding is masked, so greedy outputs are unchanged
+    assert results[True] == results[False]
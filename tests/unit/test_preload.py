@@ -0,0 +1,78 @@
+from unittest.mock import MagicMock, patch
+
+from inference import generic_inference, runtime
+from inference.preload import load_preload_manifest, parse_preload_models, preload_handlers, warmup_prompt
+
+
+def test_parse_env_models():
+    entries = parse_preload_models("/models/a, /models/a=/adapters/x,")
+    assert [(e.base_model_path, e.adapter_path) for e in entries] == [
+        ("/models/a", None),
+        ("/models/a", "/adapters/x"),
+    ]
+
+
+def test_load_yaml_manifest(tmp_path):
+    path = tmp_path / "preload.yml"
+    path.write_text(
+        "warmup_tokens: [16, 64]\n"
+        "models:\n"
+        "  - base_model_path: /models/a\n"
+        "  - base_model_path: /models/a\n"
+        "    adapter_path: /adapters/x\n"
+        "    warmup_tokens: [8]\n"
+    )
+    entries, warmup_tokens = load_preload_manifest(str(path))
+    assert warmup_tokens == [16, 64]
+    assert entries[0].warmup_tokens is None
+    assert (entries[1].adapter_path, entries[1].warmup_tokens) == ("/adapters/x", [8])
+
+
+def test_warmup_prompt_length(tiny_tokenizer):
+    prompt = warmup_prompt(tiny_tokenizer, 20)
+    assert len(tiny_tokenizer(prompt, add_special_tokens=False)["input_ids"]) == 20
+
+
+def test_preload_builds_and_warms_handlers(tiny_loading):
+    entries = parse_preload_models("/models/tiny")
+    reports = preload_handlers(
+        entries,
+        lambda base, adapter: runtime.build_handler(base, "cpu", adapter),
+        default_warmup_tokens=[4, 16],
+        max_new_tokens=2,
+    )
+    assert tiny_loading == ["/models/tiny"]
+    assert set(reports[0]["warmup_seconds"]) == {4, 16}
+    assert reports[0]["load_seconds"] >= 0
+
+
+def test_failed_entry_is_reported_and_skipped():
+    def get_handler(base, adapter):
+        raise OSError("missing weights")
+
+    reports = preload_handlers(parse_preload_models("/models/gone"), get_handler)
+    assert reports[0]["error"] == "missing weights"
+
+
+def test_consuming_starts_after_preload(tiny_loading):
+    events = []
+
+    def connect(*args, **kwargs):
+        events.append("connect")
+        connection = MagicMock()
+        connection.channel.return_value.start_consuming.side_effect = lambda: events.append("consume")
+        return connection
+
+    build_handler = runtime.build_handler
+
+    def build(*args):
+        events.append("load")
+        return build_handler(*args)
+
+    with patch.object(generic_inference, "PRELOAD_MODELS", "/models/tiny"), \
+         patch.object(runtime, "build_handler", side_effect=build), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "WARMUP_PROMPT_TOKENS", "4"), \
+         patch("inference.generic_inference.pika.BlockingConnection", side_effect=connect):
+        generic_inference.main()
+    assert events == ["load", "connect", "consume"]
@@ -0,0 +1,85 @@
+import json
+import time
+import types
+from unittest.mock import MagicMock, patch
+
+from inference import generic_inference
+from inference.batching import BatchScheduler, batch_key, class_queue, deadline_passed, priority_of
+
+
+def msg(cid, priority=None, deadline=None, model="m"):
+    m = {"conversation_id": cid, "base_model_path": model, "input": [{"role": "user", "content": "hi"}]}
+    if priority:
+        m["priority"] = priority
+    if deadline is not None:
+        m["deadline"] = deadline
+    return m
+
+
+def method(tag):
+    return types.SimpleNamespace(delivery_tag=tag)
+
+
+def ids(groups):
+    return [[p.message["conversation_id"] for p in g] for g in groups]
+
+
+def test_priority_classes_and_queues():
+    assert priority_of(msg("1")) == "interactive"
+    assert priority_of(msg("1", priority="bogus")) == "interactive"
+    assert priority_of(msg("1", priority="batch")) == "batch"
+    assert class_queue("engineered_prompt", "interactive") == "engineered_prompt"
+    assert class_queue("engineered_prompt", "batch") == "engineered_prompt_batch"
+    assert batch_key(msg("1")) != batch_key(msg("2", priority="batch"))
+
+
+def test_deadlines():
+    assert deadline_passed(msg("1", deadline=time.time() - 1))
+    assert not deadline_passed(msg("1", deadline=time.time() + 60))
+    assert not deadline_passed(msg("1"))
+
+
+def test_interactive_served_before_batch_and_batch_deferred():
+    groups = []
+    conn = MagicMock()
+    s = BatchScheduler(groups.append, max_batch_size=8, max_wait=1.0, connection=conn)
+    s.submit("ch", method(1), None, msg("b1", priority="batch"))
+    s.submit("ch", method(2), None, msg("i1"))
+    s.flush()
+    assert ids(groups) == [["i1"]]
+    # Batch work is flushed on the next turn of the event loop
+    assert conn.call_later.call_args.args[0] == 0
+    s.submit("ch", method(3), None, msg("i2", model="other"))
+    s.flush()
+    assert ids(groups) == [["i1"], ["i2"]]
+    s.flush()
+    assert ids(groups) == [["i1"], ["i2"], ["b1"]]
+
+
+def test_earliest_deadline_group_first():
+    groups = []
+    s = BatchScheduler(groups.append, max_batch_size=8, max_wait=1.0, connection=MagicMock())
+    now = time.time()
+    s.submit("ch", method(1), None, msg("late", model="a", deadline=now + 60))
+    s.submit("ch", method(2), None, msg("soon", model="b", deadline=now + 5))
+    s.flush()
+    assert ids(groups) == [["soon"], ["late"]]
+
+
+def test_expired_request_fails_fast_without_loading(tiny_loading):
+    connection = MagicMock()
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1):
+        generic_inference.main()
+        consumed = [c.kwargs["queue"] for c in connection.channel.return_value.basic_consume.call_args_list]
+        on_message = connection.channel.return_value.basic_consume.call_args.kwargs["on_message_callback"]
+        channel = MagicMock()
+        body = json.dumps(dict(msg("late", model="/models/tiny"), deadline=time.time() - 1)).encode()
+        on_message(channel, method(1), None, body)
+
+    assert consumed == ["engineered_prompt", "engineered_prompt_batch"]
+    response = json.loads(channel.basic_publish.call_args.kwargs["body"])
+    assert response["error"] == "deadline_exceeded"
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+    assert tiny_loading == []
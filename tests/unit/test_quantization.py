@@ -0,0 +1,185 @@
+import json
+
+import pytest
+import torch
+
+from inference.quantization import (
+    QuantizedLinear,
+    fp8_supported,
+    module_bytes,
+    parse_quantize_models,
+    quantization_for,
+    quantize_model,
+)
+
+ARGS = {"max_new_tokens": 8, "do_sample": False}
+
+
+def relative_error(linear, quantized, x):
+    expected = linear(x)
+    return ((quantized(x) - expected).norm() / expected.norm()).item()
+
+
+@pytest.mark.parametrize("mode, group_size, max_error, max_ratio", [
+    ("int8", 128, 0.02, 0.3),
+    ("int4", 32, 0.15, 0.4),
+    ("int4", 16, 0.15, 0.4),
+    ("int4", 48, 0.15, 0.4),
+])
+def test_quantized_linear_is_close_and_smaller(mode, group_size, max_error, max_ratio):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(64, 32)
+    x = torch.randn(3, 5, 64)
+    quantized = QuantizedLinear(linear, mode, group_size)
+    # The fused kernel takes groups of 32 to 256 that divide the input channels
+    assert quantized.fused == (group_size in (32, 128))
+    assert relative_error(linear, quantized, x) < max_error
+    assert torch.allclose(quantized.dequantize() @ x[0, 0] + linear.bias, quantized(x)[0, 0], atol=1e-4)
+    # float32 weights here: a quarter for int8, an eighth plus the group scales for int4
+    weight_bytes = quantized.qweight.nbytes + quantized.scale.nbytes
+    assert weight_bytes < max_ratio * linear.weight.nbytes
+
+
+@pytest.mark.skipif(not fp8_supported("cpu"), reason="no float8 support")
+def test_fp8_linear():
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(64, 32, bias=False)
+    quantized = QuantizedLinear(linear, "fp8")
+    assert quantized.qweight.element_size() == 1
+    assert relative_error(linear, quantized, torch.randn(4, 64)) < 0.05
+
+
+def test_unfused_layer_keeps_no_dequantized_copy():
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(64, 32)
+    quantized = QuantizedLinear(linear, "int4", group_size=48)
+    assert not quantized.fused
+    before = module_bytes(quantized)
+    x = torch.randn(2, 64)
+    assert torch.allclose(quantized(x), x @ quantized.dequantize().t() + linear.bias, atol=1e-5)
+    assert module_bytes(quantized) == before < module_bytes(linear)
+
+
+def test_fused_int4_dequantizes_in_blocks():
+    torch.manual_seed(0)
+    quantized = QuantizedLinear(torch.nn.Linear(64, 32, bias=False), "int4", group_size=32)
+    assert quantized.fused
+    assert torch.equal(quantized.dequantize(block_size=24), quantized.dequantize())
+    x = torch.randn(3, 64)
+    assert torch.allclose(x @ quantized.dequantize(block_size=16).t(), quantized(x), atol=1e-4)
+
+
+def test_quantization_mode_per_family():
+    families = parse_quantize_models("Llama-3.1-70B=int4, Med42=int8,broken,=int8")
+    assert families == {"Llama-3.1-70B": "int4", "Med42": "int8"}
+    assert quantization_for("/models/Llama-3.1-70B-Med42/", families) == "int4"
+    assert quantization_for("/models/Llama3-Med42-8B", families) == "int8"
+    assert quantization_for("/models/mistral", families, default="none") is None
+    assert quantization_for("/models/mistral", {}, default="INT8") == "int8"
+    with pytest.raises(ValueError):
+        quantization_for("/models/mistral", {}, default="int3")
+
+
+def test_quantize_model_keeps_lm_head_and_generates():
+    from tests.conftest import build_tiny_model
+
+    model = build_tiny_model()
+    before = module_bytes(model)
+    quantize_model(model, "int8")
+    assert type(model.lm_head) is torch.nn.Linear
+    assert isinstance(model.model.layers[0].mlp.down_proj, QuantizedLinear)
+    assert module_bytes(model) < before
+    output = model.generate(torch.tensor([[2, 64, 65]]), **ARGS)
+    assert output.shape == (1, 3 + ARGS["max_new_tokens"])
+
+
+def test_handlers_load_quantized(tiny_loading):
+    from inference.runtime import ChatHandler, build_handler
+
+    handler = ChatHandler("tiny-instruct", "cpu", quantization="int8")
+    assert handler.quantization == "int8"
+    assert isinstance(handler.model.model.layers[0].self_attn.q_proj, QuantizedLinear)
+    assert handler.infer("hello world", **ARGS)
+
+    handler = build_handler("/models/tiny-instruct", "cpu", quantization="none")
+    assert handler.quantization is None
+    assert type(handler.model.model.layers[0].self_attn.q_proj) is torch.nn.Linear
+
+
+def test_modes_without_a_fused_kernel_load_unquantized(capsys):
+    from unittest.mock import patch
+    from tests.conftest import build_tiny_model
+
+    before = module_bytes(build_tiny_model())
+    # fp8 has no fused kernel, nor do int8/int4 where the probe fails
+    model = quantize_model(build_tiny_model(), "fp8")
+    assert "Warning: no fused fp8 kernel" in capsys.readouterr().out
+    with patch("inference.quantization.fused_kernel_supported", return_value=False):
+        model = quantize_model(build_tiny_model(), "int8")
+    assert not any(isinstance(m, QuantizedLinear) for m in model.modules())
+    model(torch.tensor([[2, 64, 65]]))
+    assert module_bytes(model) == before
+
+
+def test_int4_keeps_layers_the_kernel_cannot_take(capsys):
+    from tests.conftest import build_tiny_model
+
+    # The tiny model's 32 and 64 wide layers fit groups of 32 but not of 128
+    model = quantize_model(build_tiny_model(), "int4", group_size=32)
+    assert isinstance(model.model.layers[0].self_attn.q_proj, QuantizedLinear)
+    assert all(m.fused for m in model.modules() if isinstance(m, QuantizedLinear))
+    model = quantize_model(build_tiny_model(), "int4", group_size=128)
+    assert type(model.model.layers[0].self_attn.q_proj) is torch.nn.Linear
+    assert "kept 14 linear layer(s) unquantized" in capsys.readouterr().out
+
+
+def test_quantized_models_load_on_the_host(tiny_loading):
+    from unittest.mock import patch
+    from inference import runtime
+
+    with patch.object(runtime, "load_model", wraps=runtime.load_model) as load:
+        handler = runtime.ChatHandler("tiny-instruct", "meta", quantization="int8")
+    # Only the quantized layers reach the device
+    assert load.call_args.args[2] == "cpu"
+    q_proj = handler.model.model.layers[0].self_attn.q_proj
+    assert isinstance(q_proj, QuantizedLinear) and q_proj.qweight.device.type == "meta"
+    assert {parameter.device.type for parameter in handler.model.parameters()} == {"meta"}
+
+
+def test_adapter_handlers_warn_they_are_not_quantized(tiny_loading, capsys):
+    from inference.runtime import adapter_quantization
+
+    assert adapter_quantization("int4", "/models/base", "/adapters/a") is None
+    assert "Warning: int4 quantization is not applied to adapters" in capsys.readouterr().out
+    assert adapter_quantization("none", "/models/base", "/adapters/a") is None
+    assert capsys.readouterr().out == ""
+
+
+def test_quality_check_reports_each_mode(tiny_loading, tmp_path, capsys):
+    from inference import quantization_check
+
+    prompts = tmp_path / "prompts.jsonl"
+    prompts.write_text('"hello world"\n{"input": [{"role": "user", "content": "the patient"}]}\n')
+    output = tmp_path / "report.json"
+    code = quantization_check.main([
+        "--model", "/models/tiny-instruct", "--modes", "int8,int4", "--prompts", str(prompts),
+        "--max-new-tokens", "6", "--output", str(output), "--min-top1", "0",
+    ])
+    assert code == 0
+    report = json.loads(output.read_text())
+    assert report["prompts"] == 2 and set(report["modes"]) == {"int8", "int4"}
+    for stats in report["modes"].values():
+        assert 0 <= stats["exact_match"] <= 1 and 0 <= stats["top1_agreement"] <= 1
+        assert stats["kl_divergence"] >= 0 and stats["generating_memory_ratio"] <= 1
+    int8, int4 = report["modes"]["int8"], report["modes"]["int4"]
+    assert int8["quantized"] == "int8" and int8["top1_agreement"] > 0.5
+    assert int8["memory_ratio"] < 1 and int8["generating_memory_ratio"] < 1
+    # Groups of 128 do not fit these layers, so int4 loads the model unquantized
+    assert int4["quantized"] is None and int4["memory_ratio"] == 1 and int4["exact_match"] == 1
+
+
+def test_prefix_agreement():
+    from inference.quantization_check import prefix_agreement
+
+    assert prefix_agreement([1, 2, 3, 4], [1, 2, 5, 4]) == 0.5
+    assert prefix_agreement([], [1]) == 1.0
@@ -0,0 +1,102 @@
+import pytest
+
+from inference import response_cache as rc
+from inference.response_cache import ResponseCache, is_deterministic, response_key
+
+
+@pytest.mark.parametrize("args,expected", [
+    ({"do_sample": False}, True),
+    ({"do_sample": True, "seed": 7}, True),
+    ({"do_sample": True}, False),
+    ({"max_new_tokens": 8}, False),
+    (None, False),
+])
+def test_is_deterministic(args, expected):
+    assert is_deterministic(args) is expected
+
+
+def test_key_depends_on_every_input():
+    base = response_key("m", None, "prompt", {"do_sample": False, "max_new_tokens": 8})
+    assert base == response_key("m", None, "prompt", {"max_new_tokens": 8, "do_sample": False})
+    assert base != response_key("m", "/models/a", "prompt", {"do_sample": False, "max_new_tokens": 8})
+    assert base != response_key("m", None, "prompt!", {"do_sample": False, "max_new_tokens": 8})
+    assert base != response_key("m", None, "prompt", {"do_sample": False, "max_new_tokens": 9})
+    assert base == response_key("m", None, "prompt", {"do_sample": False, "max_new_tokens": 8}, None)
+    assert base != response_key("m", None, "prompt", {"do_sample": False, "max_new_tokens": 8}, "int8")
+
+
+def test_key_follows_the_served_quantization(monkeypatch):
+    from inference import quantization_modes
+
+    monkeypatch.setattr(quantization_modes, "QUANTIZE_MODELS", "Med42=int4")
+    assert quantization_modes.handler_quantization("/models/Llama3-Med42-8B") == "int4"
+    # Adapters are served by an unquantized base model
+    assert quantization_modes.handler_quantization("/models/Llama3-Med42-8B", "/adapters/a") is None
+    assert quantization_modes.handler_quantization("/models/mistral") is None
+
+
+def test_memory_tier_is_lru():
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    cache.put("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    ResponseCache(max_entries=4, disk_dir=str(tmp_path)).put("k" * 64, "stored")
+    fresh = ResponseCache(max_entries=4, disk_dir=str(tmp_path))
+    assert fresh.get("k" * 64) == "stored"
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rc.time, "time", lambda: now[0])
+    cache = ResponseCache(max_entries=4, disk_dir=str(tmp_path), ttl=60)
+    cache.put("x" * 64, "old")
+    now[0] += 61
+    assert cache.get("x" * 64) is None
+    assert not any(p.suffix == ".json" for p in tmp_path.rglob("*"))
+
+
+def test_consumer_publishes_cached_results_without_loading(tiny_loading, tmp_path):
+    import json
+    from unittest.mock import MagicMock, patch
+
+    from inference import generic_inference, runtime
+    from transformers import GenerationMixin
+
+    body = json.dumps({
+        "conversation_id": "c1",
+        "base_model_path": "/models/tiny",
+        "input": [{"role": "user", "content": "hello world"}],
+        "generation_args": {"max_new_tokens": 4, "do_sample": False},
+    }).encode()
+
+    def consume(tag):
+        """Deliver body to a freshly started consumer, returning its published responses"""
+        connection = MagicMock()
+        channel = connection.channel.return_value
+        with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+             patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+             patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+             patch.object(generic_inference, "RESPONSE_CACHE_MAX_ENTRIES", 16), \
+             patch.object(generic_inference, "RESPONSE_CACHE_DIR", str(tmp_path)):
+            generic_inference.main()
+            on_message = channel.basic_consume.call_args.kwargs["on_message_callback"]
+            on_message(channel, MagicMock(delivery_tag=tag), None, body)
+        return [json.loads(c.kwargs["body"]) for c in channel.basic_publish.call_args_list if c.kwargs["exchange"] == ""]
+
+    with patch.object(runtime, "build_handler", wraps=runtime.build_handler) as build, \
+         patch.object(GenerationMixin, "generate", autospec=True, side_effect=GenerationMixin.generate) as generate:
+        first = consume(1)
+        assert build.call_count == 1 and generate.call_count == 1
+        # A restarted consumer finds the result in the disk tier
+        second = consume(2)
+        assert build.call_count == 1 and generate.call_count == 1
+
+    assert "cached" not in first[0]
+    assert second[0]["cached"] is True and second[0]["result"] == first[0]["result"]
@@ -0,0 +1,85 @@
+import json
+from unittest.mock import MagicMock
+
+from pika.exceptions import UnroutableError
+
+from inference.router import Router, WorkerTable, worker_status
+
+
+def status(worker_id, loaded=(), backlog=0):
+    return worker_status(worker_id, f"inference_worker_{worker_id}", [(b, a, "hpu") for b, a in loaded], backlog)
+
+
+def test_status_leaves_out_draft_models():
+    s = worker_status("0", "q", [("/m/a", None, "hpu"), ("draft", "/m/d", "hpu")], 3)
+    assert s["loaded"] == [["/m/a", None]]
+    assert s["backlog"] == 3
+
+
+def test_routes_to_worker_holding_the_model():
+    table = WorkerTable()
+    table.update(status("0", [("/m/a", None)], backlog=5), now=0)
+    table.update(status("1", [("/m/b", None)]), now=0)
+    assert table.choose(("/m/a", None), now=1).worker_id == "0"
+    assert table.choose(("/m/b", None), now=1).worker_id == "1"
+    assert table.stats()["cold_routes"] == 0
+
+
+def test_adapter_follows_its_base_model():
+    table = WorkerTable()
+    table.update(status("0", [("/m/a", "/ad/x")], backlog=3), now=0)
+    table.update(status("1"), now=0)
+    assert table.choose(("/m/a", "/ad/y"), now=1).worker_id == "0"
+
+
+def test_cold_model_goes_to_least_loaded_worker_once():
+    table = WorkerTable()
+    table.update(status("0", backlog=4), now=0)
+    table.update(status("1", backlog=1), now=0)
+    first = table.choose(("/m/new", None), now=1)
+    assert first.worker_id == "1"
+    # The burst sticks to the worker loading the model, even as its load grows
+    for _ in range(5):
+        assert table.choose(("/m/new", None), now=2).worker_id == "1"
+    assert table.stats()["cold_routes"] == 1
+
+
+def test_backlogged_resident_worker_is_passed_over():
+    table = WorkerTable(max_backlog=10)
+    table.update(status("0", [("/m/a", None)], backlog=20), now=0)
+    table.update(status("1"), now=0)
+    assert table.choose(("/m/a", None), now=1).worker_id == "1"
+
+
+def test_silent_workers_are_skipped():
+    table = WorkerTable(status_ttl=10)
+    table.update(status("0", [("/m/a", None)]), now=0)
+    table.update(status("1"), now=15)
+    assert table.choose(("/m/a", None), now=20).worker_id == "1"
+
+
+def test_requests_wait_for_first_worker():
+    channel = MagicMock()
+    router = Router(channel)
+    method = MagicMock(delivery_tag=7)
+    router.on_request(channel, method, None, json.dumps({"base_model_path": "/m/a"}).encode())
+    channel.basic_publish.assert_not_called()
+
+    router.on_status(channel, None, None, json.dumps(status("3")).encode())
+    assert channel.basic_publish.call_args.kwargs["routing_key"] == "inference_worker_3"
+    channel.basic_ack.assert_called_once_with(delivery_tag=7)
+    assert not router.waiting
+
+
+def test_forward_the_broker_did_not_take_is_requeued():
+    channel = MagicMock()
+    channel.basic_publish.side_effect = UnroutableError([])
+    router = Router(channel)
+    router.on_status(channel, None, None, json.dumps(status("0")).encode())
+    router.on_request(channel, MagicMock(delivery_tag=4), None, json.dumps({"base_model_path": "/m/a"}).encode())
+
+    assert channel.basic_publish.call_args.kwargs["mandatory"] is True
+    channel.confirm_delivery.assert_called_once()
+    channel.basic_nack.assert_called_once_with(delivery_tag=4, requeue=True)
+    channel.basic_ack.assert_not_called()
+
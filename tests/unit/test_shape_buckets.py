@@ -0,0 +1,58 @@
+from unittest.mock import patch
+
+import torch
+
+from inference import runtime
+from inference.shape_buckets import ShapeBuckets, bucket_length, left_pad
+
+
+def test_bucket_lengths():
+    assert bucket_length(3) == 16
+    assert bucket_length(17) == 32
+    assert bucket_length(64) == 64
+    assert bucket_length(200, max_length=256) == 256
+    # Inputs beyond the cap are left as they are
+    assert bucket_length(300, max_length=200) == 300
+
+
+def test_left_pad_masks_padding():
+    inputs = {"input_ids": torch.tensor([[5, 6, 7]]), "attention_mask": torch.tensor([[1, 1, 1]])}
+    padded = left_pad(inputs, 6, pad_token_id=0)
+    assert padded["input_ids"].tolist() == [[0, 0, 0, 5, 6, 7]]
+    assert padded["attention_mask"].tolist() == [[0, 0, 0, 1, 1, 1]]
+
+
+def test_padding_after_a_cached_prefix_goes_before_the_last_token():
+    shapes = ShapeBuckets(enabled=True, min_length=4)
+    inputs = {"input_ids": torch.tensor([[1, 2, 3, 4, 5, 6]]), "attention_mask": torch.ones(1, 6, dtype=torch.long)}
+    padded = shapes.prepare(inputs, pad_token_id=0, prefix_length=4)
+    assert padded["input_ids"].tolist() == [[1, 2, 3, 4, 5, 0, 0, 6]]
+    assert padded["attention_mask"].tolist() == [[1, 1, 1, 1, 1, 0, 0, 1]]
+
+
+def run_prompts(enabled, prompts):
+    shapes = ShapeBuckets(enabled=enabled, min_length=8)
+    with patch.object(runtime, "input_shapes", shapes):
+        handler = runtime.ChatHandler("/models/tiny", "cpu")
+        results = [handler.infer(p, max_new_tokens=4, do_sample=False) for p in prompts]
+    return shapes, results
+
+
+def test_bucketing_reduces_distinct_shapes(tiny_loading):
+    prompts = [" ".join(["patient"] * n) for n in range(1, 13)]
+    plain, plain_results = run_prompts(False, prompts)
+    bucketed, bucketed_results = run_prompts(True, prompts)
+
+    assert plain.stats()["distinct_shapes"] == len(prompts)
+    assert bucketed.stats()["distinct_shapes"] <= 2
+    # Padding is masked, so greedy outputs are unchanged
+    assert bucketed_results == plain_results
+
+
+def test_pipeline_batch_is_bucketed(tiny_loading):
+    shapes = ShapeBuckets(enabled=True, min_length=8)
+    with patch.object(runtime, "input_shapes", shapes):
+        handler = runtime.PipelineHandler("/models/tiny", "cpu")
+        results = handler.infer_batch(["hello world", "the patient is"], max_new_tokens=2, do_sample=False)
+    assert len(results) == 2
+    assert list(shapes.shapes) == [(2, 8)]
@@ -0,0 +1,52 @@
+from unittest.mock import patch
+
+from tests.conftest import build_tiny_model
+
+from inference import generic_inference
+from inference.speculative import draft_model_for, generate_with_draft, parse_draft_models, speculation_stats
+
+
+def test_draft_mapping_uses_longest_family():
+    drafts = parse_draft_models("Llama-3=/models/Llama-3.2-1B, Llama-3.1-70B=/models/Llama-3.1-8B")
+    assert draft_model_for("/models/Llama-3.2-3B-Instruct", drafts) == "/models/Llama-3.2-1B"
+    assert draft_model_for("/models/Llama-3.1-70B-Instruct", drafts) == "/models/Llama-3.1-8B"
+    assert draft_model_for("/models/granite-3.1-8b", drafts) is None
+    # A draft is never used to assist itself
+    assert draft_model_for("/models/Llama-3.2-1B", drafts) is None
+
+
+def test_stats_from_forward_counts():
+    stats = speculation_stats(new_tokens=10, target_forwards=4, draft_forwards=12, seconds=2.0)
+    assert stats["acceptance_rate"] == 0.5
+    assert stats["tokens_per_second"] == 5.0
+
+
+def test_identical_draft_accepts_every_token(tiny_tokenizer):
+    model, draft = build_tiny_model(), build_tiny_model()
+    inputs = tiny_tokenizer("hello world the patient", return_tensors="pt")
+    plain = model.generate(**inputs, max_new_tokens=12, min_new_tokens=12, do_sample=False, pad_token_id=0)
+    outputs, stats = generate_with_draft(
+        model, draft, inputs, max_new_tokens=12, min_new_tokens=12, do_sample=False, pad_token_id=0
+    )
+    assert outputs.tolist() == plain.tolist()
+    assert stats["new_tokens"] == 12
+    assert stats["target_forwards"] < 12
+    assert stats["acceptance_rate"] > 0.9
+
+
+def test_chat_handler_greedy_output_unchanged_with_draft(tiny_loading):
+    handler = generic_inference.ChatHandler("/models/tiny", "cpu")
+    args = {"max_new_tokens": 8, "min_new_tokens": 8, "do_sample": False}
+    plain = handler.infer("the patient summary", **args)
+    with patch("builtins.print") as printed:
+        assisted = handler.infer("the patient summary", assistant_model=build_tiny_model(seed=1), **args)
+    assert assisted == plain
+    assert any("acceptance rate" in str(call) for call in printed.call_args_list)
+
+
+def test_pipeline_handler_uses_draft(tiny_loading):
+    handler = generic_inference.PipelineHandler("/models/tiny", "cpu")
+    args = {"max_new_tokens": 6, "do_sample": False}
+    plain = generic_inference.extract_llama3_answer(handler.infer("hello world", **args))
+    assisted = handler.infer("hello world", assistant_model=build_tiny_model(), **args)
+    assert generic_inference.extract_llama3_answer(assisted) == plain
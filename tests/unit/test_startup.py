@@ -0,0 +1,66 @@
+import json
+import subprocess
+import sys
+from types import SimpleNamespace
+
+from inference.local_broker import LocalConnection
+from inference.startup_benchmark import benchmark_env, run_benchmark
+
+HEAVY_MODULES = ("torch", "transformers", "peft")
+
+
+def test_consumer_starts_without_heavy_imports():
+    script = (
+        "import json, sys\n"
+        "from unittest.mock import patch\n"
+        "from inference.local_broker import LocalConnection\n"
+        "with patch('pika.BlockingConnection', return_value=LocalConnection()):\n"
+        "    from inference import generic_inference\n"
+        "    generic_inference.main()\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], env=benchmark_env(), check=True, capture_output=True, text=True
+    ).stdout
+    assert json.loads(output.strip().splitlines()[-1]) == []
+
+
+def test_runtime_names_resolve_through_consumer_module():
+    from inference import generic_inference, runtime
+
+    assert generic_inference.ChatHandler is runtime.ChatHandler
+    assert generic_inference.compose_prompt([{"role": "user", "content": "hi"}]) == "hi"
+
+
+def test_benchmark_reports_import_and_ready():
+    report = run_benchmark(runs=1, include_runtime=False)
+    assert 0 < report["import"]["median"] <= report["ready"]["median"]
+
+
+def test_local_broker_respects_prefetch_and_acks():
+    connection = LocalConnection()
+    channel = connection.channel()
+    channel.basic_qos(prefetch_count=2)
+    received = []
+    channel.basic_consume(queue="q", on_message_callback=lambda ch, method, props, body: received.append(method))
+    for body in (b"1", b"2", b"3"):
+        channel.basic_publish(exchange="", routing_key="q", body=body)
+
+    assert channel.deliver() == 2
+    channel.basic_ack(delivery_tag=received[-1].delivery_tag, multiple=True)
+    assert channel.deliver() == 1
+    assert channel.pending() == 0
+
+
+def test_local_broker_timers_can_be_removed():
+    from inference.batching import BatchScheduler
+
+    connection = LocalConnection()
+    groups = []
+    scheduler = BatchScheduler(groups.append, max_batch_size=3, max_wait=60, connection=connection)
+    for tag in (1, 2):
+        scheduler.submit("ch", SimpleNamespace(delivery_tag=tag), None, {"base_model_path": "m", "input": "hi"})
+    # One timer armed for the pending batch, removed once the batch is full
+    assert scheduler._timer is not None and len(connection.timers) == 1
+    scheduler.submit("ch", SimpleNamespace(delivery_tag=3), None, {"base_model_path": "m", "input": "hi"})
+    assert len(groups) == 1 and connection.timers == []
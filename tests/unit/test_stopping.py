@@ -0,0 +1,200 @@
+from unittest.mock import patch
+
+from inference.speculative import ForwardCounter
+from inference.stopping import DEFAULT_STOP_SEQUENCES, parse_stop_sequences, stops_for, trim_at_stop
+
+ARGS = {"max_new_tokens": 12, "min_new_tokens": 12, "do_sample": False}
+
+
+def test_stops_combine_defaults_family_and_request():
+    model_stops = {"Med42": ["### Response:", "Patient:"], "Llama": ["</answer>"], "Mistral": ["[INST]"]}
+    strings, token_ids = stops_for(
+        "/models/Llama3-Med42-8B", stop="END", stop_token_ids=[7, True, "x"], model_stops=model_stops
+    )
+    assert strings == list(DEFAULT_STOP_SEQUENCES) + ["Patient:", "</answer>", "END"]
+    assert token_ids == [7]
+    assert stops_for("/models/a", stop=["### Instruction:", ""], model_stops={})[0] == list(DEFAULT_STOP_SEQUENCES)
+
+
+def test_parse_stop_sequences():
+    assert parse_stop_sequences('{"Med42": ["### Response:", 3], "x": "y"}') == {"Med42": ["### Response:"]}
+    assert parse_stop_sequences("not json") == {} and parse_stop_sequences("[]") == {}
+
+
+def test_trim_at_first_stop_after_start():
+    assert trim_at_stop("answer<|user|>more### Instruction:", ["### Instruction:", "<|user|>"]) == "answer"
+    assert trim_at_stop("<|user|>q answer<|user|>", ["<|user|>"], start=3) == "<|user|>q answer"
+    assert trim_at_stop("answer", []) == "answer"
+
+
+def test_leading_answer_header_is_removed_not_a_stop():
+    stops = list(DEFAULT_STOP_SEQUENCES)
+    assert trim_at_stop("\n### Response:\nanswer\n### Response:\nagain", stops) == "\nanswer\n"
+    assert trim_at_stop("<|assistant|> answer <|assistant|> more", stops) == " answer "
+    assert trim_at_stop("prompt<|assistant|>answer<|user|>", stops, start=6) == "promptanswer"
+    assert trim_at_stop("answer ### Response: more", stops) == "answer "
+
+
+def test_criteria_skip_leading_answer_header(tiny_tokenizer):
+    import torch
+    from inference.runtime import StopSequenceCriteria
+
+    ids = lambda text: tiny_tokenizer(text, add_special_tokens=False)["input_ids"]
+    prompt = ids("hello world")
+    outputs = ["assistant", "assistant :", "assistant : the", "assistant : the patient", "assistant : the patient user :"]
+    # The word-level test vocabulary has no special tokens, its answer header is "assistant :"
+    with patch("inference.stopping.ANSWER_HEADERS", ("assistant :",)), \
+         patch("inference.runtime.ANSWER_HEADERS", ("assistant :",)):
+        criteria = StopSequenceCriteria(tiny_tokenizer, ["user :", "assistant :"], check_every=1)
+        done = [criteria(torch.tensor([prompt + ids(output)]), None).item() for output in outputs]
+    assert done == [False, False, False, False, True]
+
+
+def build_bpe_tokenizer():
+    """Byte-level BPE where "END" and " END" are two different single tokens"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {token: i for i, token in enumerate(["<eos>", "<|end|>", "Ġ", "E", "N", "D", "a", "b"])}
+    merges = [("E", "N"), ("EN", "D"), ("Ġ", "END")]
+    for first, second in merges:
+        vocab[first + second] = len(vocab)
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=merges))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<eos>")
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<|end|>"]})
+    return tokenizer
+
+
+def test_stop_strings_match_every_tokenization():
+    import torch
+    from inference.runtime import apply_stops
+
+    tokenizer = build_bpe_tokenizer()
+    args, stops = apply_stops(tokenizer, "/models/a", {"stop": ["END", "<|end|>"]})
+    # Only the exact special token joins the end-of-sequence ids
+    assert args["eos_token_id"] == [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|end|>")]
+    criteria = args["stopping_criteria"]
+    prompt = tokenizer("ab", add_special_tokens=False)["input_ids"]
+    continued = prompt + tokenizer(" END", add_special_tokens=False)["input_ids"]
+    assert len(continued) == len(prompt) + 1 and "END" in stops
+    assert criteria(torch.tensor([continued]), None).tolist() == [True]
+
+
+def generate(handler, prompt, **generation_args):
+    with ForwardCounter(handler.model) as counter:
+        result = handler.infer(prompt, **dict(ARGS, **generation_args))
+    return result, counter.calls
+
+
+def test_chat_handler_stops_at_strings_and_tokens(tiny_loading):
+    from inference.runtime import ChatHandler
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    baseline, baseline_forwards = generate(handler, "hello world")
+    words = baseline.split()
+    assert baseline_forwards == ARGS["max_new_tokens"]
+
+    # A multi-token stop string is matched on the tail while decoding
+    stop = " ".join(words[2:4])
+    result, forwards = generate(handler, "hello world", stop=stop)
+    assert result == baseline[:baseline.find(stop)]
+    assert forwards == 4
+
+    # A string that is one vocabulary token stops on that token
+    baseline, _ = generate(handler, "hello world", min_new_tokens=0)
+    words = baseline.split()
+    index = next(i for i, word in enumerate(words) if word not in words[:i] and i > 1)
+    result, forwards = generate(handler, "hello world", stop=[words[index]], min_new_tokens=0)
+    assert result == baseline[:baseline.find(words[index])] and forwards == index + 1
+
+    # Rows of a batch stop independently
+    prompts = ["hello world", "the patient"]
+    args = dict(ARGS, min_new_tokens=0)
+    unstopped = handler.infer_batch(prompts, **args)
+    stop = next(word for word in unstopped[1].split() if word not in unstopped[0])
+    results = handler.infer_batch(prompts, stop=stop, **args)
+    assert results == [unstopped[0], unstopped[1][:unstopped[1].find(stop)]]
+
+
+def test_pipeline_handler_stops(tiny_loading):
+    from inference.runtime import PipelineHandler
+
+    handler = PipelineHandler("/models/tiny", "cpu")
+    args = dict(ARGS, pad_token_id=0)
+    baseline = handler.infer("hello world", **args)
+    stop = " ".join(baseline.split()[1:3])
+    assert handler.infer("hello world", stop=stop, **args) == baseline[:baseline.find(stop)]
+
+
+def test_criteria_check_every_token_of_multi_token_steps(tiny_tokenizer):
+    import torch
+    from inference.runtime import StopSequenceCriteria
+
+    ids = lambda text: tiny_tokenizer(text, add_special_tokens=False)["input_ids"]
+    # The prompt holds the stop string itself, and steps add three tokens at a time
+    prompt = ids("hello the patient world")
+    steps = ["a is w1", "a is w1 the patient w2", "a is w1 the patient w2 w3 w4 w5"]
+    criteria = StopSequenceCriteria(tiny_tokenizer, ["the patient"])
+    criteria.prompt_length = len(prompt)
+    with patch.object(criteria, "_decode", wraps=criteria._decode) as decode:
+        done = [criteria(torch.tensor([prompt + ids(step)]), None).item() for step in steps]
+    # Matched on the tokens alone, without decoding on any step
+    assert done == [False, True, True] and decode.call_count == 0
+
+
+def test_criteria_decode_new_tokens_every_few_steps(tiny_tokenizer):
+    import torch
+    from inference.runtime import StopSequenceCriteria
+
+    ids = lambda text: tiny_tokenizer(text, add_special_tokens=False)["input_ids"]
+    prompt = ids("hello world")
+    output = ids("w1 w2 w3 w4 w5 w6 w7 w8")
+    criteria = StopSequenceCriteria(tiny_tokenizer, ["w3 w4"], check_every=4)
+    # Tokenized in context unlike on its own, the stop string is only found by decoding
+    criteria.token_sequences = []
+    criteria.prompt_length = len(prompt)
+    done = [criteria(torch.tensor([prompt + output[:n]]), None).item() for n in range(1, len(output) + 1)]
+    assert done == [False, False, False, True, True, True, True, True]
+
+
+def test_assisted_decoding_stops_mid_step(tiny_loading):
+    from inference.runtime import ChatHandler
+    from tests.conftest import build_tiny_model
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    baseline, _ = generate(handler, "hello world")
+    words = baseline.split()
+    stop = " ".join(words[3:5])
+    # An identical draft is always accepted, so each target pass adds several tokens
+    result, forwards = generate(handler, "hello world", stop=stop, assistant_model=build_tiny_model())
+    assert result == baseline[:baseline.find(stop)]
+    assert forwards < 5
+
+
+def test_streamed_chunks_end_before_stop(tiny_tokenizer):
+    from inference.streaming import ChunkStreamer
+
+    chunks = []
+    streamer = ChunkStreamer(tiny_tokenizer, chunks.append, min_interval=0, stop_strings=["<|user|>", "### Response:"])
+    for text in ["### Res", "ponse:\n", "The answer", " is 4. <|us", "er|> next", " question"]:
+        streamer.on_finalized_text(text)
+    streamer.on_finalized_text("", stream_end=True)
+    # The opening header is dropped, a partial stop string held back until it completes
+    assert chunks == ["\nThe answer", " is 4. "]
+    assert "".join(chunks) == trim_at_stop("### Response:\nThe answer is 4. <|user|> next question", DEFAULT_STOP_SEQUENCES)
+
+
+def test_streamed_generation_matches_trimmed_result(tiny_loading):
+    from inference.runtime import ChatHandler
+    from inference.streaming import ChunkStreamer
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    baseline, _ = generate(handler, "hello world")
+    stop = " ".join(baseline.split()[2:4])
+    chunks = []
+    streamer = ChunkStreamer(handler.tokenizer, chunks.append, min_interval=0, stop_strings=[stop])
+    result = handler.infer("hello world", streamer=streamer, stop=stop, **ARGS)
+    assert len(chunks) > 1 and stop not in "".join(chunks)
+    assert "".join(chunks).strip() == result.strip()
@@ -0,0 +1,151 @@
+from inference.batching import batch_key
+from inference.streaming import ChunkStreamer, StreamPublisher
+
+
+def test_publisher_numbers_chunks_and_marks_done():
+    sent = []
+    pub = StreamPublisher(lambda message, requeue: sent.append(message), "conv-1")
+    pub.chunk("Hel")
+    pub.chunk("lo")
+    pub.done("Hello")
+    assert [m["sequence"] for m in sent] == [0, 1, 2]
+    assert all(m["conversation_id"] == "conv-1" for m in sent)
+    assert [m["done"] for m in sent] == [False, False, True]
+    assert sent[-1]["result"] == "Hello"
+
+
+def test_delivered_stream_is_not_requeued():
+    sent = []
+    taken = iter([False, True, False, True])
+
+    def publish(message, requeue):
+        sent.append((message["sequence"], requeue))
+        return next(taken)
+
+    pub = StreamPublisher(publish, "conv-1")
+    pub.chunk("a")
+    pub.chunk("b")
+    pub.chunk("c")
+    pub.done("abc")
+    # Until a chunk is taken a failure requeues the request; after that only the done marker does
+    assert sent == [(0, True), (1, True), (2, False), (3, True)]
+    assert pub.streamed
+
+
+def test_redelivered_stream_starts_over():
+    sent = []
+    pub = StreamPublisher(lambda message, requeue: sent.append(message), "conv-1", restart=True)
+    pub.chunk("a")
+    pub.done("a")
+    assert sent[0]["restart"] is True and "restart" not in sent[1]
+
+
+def test_consumer_requeues_only_streams_not_yet_delivered(tiny_loading):
+    import json
+    from unittest.mock import MagicMock, patch
+
+    from pika.exceptions import NackError
+    from inference import generic_inference
+
+    connection = MagicMock()
+    channel = connection.channel.return_value
+    published = []
+
+    def basic_publish(**kwargs):
+        body = json.loads(kwargs["body"])
+        published.append(body)
+        # The broker drops the second chunk of the stream
+        if kwargs["exchange"] == "" and body.get("sequence") == 1:
+            raise NackError([])
+
+    channel.basic_publish.side_effect = basic_publish
+    body = json.dumps({
+        "conversation_id": "s1",
+        "base_model_path": "/models/tiny-instruct",
+        "input": [{"role": "user", "content": "hello world"}],
+        "generation_args": {"max_new_tokens": 6, "min_new_tokens": 6, "do_sample": False},
+        "stream": True,
+    }).encode()
+
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+         patch.object(generic_inference, "STREAM_MIN_INTERVAL_MS", 0):
+        generic_inference.main()
+        on_message = channel.basic_consume.call_args.kwargs["on_message_callback"]
+        on_message(channel, MagicMock(delivery_tag=1, redelivered=False), None, body)
+
+    assert sum("chunk" in message for message in published) > 2 and published[-1]["done"]
+    # The client already has the first chunk, so the request is not redelivered
+    channel.basic_nack.assert_not_called()
+
+
+def test_failed_generation_closes_its_stream(tiny_loading):
+    import json
+    from unittest.mock import MagicMock, patch
+
+    from inference import generic_inference
+
+    connection = MagicMock()
+    channel = connection.channel.return_value
+    published = []
+    channel.basic_publish.side_effect = lambda **kwargs: published.append(json.loads(kwargs["body"]))
+    put = ChunkStreamer.put
+    tokens = []
+
+    def failing_put(self, value):
+        # Generation fails after a few tokens have been streamed
+        tokens.append(value)
+        if len(tokens) > 3:
+            raise RuntimeError("device lost")
+        put(self, value)
+
+    body = json.dumps({
+        "conversation_id": "s1",
+        "base_model_path": "/models/tiny-instruct",
+        "input": [{"role": "user", "content": "hello world"}],
+        "generation_args": {"max_new_tokens": 6, "min_new_tokens": 6, "do_sample": False},
+        "stream": True,
+    }).encode()
+
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+         patch.object(generic_inference, "STREAM_MIN_INTERVAL_MS", 0), \
+         patch.object(ChunkStreamer, "put", failing_put):
+        generic_inference.main()
+        on_message = channel.basic_consume.call_args.kwargs["on_message_callback"]
+        on_message(channel, MagicMock(delivery_tag=1, redelivered=False), None, body)
+
+    stream = [message for message in published if message.get("conversation_id") == "s1"]
+    chunks = [message["chunk"] for message in stream if "chunk" in message]
+    assert chunks
+    assert stream[-1]["done"] is True and stream[-1]["error"] == "generation_failed"
+    assert stream[-1]["result"] == "".join(chunks)
+    assert [message["sequence"] for message in stream] == list(range(len(stream)))
+
+
+def test_streamed_chunks_reassemble_result(tiny_loading):
+    from inference.generic_inference import ChatHandler
+
+    handler = ChatHandler("tiny-instruct", "cpu")
+    chunks = []
+    streamer = ChunkStreamer(handler.tokenizer, chunks.append, min_interval=0)
+    args = {"max_new_tokens": 6, "min_new_tokens": 6, "do_sample": False}
+    result = handler.infer("hello world", streamer=streamer, **args)
+    assert len(chunks) > 1
+    assert "".join(chunks).strip() == result.strip()
+
+
+def test_streamer_coalesces_within_interval(tiny_tokenizer):
+    chunks = []
+    streamer = ChunkStreamer(tiny_tokenizer, chunks.append, min_interval=60)
+    streamer.on_finalized_text("a ")
+    streamer.on_finalized_text("b ")
+    streamer.on_finalized_text("c", stream_end=True)
+    assert chunks == ["a ", "b c"]
+
+
+def test_streaming_messages_are_not_batched_with_plain_ones():
+    base = {"base_model_path": "m", "input": []}
+    assert batch_key(dict(base, stream=True)) != batch_key(base)
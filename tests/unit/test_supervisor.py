@@ -0,0 +1,92 @@
+import json
+import sys
+import time
+
+from inference.supervisor import WorkerSupervisor, parse_devices, worker_env, write_metrics_targets
+
+
+def test_parse_devices():
+    assert parse_devices("hpu:0, hpu:3") == ["hpu:0", "hpu:3"]
+    assert parse_devices("cpu", cpu_workers=3) == ["cpu", "cpu", "cpu"]
+    assert parse_devices("") == []
+
+
+def test_worker_sees_only_its_card():
+    env = worker_env("hpu:3", 1, base_env={"HABANA_VISIBLE_DEVICES": "0,1,2,3", "METRICS_PORT": "9400"})
+    assert env["HABANA_VISIBLE_MODULES"] == "3"
+    # The container's card list is left to the habana runtime
+    assert env["HABANA_VISIBLE_DEVICES"] == "0,1,2,3"
+    assert env["INFERENCE_DEVICE"] == "hpu"
+    assert env["METRICS_PORT"] == "9401"
+    assert env["WORKER_ID"] == "1"
+
+
+def test_cuda_worker_is_pinned_by_visible_devices():
+    env = worker_env("cuda:1", 0, base_env={})
+    assert env["CUDA_VISIBLE_DEVICES"] == "1"
+    assert "HABANA_VISIBLE_MODULES" not in env
+
+
+def test_metrics_targets_cover_every_worker(tmp_path):
+    supervisor = WorkerSupervisor(
+        ["hpu:2", "hpu:5"], base_env={"METRICS_PORT": "9400"}, router_command=[sys.executable, "-V"]
+    )
+    path = tmp_path / "targets" / "inference.json"
+    write_metrics_targets(str(path), supervisor.workers)
+    targets = json.loads(path.read_text())
+    assert [t["targets"] for t in targets] == [["localhost:9400"], ["localhost:9401"]]
+    assert [t["labels"]["device"] for t in targets] == ["hpu:2", "hpu:5"]
+
+
+def test_cpu_workers_split_threads():
+    env = worker_env("cpu", 0, base_env={}, cpu_threads=2)
+    assert env["INFERENCE_DEVICE"] == "cpu"
+    assert env["OMP_NUM_THREADS"] == "2"
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_crashed_workers_are_restarted():
+    supervisor = WorkerSupervisor(
+        ["cpu", "cpu"],
+        command=[sys.executable, "-c", "import sys; sys.exit(3)"],
+        base_env={},
+        backoff=0.0,
+    )
+
+    def restarted():
+        supervisor.poll()
+        return all(worker.restarts >= 2 for worker in supervisor.workers)
+
+    assert wait_for(restarted)
+    supervisor.stop(grace=1)
+
+
+def test_stop_terminates_running_workers():
+    supervisor = WorkerSupervisor(["cpu"], command=[sys.executable, "-c", "import time; time.sleep(60)"], base_env={})
+    supervisor.poll()
+    process = supervisor.workers[0].process
+    supervisor.stop(grace=5)
+    assert process.poll() is not None
+    supervisor.poll()
+    assert supervisor.workers[0].restarts == 0
+
+
+def test_router_is_supervised_alongside_workers():
+    supervisor = WorkerSupervisor(
+        ["cpu"],
+        command=[sys.executable, "-c", "import time; time.sleep(60)"],
+        base_env={},
+        router_command=[sys.executable, "-c", "import time; time.sleep(60)"],
+    )
+    supervisor.poll()
+    assert len(supervisor.workers) == 2
+    assert all(worker.process is not None for worker in supervisor.workers)
+    supervisor.stop(grace=5)
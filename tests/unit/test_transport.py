@@ -0,0 +1,158 @@
+import importlib.util
+import json
+import os
+import time
+from unittest.mock import MagicMock, call, patch
+
+from pika.exceptions import NackError, UnroutableError
+
+from inference.batching import class_queue
+from inference.local_broker import LocalConnection
+from inference.transport import Transport
+
+COT_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "prompt-eng", "cot_1.py")
+
+
+def delivered(transport, channel, tags):
+    for tag in tags:
+        transport.delivered(channel, tag)
+
+
+def test_completed_requests_share_one_ack():
+    channel = MagicMock()
+    transport = Transport(LocalConnection(), ack_batch=3, ack_interval=10)
+    delivered(transport, channel, [1, 2, 3, 4])
+
+    transport.settle(channel, [2])
+    transport.settle(channel, [1])
+    channel.basic_ack.assert_not_called()
+    transport.settle(channel, [3])
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+    # Nothing else in progress, so the last one is acked straight away
+    transport.settle(channel, [4])
+    assert channel.basic_ack.call_args == call(delivery_tag=4)
+    assert transport.stats()["acked"] == 4 and transport.stats()["ack_frames"] == 2
+    channel.confirm_delivery.assert_called_once()
+
+
+def test_ack_never_covers_requests_in_progress():
+    channel = MagicMock()
+    connection = LocalConnection()
+    transport = Transport(connection, ack_batch=2, ack_interval=0.01)
+    delivered(transport, channel, [1, 2, 3])
+
+    transport.settle(channel, [2, 3])
+    channel.basic_ack.assert_not_called()
+    time.sleep(0.02)
+    connection.process_data_events()
+    # The flush timer acks them one by one, leaving tag 1 alone
+    assert channel.basic_ack.call_args_list == [call(delivery_tag=2), call(delivery_tag=3)]
+
+
+def test_rejected_publish_requeues_request():
+    channel = MagicMock()
+    channel.basic_publish.side_effect = NackError([])
+    round_trips = []
+    transport = Transport(on_round_trip=round_trips.append)
+    transport.delivered(channel, 5)
+
+    assert not transport.publish(channel, "out", "{}", delivery_tag=5)
+    transport.settle(channel, [5])
+    channel.basic_nack.assert_called_once_with(delivery_tag=5, requeue=True)
+    channel.basic_ack.assert_not_called()
+    assert round_trips == [] and transport.stats()["requeued"] == 1
+
+    channel.basic_publish.side_effect = None
+    assert transport.publish(channel, "out", "{}")
+    assert len(round_trips) == 1 and "round_trip_ms_p99" in transport.stats()
+
+
+def test_unroutable_result_requeues_request():
+    channel = MagicMock()
+    channel.basic_publish.side_effect = UnroutableError([])
+    transport = Transport()
+    transport.delivered(channel, 7)
+
+    assert not transport.publish(channel, "missing_queue", "{}", delivery_tag=7)
+    assert channel.basic_publish.call_args.kwargs["mandatory"] is True
+    transport.settle(channel, [7])
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+
+
+def test_worker_status_goes_through_transport_and_reuses_queue_depth(tiny_loading):
+    from inference import generic_inference
+    from inference.batching import PRIORITY_CLASSES
+
+    connection = MagicMock()
+    channel = connection.channel.return_value
+    body = json.dumps({
+        "conversation_id": 1,
+        "base_model_path": "/models/tiny",
+        "input": [{"role": "user", "content": "hello world"}],
+        "generation_args": {"max_new_tokens": 2, "do_sample": False},
+    }).encode()
+
+    with patch("inference.generic_inference.pika.BlockingConnection", return_value=connection), \
+         patch.object(generic_inference, "INFERENCE_DEVICE", "cpu"), \
+         patch.object(generic_inference, "MAX_BATCH_SIZE", 1), \
+         patch.object(generic_inference, "MODEL_ROUTING", True):
+        generic_inference.main()
+        on_message = channel.basic_consume.call_args.kwargs["on_message_callback"]
+        for tag in (1, 2):
+            on_message(channel, MagicMock(delivery_tag=tag), None, body)
+
+    statuses = [
+        c.kwargs for c in channel.basic_publish.call_args_list
+        if c.kwargs["exchange"] == generic_inference.WORKER_STATUS_EXCHANGE
+    ]
+    # The heartbeat, then the load of the model; the second request changes nothing
+    assert len(statuses) == 2 and not any(c["mandatory"] for c in statuses)
+    assert json.loads(statuses[1]["body"])["loaded"] == [["/models/tiny", None]]
+    passive = [c for c in channel.queue_declare.call_args_list if c.kwargs.get("passive")]
+    assert len(passive) == len(PRIORITY_CLASSES)
+
+
+def test_prompt_engineering_consumer_acks_after_publishing():
+    spec = importlib.util.spec_from_file_location("cot_1", COT_PATH)
+    cot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cot)
+    outputs = []
+
+    def on_ready(channel):
+        for n in range(5):
+            message = {"conversation_id": n, "input": [{"role": "user", "content": f"question {n}"}]}
+            channel.basic_publish(exchange="", routing_key="user_prompts", body=json.dumps(message))
+
+    def on_publish(exchange, routing_key, body, properties):
+        if routing_key == "engineered_prompt":
+            outputs.append(json.loads(body)["conversation_id"])
+
+    connection = LocalConnection(on_ready=on_ready, on_publish=on_publish)
+    with patch("pika.BlockingConnection", return_value=connection):
+        cot.main()
+
+    channel = connection.channels[0]
+    assert outputs == list(range(5))
+    assert channel.confirming and not channel.unacked and channel.pending() == 0
+
+
+def test_prompt_engineering_routes_by_priority_class():
+    spec = importlib.util.spec_from_file_location("cot_1", COT_PATH)
+    cot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cot)
+    routed = {}
+
+    def on_ready(channel):
+        for n, priority in enumerate(["batch", None, "unknown"]):
+            message = {"conversation_id": n, "priority": priority, "input": [{"role": "user", "content": "question"}]}
+            channel.basic_publish(exchange="", routing_key="user_prompts", body=json.dumps(message))
+
+    def on_publish(exchange, routing_key, body, properties):
+        if routing_key != "user_prompts":
+            routed[json.loads(body)["conversation_id"]] = routing_key
+
+    connection = LocalConnection(on_ready=on_ready, on_publish=on_publish)
+    with patch("pika.BlockingConnection", return_value=connection):
+        cot.main()
+
+    assert routed == {0: class_queue("engineered_prompt", "batch"), 1: "engineered_prompt", 2: "engineered_prompt"}
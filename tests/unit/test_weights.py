@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+import pytest
+import torch
+from safetensors.torch import load_file
+from transformers import AutoModelForCausalLM
+
+from inference import weights
+from inference.memory import LoadMemory, process_memory
+from tests.conftest import build_tiny_model
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    model = build_tiny_model()
+    model.save_pretrained(tmp_path, max_shard_size="20KB")
+    return tmp_path, model
+
+
+def test_mmap_tensors_match_file(checkpoint):
+    path, _ = checkpoint
+    shards = weights.safetensors_shards(str(path))
+    assert len(shards) > 1
+    mapped = weights.mmap_safetensors(shards[0])
+    expected = load_file(shards[0])
+    assert mapped.keys() == expected.keys()
+    for name, tensor in expected.items():
+        assert torch.equal(mapped[name], tensor)
+    # The mapping is copy-on-write, writes never reach the checkpoint
+    name = next(iter(mapped))
+    mapped[name].zero_()
+    assert torch.equal(load_file(shards[0])[name], expected[name])
+
+
+def test_model_uses_mapped_weights_in_place(checkpoint):
+    path, original = checkpoint
+    state_dicts = []
+    mmap_state_dict = weights.mmap_state_dict
+
+    def capture(*args, **kwargs):
+        state_dicts.append(mmap_state_dict(*args, **kwargs))
+        return state_dicts[-1]
+
+    with patch.object(weights, "mmap_state_dict", side_effect=capture):
+        model = weights.load_pretrained_mmap(AutoModelForCausalLM, str(path), torch_dtype=torch.float32, device_map="cpu")
+
+    input_ids = torch.tensor([[2, 5, 6, 7]])
+    assert torch.allclose(model(input_ids).logits, original(input_ids).logits)
+    mapped = state_dicts[0]["model.layers.0.mlp.up_proj.weight"]
+    assert model.model.layers[0].mlp.up_proj.weight.data_ptr() == mapped.data_ptr()
+
+
+def test_load_memory_records_peak():
+    if not process_memory():
+        pytest.skip("/proc is not available")
+    with LoadMemory() as load:
+        block = bytearray(64 * 2**20)
+        del block
+    assert load.peak_rss - load.start["rss"] >= 60 * 2**20
+    assert "peak RSS" in load.summary()